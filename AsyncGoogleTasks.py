@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import quote
+
+from googleapiclient.errors import HttpError
+
+try:
+   import aiohttp
+except ImportError:
+   aiohttp = None
+
+from GoogleTasks import GoogleTasks
+
+# The same tasks, projects, caching and batching as GoogleTasks, but the
+# requests are raw REST calls made from an asyncio event loop over one
+# pooled HTTP session, so listing, paging and bulk changes all overlap
+# without a thread per request.  The event loop runs in its own thread, and
+# the usual synchronous methods just wait on it.  The coroutines (e.g.
+# Task.saveAsync) can be awaited on any loop; the requests are still made
+# on this one, which the HTTP session belongs to.
+
+class RestRequest:
+   # Enough like a googleapiclient request for GoogleTasks to use
+   def __init__( self, taskApi, methodId, method, path, params=None, body=None ):
+      self.taskApi = taskApi
+      self.methodId = methodId
+      self.method = method
+      self.path = path
+      self.params = {}
+      for key, value in ( params or {} ).items():
+         if value is None:
+            continue
+         if isinstance( value, bool ):
+            value = "true" if value else "false"
+         self.params[ key ] = str( value )
+      self.body = body
+      self.headers = {}
+
+   def execute( self, http=None ):
+      return self.taskApi.run( self.executeAsync() )
+
+   async def executeAsync( self ):
+      session = await self.taskApi.session()
+      headers = dict( self.headers )
+      headers[ 'Authorization' ] = 'Bearer ' + await self.taskApi.accessToken()
+      async with session.request( self.method,
+                                  self.taskApi.baseUrl + self.path,
+                                  params=self.params, json=self.body,
+                                  headers=headers ) as response:
+         content = await response.read()
+         if response.status >= 300:
+            import httplib2
+            info = {}
+            for key, value in response.headers.items():
+               info[ key.lower() ] = value
+            info[ 'status' ] = str( response.status )
+            raise HttpError( httplib2.Response( info ), content,
+                             uri=str( response.url ) )
+      if not content:
+         return ''
+      return json.loads( content )
+
+def pathId( apiId ):
+   return quote( apiId, safe='' )
+
+class Tasklists:
+   def __init__( self, taskApi ):
+      self.taskApi = taskApi
+
+   def list( self, maxResults=None, pageToken=None ):
+      return RestRequest( self.taskApi, "tasks.tasklists.list", 'GET',
+                          'users/@me/lists',
+                          { 'maxResults': maxResults, 'pageToken': pageToken } )
+
+   def get( self, tasklist ):
+      return RestRequest( self.taskApi, "tasks.tasklists.get", 'GET',
+                          'users/@me/lists/' + pathId( tasklist ) )
+
+   def insert( self, body ):
+      return RestRequest( self.taskApi, "tasks.tasklists.insert", 'POST',
+                          'users/@me/lists', body=body )
+
+   def update( self, tasklist, body ):
+      return RestRequest( self.taskApi, "tasks.tasklists.update", 'PUT',
+                          'users/@me/lists/' + pathId( tasklist ), body=body )
+
+   def delete( self, tasklist ):
+      return RestRequest( self.taskApi, "tasks.tasklists.delete", 'DELETE',
+                          'users/@me/lists/' + pathId( tasklist ) )
+
+class Tasks:
+   def __init__( self, taskApi ):
+      self.taskApi = taskApi
+
+   def path( self, tasklist, task=None ):
+      path = 'lists/' + pathId( tasklist ) + '/tasks'
+      if task is not None:
+         path += '/' + pathId( task )
+      return path
+
+   def list( self, tasklist, **params ):
+      return RestRequest( self.taskApi, "tasks.tasks.list", 'GET',
+                          self.path( tasklist ), params )
+
+   def get( self, tasklist, task ):
+      return RestRequest( self.taskApi, "tasks.tasks.get", 'GET',
+                          self.path( tasklist, task ) )
+
+   def insert( self, tasklist, body, parent=None, previous=None ):
+      return RestRequest( self.taskApi, "tasks.tasks.insert", 'POST',
+                          self.path( tasklist ),
+                          { 'parent': parent, 'previous': previous }, body=body )
+
+   def update( self, tasklist, task, body ):
+      return RestRequest( self.taskApi, "tasks.tasks.update", 'PUT',
+                          self.path( tasklist, task ), body=body )
+
+   def delete( self, tasklist, task ):
+      return RestRequest( self.taskApi, "tasks.tasks.delete", 'DELETE',
+                          self.path( tasklist, task ) )
+
+   def move( self, tasklist, task, parent=None, previous=None ):
+      return RestRequest( self.taskApi, "tasks.tasks.move", 'POST',
+                          self.path( tasklist, task ) + '/move',
+                          { 'parent': parent, 'previous': previous } )
+
+class RestService:
+   def __init__( self, taskApi ):
+      self.taskApi = taskApi
+
+   def tasklists( self ):
+      return Tasklists( self.taskApi )
+
+   def tasks( self ):
+      return Tasks( self.taskApi )
+
+class AsyncPool:
+   # Runs coroutines on the event loop, looking enough like the thread pool
+   # GoogleTasks would otherwise sync projects with
+   def __init__( self, taskApi ):
+      self.taskApi = taskApi
+      self.futures = []
+
+   def submit( self, coroutineFunction, *args ):
+      future = self.taskApi.start( coroutineFunction( *args ) )
+      self.futures.append( future )
+      return future
+
+   def shutdown( self, cancel_futures=False ):
+      if cancel_futures:
+         for future in self.futures:
+            future.cancel()
+
+class AsyncGoogleTasks( GoogleTasks ):
+   baseUrl = "https://tasks.googleapis.com/tasks/v1/"
+   requestTimeout = 60
+
+   def get_networkErrors( self ):
+      return super().get_networkErrors() + ( aiohttp.ClientError,
+                                             asyncio.TimeoutError )
+
+   networkErrors = property( get_networkErrors )
+
+   class Project( GoogleTasks.Project ):
+      async def getTasksAsync( self ):
+         if not self.loaded:
+            await self.taskApi.loadTasksAsync( [ self ] )
+         return self._tasks
+
+      async def saveAsync( self ):
+         await self.taskApi.batched( self.save )
+
+      async def deleteAsync( self ):
+         await self.taskApi.batched( self.delete )
+
+   class Task( GoogleTasks.Task ):
+      __slots__ = ()
+
+      async def saveAsync( self ):
+         await self.taskApi.batched( self.save )
+
+      async def deleteAsync( self ):
+         await self.taskApi.batched( self.delete )
+
+   class Batch( GoogleTasks.Batch ):
+      # There are no HTTP batches, each chunk's requests are just made at once
+      def executeChunk( self, chunk ):
+         self.taskApi.run( self.executeChunkAsync( chunk ) )
+
+      async def executeChunkAsync( self, chunk ):
+         executor = self.taskApi.executor
+         responses = await asyncio.gather(
+               *[ executor.executeAsync( request )
+                  for request, callback, projectId in chunk ],
+               return_exceptions=True )
+         # Whatever succeeded is applied, even if something else failed
+         failure = None
+         for ( request, callback, projectId ), response in zip( chunk, responses ):
+            if isinstance( response, BaseException ):
+               failure = failure or response
+            elif callback is not None:
+               callback( response )
+         if failure is not None:
+            raise failure
+
+      async def executeAsync( self ):
+         executed = []
+         try:
+            for chunk in self.chunks():
+               executed.extend( chunk )
+               await self.executeChunkAsync( chunk )
+         finally:
+            # Committing may check with the server, through the sync API
+            await asyncio.get_running_loop().run_in_executor( None, self.commit,
+                                                              executed )
+
+   def __init__( self, *args, **kwargs ):
+      if aiohttp is None:
+         raise RuntimeError( "the async backend needs aiohttp: "
+                             "python3 -m pip install --user aiohttp" )
+      super().__init__( *args, **kwargs )
+      self.loop = None
+      self.loopThread = None
+      self.loopLock = threading.Lock()
+      self.httpSession = None
+      self.tokenLock = None
+
+   def buildService( self ):
+      return RestService( self )
+
+   def start( self, coroutine ):
+      with self.loopLock:
+         if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.loopThread = threading.Thread( target=self.loop.run_forever,
+                                                daemon=True )
+            self.loopThread.start()
+      return asyncio.run_coroutine_threadsafe( coroutine, self.loop )
+
+   def run( self, coroutine ):
+      return self.start( coroutine ).result()
+
+   async def onLoop( self, coroutine ):
+      # Awaits coroutine on our loop, whichever loop is awaiting this
+      if self.loop is not None and asyncio.get_running_loop() is self.loop:
+         return await coroutine
+      return await asyncio.wrap_future( self.start( coroutine ) )
+
+   async def session( self ):
+      if self.httpSession is None:
+         self.httpSession = aiohttp.ClientSession(
+               connector=aiohttp.TCPConnector( limit=self.jobs ),
+               timeout=aiohttp.ClientTimeout( total=self.requestTimeout ) )
+      return self.httpSession
+
+   async def accessToken( self ):
+      if not self.creds.valid:
+         if self.tokenLock is None:
+            self.tokenLock = asyncio.Lock()
+         async with self.tokenLock:
+            if not self.creds.valid:
+               from google.auth.transport.requests import Request
+               await asyncio.get_running_loop().run_in_executor(
+                     None, self.creds.refresh, Request() )
+      return self.creds.token
+
+   async def closeSession( self ):
+      if self.httpSession is not None:
+         await self.httpSession.close()
+         self.httpSession = None
+
+   def close( self ):
+      super().close()
+      if self.loop is not None:
+         self.run( self.closeSession() )
+         self.loop.call_soon_threadsafe( self.loop.stop )
+         self.loopThread.join()
+         self.loop.close()
+         self.loop = None
+
+   async def batched( self, queue ):
+      # Collects the requests queue() submits, then makes them concurrently
+      if self.currentBatch is not None:
+         queue()
+         return
+      batch = self.batch()
+      self.currentBatch = batch
+      try:
+         queue()
+      finally:
+         self.currentBatch = None
+      await self.onLoop( batch.executeAsync() )
+
+   async def loadTasksAsync( self, projects ):
+      # As loadTasks, but the stale projects are synced on our loop while
+      # the caller's carries on
+      projects = list( projects )
+      order, stale, rawTasks = self._tasksToLoad( projects )
+      syncs = {}
+      if not self.offline:
+         for project in order:
+            if project in stale:
+               syncs[ project ] = self.start(
+                     self._syncTasksAsync( project, stale[ project ] ) )
+      if syncs:
+         await asyncio.wait( [ asyncio.wrap_future( sync )
+                               for sync in syncs.values() ] )
+      try:
+         for project in order:
+            self._finishLoading( project, stale, rawTasks, syncs.get( project ) )
+      finally:
+         self.saveTaskIds()
+         self.reportDataAge()
+
+   def _syncPool( self ):
+      return AsyncPool( self )
+
+   def _syncInBackground( self, pool, project, cache ):
+      return pool.submit( self._syncTasksAsync, project, cache )
+
+   def _workerHttp( self ):
+      return None
+
+   async def _syncTasksAsync( self, project, cache ):
+      syncTime = time.time()
+      if self.canSyncChanges( cache, syncTime ):
+         try:
+            changes = await self._fetchTasksAsync( project,
+                                                   **self.changesSince( cache ) )
+         except HttpError:
+            changes = None
+         if changes is not None:
+            tasks = self.applyTaskChanges( cache, changes )
+            if tasks is not None:
+               return syncTime, tasks
+      try:
+         return syncTime, await self._fetchTasksAsync( project )
+      except HttpError as e:
+         # The list may have been deleted since the tasklist index was cached
+         if e.resp.status != 404:
+            raise
+         return syncTime, []
+
+   async def _fetchTasksAsync( self, project, **listParams ):
+      first = True
+      nextPage = None
+      tasks = []
+      while nextPage or first:
+         first = False
+         result = await self.executor.executeAsync(
+               lambda: self.service.tasks().list( maxResults=100,
+                                                  tasklist=project.apiId,
+                                                  pageToken=nextPage,
+                                                  showHidden=True,
+                                                  showCompleted=True,
+                                                  **listParams ) )
+         tasks.extend( result.get( 'items', [] ) )
+         nextPage = result.get( 'nextPageToken', None )
+      return tasks
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+# "task serve" keeps an authenticated API client, and every project and
+# task it has loaded, in a long running process.  Other task commands hand
+# it their arguments along with their stdin, stdout and stderr, so it
+# writes straight to their terminal, and just wait to be told the exit
+# status.  Anything the daemon can't do for them (bulk editing, another
+# account...) they are told to run themselves.  Commands run in the
+# client's directory, with its say in the environment variables below.
+
+socketName = '/daemon.sock'
+maxMessage = 1024 * 1024
+forwardedEnvironment = ( 'EDITOR', 'TZ' )
+
+class RunLocally( Exception ):
+   pass
+
+def socketPath( cacheDir ):
+   return cacheDir + socketName
+
+def forward( cacheDir, argv ):
+   # Returns the command's exit status, or None if it must be run here
+   if not hasattr( socket, 'AF_UNIX' ):
+      return None
+   client = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+   try:
+      try:
+         client.connect( socketPath( cacheDir ) )
+      except OSError:
+         return None
+      try:
+         cwd = os.getcwd()
+      except OSError:
+         # It has been removed from under us
+         return None
+      environ = {}
+      for name in forwardedEnvironment:
+         environ[ name ] = os.environ.get( name )
+      request = json.dumps( { 'argv': argv, 'cwd': cwd,
+                              'environ': environ } ).encode( 'utf8' )
+      try:
+         socket.send_fds( client, [ request ], [ 0, 1, 2 ] )
+      except OSError:
+         return None
+      # Once sent, the command may have done anything, so whatever happens
+      # it mustn't be run again here
+      try:
+         client.shutdown( socket.SHUT_WR )
+         reply = receive( client )
+      except ( OSError, ValueError ):
+         reply = None
+   finally:
+      client.close()
+   if reply is None:
+      print( "task: the daemon stopped before saying how the command went",
+             file=sys.stderr )
+      return 1
+   if reply.get( 'local' ):
+      return None
+   return reply[ 'status' ]
+
+def receive( connection ):
+   chunks = []
+   while True:
+      chunk = connection.recv( 65536 )
+      if not chunk:
+         break
+      chunks.append( chunk )
+   if not chunks:
+      return None
+   return json.loads( b''.join( chunks ).decode( 'utf8' ) )
+
+def setEnvironment( environ ):
+   # Returns what it replaced, to put back afterwards
+   previous = {}
+   for name, value in environ.items():
+      if name not in forwardedEnvironment:
+         continue
+      previous[ name ] = os.environ.get( name )
+      if value is None:
+         os.environ.pop( name, None )
+      else:
+         os.environ[ name ] = value
+   if 'TZ' in previous and hasattr( time, 'tzset' ):
+      time.tzset()
+   return previous
+
+class Server:
+   def __init__( self, taskApi, syncApi, settings, cacheDir, run,
+                 syncInterval=60 ):
+      # run( argv, server ) runs a command, calling server.taskApiFor() to
+      # get the warm client, and returns its exit status.  syncApi is
+      # another client with the same cache, which keeps it in sync.
+      self.taskApi = taskApi
+      self.syncApi = syncApi
+      self.settings = settings
+      self.path = socketPath( cacheDir )
+      self.run = run
+      self.syncInterval = syncInterval
+      self.lock = threading.Lock()
+      self.wake = threading.Event()
+      self.stopping = False
+      self.mutated = False
+      self.log = None
+
+   def taskApiFor( self, settings, allowOffline, indexMaxAge, interactive=False ):
+      # The warm client only suits commands wanting what it was set up with,
+      # and an editor needs the terminal to itself
+      if settings != self.settings or interactive:
+         raise RunLocally()
+      if self.taskApi.creds is None:
+         self.taskApi.authenticate()
+      self.taskApi.startCommand( indexMaxAge=indexMaxAge,
+                                 allowOffline=allowOffline )
+      # Changes leave the loaded tasks behind, so they get reloaded
+      self.mutated = not allowOffline
+      return self.taskApi
+
+   def sync( self ):
+      # Keep the cache up with changes made elsewhere, so commands seldom
+      # need to wait for the network.  It is done by a client of its own,
+      # without holding up commands, which then load what changed from the
+      # cache.
+      try:
+         if self.syncApi.creds is None:
+            self.syncApi.authenticate()
+         self.syncApi.startCommand( indexMaxAge=0, allowOffline=True )
+         self.syncApi.refreshCache( self.syncApi.getProjects() )
+      except Exception as e:
+         print( "warning: background sync failed (%s)" % e, file=self.log )
+
+   def syncLoop( self ):
+      while not self.stopping:
+         self.sync()
+         self.wake.wait( self.syncInterval )
+         self.wake.clear()
+
+   def listen( self ):
+      listener = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+      try:
+         listener.connect( self.path )
+      except OSError:
+         # Nobody is answering, so any socket file is left over
+         if os.path.exists( self.path ):
+            os.remove( self.path )
+      else:
+         raise RuntimeError( "task daemon already running", self.path )
+      finally:
+         listener.close()
+      listener = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+      umask = os.umask( 0o077 )
+      try:
+         listener.bind( self.path )
+      finally:
+         os.umask( umask )
+      listener.listen()
+      return listener
+
+   def serve( self ):
+      listener = self.listen()
+      # Commands have the clients' stderr as fd 2 while they run, so the
+      # sync thread writes to a copy of our own
+      self.log = open( os.dup( 2 ), 'w', buffering=1 )
+      self.syncApi.warningFile = self.log
+      syncThread = threading.Thread( target=self.syncLoop, daemon=True )
+      syncThread.start()
+      print( "task daemon listening on %s" % self.path, file=sys.stderr )
+      try:
+         while True:
+            connection, address = listener.accept()
+            with connection:
+               self.handle( connection )
+      except KeyboardInterrupt:
+         pass
+      finally:
+         self.stopping = True
+         self.wake.set()
+         listener.close()
+         os.remove( self.path )
+         with self.lock:
+            self.taskApi.close()
+         self.syncApi.close()
+         self.log.close()
+      return 0
+
+   def handle( self, connection ):
+      try:
+         message, fds, flags, address = socket.recv_fds( connection,
+                                                         maxMessage, 3 )
+      except OSError:
+         return
+      try:
+         request = json.loads( message.decode( 'utf8' ) )
+         if len( fds ) != 3:
+            raise ValueError( "expected stdin, stdout and stderr" )
+         reply = self.runWithFiles( request[ 'argv' ], fds, request[ 'cwd' ],
+                                    request[ 'environ' ] )
+      except ( ValueError, KeyError ) as e:
+         print( "warning: bad request (%s)" % e, file=sys.stderr )
+         reply = { 'local': True }
+      finally:
+         for fd in fds:
+            os.close( fd )
+      try:
+         connection.sendall( json.dumps( reply ).encode( 'utf8' ) )
+      except OSError:
+         # The client has gone, e.g. on Ctrl-C
+         pass
+
+   def runWithFiles( self, argv, fds, cwd, environ ):
+      # Commands print to stdout and stderr, so those become the client's
+      # for the duration, as do its directory and environment
+      with self.lock:
+         savedCwd = os.open( ".", os.O_RDONLY )
+         try:
+            os.chdir( cwd )
+         except OSError:
+            os.close( savedCwd )
+            return { 'local': True }
+         savedEnviron = setEnvironment( environ )
+         sys.stdout.flush()
+         sys.stderr.flush()
+         saved = [ os.dup( fd ) for fd in ( 0, 1, 2 ) ]
+         for fd, clientFd in enumerate( fds ):
+            os.dup2( clientFd, fd )
+         self.mutated = False
+         try:
+            status = self.run( argv, self )
+            reply = { 'status': status or 0 }
+         except RunLocally:
+            reply = { 'local': True }
+         except SystemExit as e:
+            reply = { 'status': e.code if isinstance( e.code, int ) else 1 }
+         except Exception:
+            traceback.print_exc()
+            reply = { 'status': 1 }
+         finally:
+            try:
+               sys.stdout.flush()
+               sys.stderr.flush()
+            except OSError:
+               pass
+            for fd, savedFd in enumerate( saved ):
+               os.dup2( savedFd, fd )
+               os.close( savedFd )
+            setEnvironment( savedEnviron )
+            os.fchdir( savedCwd )
+            os.close( savedCwd )
+         if self.mutated:
+            self.taskApi.forgetProjects()
+            self.wake.set()
+      return reply
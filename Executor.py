@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import random
+import threading
+import time
+
+import Profile
+
+class RateLimiter:
+   # A token bucket shared by every thread making requests.  The rate backs
+   # off sharply when the server says we are going too fast, and creeps
+   # back up again while requests succeed.
+   def __init__( self, rate, burst ):
+      self.maxRate = rate
+      self.rate = rate
+      self.burst = burst
+      self.tokens = burst
+      self.updated = time.monotonic()
+      self.resumeAt = 0
+      self.lock = threading.Lock()
+
+   def reserve( self, count=1 ):
+      # Takes the tokens if they are there, otherwise says how long to wait
+      count = min( count, self.burst )
+      with self.lock:
+         now = time.monotonic()
+         self.tokens = min( self.burst,
+                            self.tokens + ( now - self.updated ) * self.rate )
+         self.updated = now
+         if now >= self.resumeAt and self.tokens >= count:
+            self.tokens -= count
+            return 0
+         return max( self.resumeAt - now, ( count - self.tokens ) / self.rate )
+
+   def acquire( self, count=1 ):
+      wait = self.reserve( count )
+      while wait:
+         time.sleep( wait )
+         wait = self.reserve( count )
+
+   async def acquireAsync( self, count=1 ):
+      import asyncio
+      wait = self.reserve( count )
+      while wait:
+         await asyncio.sleep( wait )
+         wait = self.reserve( count )
+
+   def succeeded( self ):
+      with self.lock:
+         self.rate = min( self.maxRate, self.rate + self.maxRate / 100 )
+
+   def throttle( self, pause ):
+      with self.lock:
+         self.rate = max( self.maxRate / 16, self.rate / 2 )
+         self.tokens = 0
+         self.resumeAt = max( self.resumeAt, time.monotonic() + pause )
+
+class Executor:
+   # Runs API requests through the rate limiter, retrying those that failed
+   # for reasons that may go away, with exponential backoff and jitter
+   maxAttempts = 8
+   baseDelay = 0.5
+   maxDelay = 32
+   retryStatuses = ( 429, 500, 502, 503, 504 )
+   rateLimitReasons = ( "rateLimitExceeded", "userRateLimitExceeded" )
+
+   def __init__( self, rate=25, burst=50, networkErrors=(),
+                 retryNetworkErrors=True ):
+      self.limiter = RateLimiter( rate, burst )
+      self.networkErrors = networkErrors
+      self.retryNetworkErrors = retryNetworkErrors
+
+   def execute( self, request, http=None, cost=1, attempt=0 ):
+      # request builds a fresh API request for each attempt; attempt is how
+      # many have already been made elsewhere, e.g. in a batch
+      while True:
+         self.limiter.acquire( cost )
+         built = request()
+         start = time.perf_counter()
+         try:
+            result = built.execute( http=http )
+         except Exception as e:
+            self.record( built, start, e )
+            attempt += 1
+            delay = self.retryDelay( e, attempt )
+            if delay is None:
+               raise
+            Profile.retry( Profile.methodName( built ), self.retryReason( e ) )
+            with Profile.phase( "backoff" ):
+               time.sleep( delay )
+         else:
+            self.record( built, start, result=result )
+            self.limiter.succeeded()
+            return result
+
+   async def executeAsync( self, request, cost=1 ):
+      import asyncio
+      attempt = 0
+      while True:
+         await self.limiter.acquireAsync( cost )
+         built = request()
+         start = time.perf_counter()
+         try:
+            result = await built.executeAsync()
+         except Exception as e:
+            self.record( built, start, e )
+            attempt += 1
+            delay = self.retryDelay( e, attempt )
+            if delay is None:
+               raise
+            Profile.retry( Profile.methodName( built ), self.retryReason( e ) )
+            await asyncio.sleep( delay )
+         else:
+            self.record( built, start, result=result )
+            self.limiter.succeeded()
+            return result
+
+   def record( self, built, start, exception=None, result=None ):
+      if Profile.enabled:
+         # Not modified is an answer, not a failure
+         failed = exception is not None and self.retryReason( exception ) != "304"
+         Profile.apiCall( Profile.methodName( built ),
+                          time.perf_counter() - start,
+                          sent=getattr( built, 'body', None ), received=result,
+                          failed=failed )
+
+   def retryReason( self, exception ):
+      status = getattr( getattr( exception, 'resp', None ), 'status', None )
+      if status is not None:
+         return str( status )
+      return type( exception ).__name__
+
+   def retryDelay( self, exception, attempt ):
+      # How long to wait before trying again, or None to give up
+      if attempt >= self.maxAttempts:
+         return None
+      backoff = random.uniform( 0, min( self.maxDelay,
+                                        self.baseDelay * 2 ** attempt ) )
+      if isinstance( exception, self.networkErrors ):
+         return backoff if self.retryNetworkErrors else None
+      resp = getattr( exception, 'resp', None )
+      status = getattr( resp, 'status', None )
+      if status == 403 and self.isRateLimited( exception ):
+         status = 429
+      if status not in self.retryStatuses:
+         return None
+      retryAfter = resp.get( 'retry-after', '' )
+      if retryAfter.isdigit():
+         backoff = max( backoff, int( retryAfter ) )
+      if status == 429:
+         # Everyone else needs to slow down too
+         self.limiter.throttle( backoff )
+      return backoff
+
+   def isRateLimited( self, exception ):
+      content = getattr( exception, 'content', b'' ) or b''
+      if isinstance( content, bytes ):
+         content = content.decode( 'utf8', 'replace' )
+      for reason in self.rateLimitReasons:
+         if reason in content:
+            return True
+      return False
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+
+import asyncio
+import collections
+import itertools
+import json
+import random
+import threading
+import time
+import zlib
+
+from googleapiclient.errors import HttpError
+
+# An in-memory stand-in for the Tasks v1 service, looking enough like the
+# one googleapiclient builds for GoogleTasks (or AsyncGoogleTasks) to be
+# given it in place of Google's:
+#
+#   service = FakeTasks.Service( latency=0.05, throttleRate=0.1 )
+#   taskApi = GoogleTasks( configDir, cacheDir, service=service )
+#
+# Every request is counted, so the calls a command makes can be checked,
+# and requests can be slowed down or made to fail, reproducibly for a
+# given seed.  restApp() serves it over HTTP too, for AsyncGoogleTasks'
+# own REST requests.
+
+def apiTime( seconds ):
+   return time.strftime( "%Y-%m-%dT%H:%M:%S", time.gmtime( seconds ) ) + (
+         ".%03dZ" % ( int( seconds * 1000 ) % 1000 ) )
+
+def httpError( status, reason, message, retryAfter=None ):
+   import httplib2
+   info = { 'status': str( status ), 'content-type': 'application/json' }
+   if retryAfter is not None:
+      info[ 'retry-after' ] = str( retryAfter )
+   content = json.dumps( { 'error': {
+         'code': status,
+         'message': message,
+         'errors': [ { 'reason': reason, 'message': message } ] } } )
+   return HttpError( httplib2.Response( info ), content.encode( 'utf8' ) )
+
+def notFound( what ):
+   return httpError( 404, "notFound", "%s not found" % what )
+
+class Request:
+   # Made by the resources below, like a googleapiclient HttpRequest
+   def __init__( self, service, method, handler, params ):
+      self.service = service
+      self.method = method
+      self.handler = handler
+      self.params = params
+      self.headers = {}
+      self.methodId = "tasks." + method
+      self.body = params.get( 'body' )
+
+   def execute( self, http=None, num_retries=0 ):
+      self.service.requested( self.method )
+      time.sleep( self.service.delay() )
+      return self.service.call( self )
+
+   async def executeAsync( self ):
+      self.service.requested( self.method )
+      await asyncio.sleep( self.service.delay() )
+      return self.service.call( self )
+
+class BatchRequest:
+   # One HTTP request, but every request in it counts as an API call
+   maxRequests = 1000
+
+   def __init__( self, service, callback=None ):
+      self.service = service
+      self.callback = callback
+      self.requests = []
+
+   def add( self, request, callback=None, request_id=None ):
+      if len( self.requests ) >= self.maxRequests:
+         raise ValueError( "too many requests in one batch" )
+      if request_id is None:
+         request_id = str( len( self.requests ) + 1 )
+      self.requests.append( ( request, callback or self.callback, request_id ) )
+
+   def execute( self, http=None ):
+      self.service.requested( "batch" )
+      time.sleep( self.service.delay() )
+      with self.service.lock:
+         status = self.service.batchFailures.pop( 0 ) \
+                  if self.service.batchFailures else None
+         if status is not None:
+            self.service.failed[ "batch" ] += 1
+      if status is not None:
+         # None of the requests in it get made
+         raise httpError( status, "backendError", "Injected batch failure" )
+      for request, callback, requestId in self.requests:
+         try:
+            response = self.service.call( request )
+            exception = None
+         except HttpError as e:
+            response = None
+            exception = e
+         if callback is not None:
+            callback( requestId, response, exception )
+
+class Resource:
+   def __init__( self, service, name ):
+      self.service = service
+      self.name = name
+
+   def __getattr__( self, action ):
+      method = self.name + "." + action
+      handler = getattr( self.service, "_%s_%s" % ( self.name, action ), None )
+      if handler is None:
+         raise AttributeError( method )
+      return lambda **params: Request( self.service, method, handler, params )
+
+class Service:
+   # Positions are spaced out, so most moves only change the task moved;
+   # when there is no room left all the siblings are renumbered, without
+   # being marked as updated, which is what Google does too
+   positionSpacing = 1 << 20
+
+   def __init__( self, latency=0, jitter=0, errorRate=0, throttleRate=0,
+                 quota=None, seed=0 ):
+      # latency: seconds each HTTP request takes, give or take jitter
+      # errorRate: chance of any call failing with a 503
+      # throttleRate: chance of any call being refused with a 429
+      # quota: calls allowed per second before the rest get 429s
+      self.latency = latency
+      self.jitter = jitter
+      self.errorRate = errorRate
+      self.throttleRate = throttleRate
+      self.quota = quota
+      # Separate streams, so e.g. changing the latency leaves ids and
+      # failures as they were
+      self.latencyRandom = random.Random( "latency-%d" % seed )
+      self.failureRandom = random.Random( "failure-%d" % seed )
+      self.idRandom = random.Random( "id-%d" % seed )
+      self.lock = threading.Lock()
+      self.lists = {}
+      self.tasksByList = {}
+      self.ids = itertools.count( 1 )
+      self.lastStamp = 0
+      self.failures = []
+      self.batchFailures = []
+      self.quotaUsed = collections.deque()
+      self.resetCounts()
+
+   def resetCounts( self ):
+      # httpRequests counts round trips, by method or "batch", and calls
+      # counts what the API quota sees, by method, including those batched
+      self.httpRequests = collections.Counter()
+      self.calls = collections.Counter()
+      self.failed = collections.Counter()
+
+   def fail( self, *statuses ):
+      # The next calls fail with these statuses, in turn
+      with self.lock:
+         self.failures.extend( statuses )
+
+   def failBatches( self, *statuses ):
+      # The next batches fail as a whole with these statuses, in turn
+      with self.lock:
+         self.batchFailures.extend( statuses )
+
+   def tasklists( self ):
+      return Resource( self, "tasklists" )
+
+   def tasks( self ):
+      return Resource( self, "tasks" )
+
+   def new_batch_http_request( self, callback=None ):
+      return BatchRequest( self, callback )
+
+   def delay( self ):
+      with self.lock:
+         return max( 0, self.latency + self.latencyRandom.uniform( -self.jitter,
+                                                                   self.jitter ) )
+
+   def requested( self, method ):
+      with self.lock:
+         self.httpRequests[ method ] += 1
+
+   def call( self, request ):
+      with self.lock:
+         self.calls[ request.method ] += 1
+         failure = self.injectedFailure()
+         if failure is not None:
+            self.failed[ request.method ] += 1
+            raise failure
+         result = request.handler( request, **request.params )
+         # The caller gets its own copy, as it would from the network
+         return json.loads( json.dumps( result ) )
+
+   def injectedFailure( self ):
+      if self.failures:
+         status = self.failures.pop( 0 )
+         if status == 429:
+            return httpError( 429, "rateLimitExceeded", "Rate Limit Exceeded",
+                              retryAfter=0 )
+         return httpError( status, "backendError", "Injected failure" )
+      if self.quota is not None:
+         now = time.monotonic()
+         while self.quotaUsed and self.quotaUsed[ 0 ] <= now - 1:
+            self.quotaUsed.popleft()
+         if len( self.quotaUsed ) >= self.quota:
+            return httpError( 429, "rateLimitExceeded", "Quota exceeded",
+                              retryAfter=1 )
+         self.quotaUsed.append( now )
+      if self.failureRandom.random() < self.throttleRate:
+         return httpError( 429, "rateLimitExceeded", "Rate Limit Exceeded" )
+      if self.failureRandom.random() < self.errorRate:
+         return httpError( 503, "backendError", "Backend Error" )
+      return None
+
+   def stamp( self ):
+      # Strictly increasing, so every change can be told apart
+      self.lastStamp = max( time.time(), self.lastStamp + 0.001 )
+      return apiTime( self.lastStamp )
+
+   def newId( self ):
+      return "%s%06d" % ( "".join( self.idRandom.choice( "ABCDEFGHIJKLMNOP" )
+                                   for n in range( 10 ) ), next( self.ids ) )
+
+   def page( self, items, maxResults, pageToken, defaultMax ):
+      maxResults = min( int( maxResults or defaultMax ), 100 )
+      start = int( pageToken or 0 )
+      result = { 'items': items[ start:start + maxResults ] }
+      if start + maxResults < len( items ):
+         result[ 'nextPageToken' ] = str( start + maxResults )
+      return result
+
+   def tasklist( self, tasklist ):
+      if tasklist not in self.lists:
+         raise notFound( "tasklist %s" % tasklist )
+      return self.lists[ tasklist ]
+
+   def task( self, tasklist, task ):
+      self.tasklist( tasklist )
+      apiObject = self.tasksByList[ tasklist ].get( task )
+      if apiObject is None or apiObject.get( 'deleted' ):
+         raise notFound( "task %s" % task )
+      return apiObject
+
+   def touch( self, tasklist, *apiObjects ):
+      stamp = self.stamp()
+      self.lists[ tasklist ][ 'updated' ] = stamp
+      for apiObject in apiObjects:
+         apiObject[ 'updated' ] = stamp
+
+   # Tasklists
+
+   def _tasklists_list( self, request, maxResults=None, pageToken=None ):
+      items = list( self.lists.values() )
+      result = self.page( items, maxResults, pageToken, 20 )
+      etag = '"%08x"' % zlib.crc32( json.dumps( items, sort_keys=True ).encode( 'utf8' ) )
+      if request.headers.get( 'If-None-Match' ) == etag:
+         raise httpError( 304, "notModified", "Not Modified" )
+      result[ 'etag' ] = etag
+      return result
+
+   def _tasklists_get( self, request, tasklist ):
+      return self.tasklist( tasklist )
+
+   def _tasklists_insert( self, request, body ):
+      tasklistId = self.newId()
+      self.lists[ tasklistId ] = { 'kind': 'tasks#taskList', 'id': tasklistId,
+                                   'title': body.get( 'title' ) }
+      self.tasksByList[ tasklistId ] = {}
+      self.touch( tasklistId )
+      return self.lists[ tasklistId ]
+
+   def _tasklists_update( self, request, tasklist, body ):
+      self.tasklist( tasklist )[ 'title' ] = body.get( 'title' )
+      self.touch( tasklist )
+      return self.lists[ tasklist ]
+
+   def _tasklists_delete( self, request, tasklist ):
+      self.tasklist( tasklist )
+      del self.lists[ tasklist ]
+      del self.tasksByList[ tasklist ]
+      return ''
+
+   # Tasks
+
+   def siblings( self, tasklist, parent ):
+      return sorted( ( apiObject for apiObject in self.tasksByList[ tasklist ].values()
+                       if apiObject.get( 'parent' ) == parent and
+                          not apiObject.get( 'deleted' ) ),
+                     key=lambda apiObject: apiObject[ 'position' ] )
+
+   def place( self, tasklist, apiObject, parent, previous ):
+      if parent is not None:
+         self.task( tasklist, parent )
+      siblings = [ sibling for sibling in self.siblings( tasklist, parent )
+                   if sibling is not apiObject ]
+      index = 0
+      if previous is not None:
+         siblingIds = [ sibling[ 'id' ] for sibling in siblings ]
+         if previous not in siblingIds:
+            raise httpError( 400, "invalid", "Invalid previous task" )
+         index = siblingIds.index( previous ) + 1
+      before = int( siblings[ index - 1 ][ 'position' ] ) if index else 0
+      after = ( int( siblings[ index ][ 'position' ] ) if index < len( siblings )
+                else before + 2 * self.positionSpacing )
+      if after - before < 2:
+         siblings.insert( index, apiObject )
+         for rank, sibling in enumerate( siblings ):
+            sibling[ 'position' ] = "%020d" % ( ( rank + 1 ) * self.positionSpacing )
+      else:
+         apiObject[ 'position' ] = "%020d" % ( ( before + after ) // 2 )
+      if parent is None:
+         apiObject.pop( 'parent', None )
+      else:
+         apiObject[ 'parent' ] = parent
+
+   def _tasks_list( self, request, tasklist, maxResults=None, pageToken=None,
+                    showCompleted=True, showDeleted=False, showHidden=False,
+                    updatedMin=None, dueMin=None, dueMax=None ):
+      self.tasklist( tasklist )
+      items = []
+      for apiObject in self.tasksByList[ tasklist ].values():
+         if apiObject.get( 'deleted' ) and not showDeleted:
+            continue
+         if apiObject.get( 'hidden' ) and not showHidden:
+            continue
+         if apiObject[ 'status' ] == "completed" and not showCompleted:
+            continue
+         if updatedMin is not None and apiObject[ 'updated' ] < updatedMin:
+            continue
+         if dueMin is not None and apiObject.get( 'due', '' ) < dueMin:
+            continue
+         if dueMax is not None and apiObject.get( 'due', dueMax ) >= dueMax:
+            continue
+         items.append( apiObject )
+      return self.page( items, maxResults, pageToken, 20 )
+
+   def _tasks_get( self, request, tasklist, task ):
+      return self.task( tasklist, task )
+
+   def _tasks_insert( self, request, tasklist, body, parent=None, previous=None ):
+      self.tasklist( tasklist )
+      apiObject = { 'kind': 'tasks#task', 'id': self.newId() }
+      self.setFields( apiObject, body )
+      self.place( tasklist, apiObject, parent, previous )
+      self.tasksByList[ tasklist ][ apiObject[ 'id' ] ] = apiObject
+      self.touch( tasklist, apiObject )
+      return apiObject
+
+   def _tasks_update( self, request, tasklist, task, body ):
+      apiObject = self.task( tasklist, task )
+      self.setFields( apiObject, body )
+      self.touch( tasklist, apiObject )
+      return apiObject
+
+   def _tasks_move( self, request, tasklist, task, parent=None, previous=None ):
+      apiObject = self.task( tasklist, task )
+      self.place( tasklist, apiObject, parent, previous )
+      self.touch( tasklist, apiObject )
+      return apiObject
+
+   def _tasks_delete( self, request, tasklist, task ):
+      apiObject = self.task( tasklist, task )
+      doomed = [ apiObject ]
+      for doomedTask in doomed:
+         doomedTask[ 'deleted' ] = True
+         doomed.extend( child for child in self.tasksByList[ tasklist ].values()
+                        if child.get( 'parent' ) == doomedTask[ 'id' ] and
+                           not child.get( 'deleted' ) )
+      self.touch( tasklist, *doomed )
+      return ''
+
+   def setFields( self, apiObject, body ):
+      # Only the fields a client may change, the rest are the server's
+      for key in ( 'title', 'notes', 'due' ):
+         if body.get( key ) is None:
+            apiObject.pop( key, None )
+         else:
+            apiObject[ key ] = body[ key ]
+      status = body.get( 'status', "needsAction" )
+      if status == "completed" and apiObject.get( 'status' ) != "completed":
+         apiObject[ 'completed' ] = self.stamp()
+      elif status != "completed":
+         apiObject.pop( 'completed', None )
+      apiObject[ 'status' ] = status
+
+restRoutes = (
+   ( 'GET', 'users/@me/lists', 'tasklists', 'list' ),
+   ( 'POST', 'users/@me/lists', 'tasklists', 'insert' ),
+   ( 'GET', 'users/@me/lists/{tasklist}', 'tasklists', 'get' ),
+   ( 'PUT', 'users/@me/lists/{tasklist}', 'tasklists', 'update' ),
+   ( 'DELETE', 'users/@me/lists/{tasklist}', 'tasklists', 'delete' ),
+   ( 'GET', 'lists/{tasklist}/tasks', 'tasks', 'list' ),
+   ( 'POST', 'lists/{tasklist}/tasks', 'tasks', 'insert' ),
+   ( 'GET', 'lists/{tasklist}/tasks/{task}', 'tasks', 'get' ),
+   ( 'PUT', 'lists/{tasklist}/tasks/{task}', 'tasks', 'update' ),
+   ( 'DELETE', 'lists/{tasklist}/tasks/{task}', 'tasks', 'delete' ),
+   ( 'POST', 'lists/{tasklist}/tasks/{task}/move', 'tasks', 'move' ),
+)
+
+def restApp( service, prefix="/tasks/v1/" ):
+   # The same service over HTTP, as an aiohttp application, so the REST
+   # requests AsyncGoogleTasks really makes can be served
+   from aiohttp import web
+
+   def handler( resource, action ):
+      async def handle( httpRequest ):
+         params = dict( httpRequest.match_info )
+         for key, value in httpRequest.query.items():
+            if key == 'maxResults':
+               value = int( value )
+            elif key.startswith( 'show' ):
+               value = value == "true"
+            params[ key ] = value
+         if httpRequest.can_read_body:
+            params[ 'body' ] = await httpRequest.json()
+         request = getattr( getattr( service, resource )(), action )( **params )
+         request.headers = httpRequest.headers
+         try:
+            result = await request.executeAsync()
+         except HttpError as e:
+            headers = {}
+            if e.resp.get( 'retry-after' ):
+               headers[ 'Retry-After' ] = e.resp[ 'retry-after' ]
+            if e.resp.status == 304:
+               return web.Response( status=304, headers=headers )
+            return web.Response( status=e.resp.status, body=e.content,
+                                 content_type="application/json",
+                                 headers=headers )
+         if result == '':
+            return web.Response( status=204 )
+         return web.json_response( result )
+      return handle
+
+   app = web.Application()
+   for method, path, resource, action in restRoutes:
+      app.router.add_route( method, prefix + path, handler( resource, action ) )
+   return app
@@ -1,12 +1,11 @@
 #!/usr/bin/env python3
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.auth.exceptions import RefreshError
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os.path
 import pickle
 import sys
+import threading
 import time
 
 # API docs:
@@ -14,16 +13,35 @@ import time
 #   https://developers.google.com/tasks/get_started
 #   https://developers.google.com/tasks/v1/reference/
 
+# The client libraries take longer to import than most commands take to
+# run from the cache, so they are only imported once the network is needed.
+# The service is built from the discovery document shipped alongside, which
+# can be refreshed from:
+#   https://tasks.googleapis.com/$discovery/rest?version=v1
+
+import Executor
+import Profile
 import Project
-from ShortId import updateShortIds
+from ShortId import ShortIds
 import Task
+import TaskCache
+
+# httplib2 is not thread-safe, so each loader thread gets its own transport
+workerState = threading.local()
 
 class GoogleTasks:
    # If modifying these scopes, any pickled tokens will need removing
    # SCOPES = [ 'https://www.googleapis.com/auth/tasks.readonly' ]
    SCOPES = [ 'https://www.googleapis.com/auth/tasks' ]
 
+   # Changes are fetched from a little before the last sync, in case the
+   # clocks differ, and only while the server still remembers deletions
+   syncMargin = 5 * 60
+   maxDeltaAge = 24 * 60 * 60
+
    appCredentialsFileName = '/app-credentials.json'
+   discoveryDocument = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ),
+                                     'tasks.v1.json' )
    userCredentialsFileName = '/user-token.pickle'
    allTasks = set()
    projects = None
@@ -42,6 +60,13 @@ class GoogleTasks:
          time = "00:00"
       return date + "T" + time + ":00.000Z"
 
+   def describeAge( seconds ):
+      for unit, size in ( ( "day", 86400 ), ( "hour", 3600 ), ( "minute", 60 ) ):
+         if seconds >= size:
+            count = int( seconds // size )
+            return "%d %s%s" % ( count, unit, "" if count == 1 else "s" )
+      return "%d seconds" % seconds
+
    class Project( Project.Project ):
       def __init__( self, taskApi, apiObject  ):
          super().__init__( apiObject.get( 'title' ) )
@@ -67,72 +92,184 @@ class GoogleTasks:
                updated = True
 
          if self.apiId is None:
-            self.apiObject = self.taskApi.tasklists().insert(
-                  body=self.apiObject ).execute()
-            self.apiId = self.apiObject[ 'id' ]
+            def inserted( apiObject ):
+               self.apiObject = apiObject
+               self.apiId = apiObject[ 'id' ]
+               self.taskApi.cacheProject( self, None )
+            self.taskApi.submit( "projectInsert",
+                  lambda: self.taskApi.tasklists().insert(
+                     body=self.apiObject ),
+                  callback=inserted )
          elif updated:
-            self.taskApi.tasklists().update(
-                  tasklist=self.apiId,
-                  body=self.apiObject ).execute()
-            self.taskApi.invalidateProjectCache( self.apiId )
+            def updated( apiObject ):
+               previousUpdate = self.apiObject.get( 'updated' )
+               self.apiObject = apiObject
+               self.taskApi.cacheProject( self, previousUpdate )
+            self.taskApi.submit( "projectUpdate",
+                  lambda: self.taskApi.tasklists().update(
+                     tasklist=self.apiId,
+                     body=self.apiObject ),
+                  callback=updated )
 
       def delete( self ):
-         self.taskApi.tasklists().delete(
-               tasklist=self.apiId ).execute()
-         self.taskApi.invalidateProjectCache( self.apiId )
+         self.taskApi.submit( "projectDelete",
+               lambda: self.taskApi.tasklists().delete(
+                  tasklist=self.apiId ),
+               callback=lambda result: self.taskApi.invalidateProjectCache(
+                  self.apiId ) )
+
+      def loadTasks( projects ):
+         taskApis = {}
+         for project in projects:
+            taskApis.setdefault( project.taskApi, [] ).append( project )
+         for taskApi, apiProjects in taskApis.items():
+            taskApi.loadTasks( apiProjects )
+
+      def streamTasks( projects ):
+         taskApis = set( project.taskApi for project in projects )
+         if len( taskApis ) == 1:
+            return taskApis.pop().streamTasks( projects )
+         return Project.Project.streamTasks( projects )
+
+      def byTaskApi( projects ):
+         taskApis = {}
+         for project in projects:
+            taskApis.setdefault( project.taskApi, [] ).append( project )
+         return taskApis.items()
+
+      def textCandidates( projects, text, fields ):
+         candidates = set()
+         for taskApi, apiProjects in GoogleTasks.Project.byTaskApi( projects ):
+            candidates |= taskApi.textCandidates( apiProjects, text, fields )
+         return candidates
+
+      def tagCandidates( projects, tag ):
+         candidates = set()
+         for taskApi, apiProjects in GoogleTasks.Project.byTaskApi( projects ):
+            candidates |= taskApi.tagCandidates( apiProjects, tag )
+         return candidates
+
+      def dueCandidates( projects, first, last ):
+         candidates = set()
+         for taskApi, apiProjects in GoogleTasks.Project.byTaskApi( projects ):
+            candidates |= taskApi.dueCandidates( apiProjects, first, last )
+         return candidates
 
       def get_tasks( self ):
          if not self.loaded:
-            self.loaded = True
-            for apiObject in self.taskApi._getRawTasks( self ):
-               GoogleTasks.Task( self, apiObject )
-            self.taskApi.assignTaskIds( self._tasks )
-            taskById = {}
-            for task in self._tasks:
-               taskById[ task.apiId ] = task
-            previousByParentId = {}
-            for task in sorted( self._tasks, key=Task.Task.positionKey ):
-               parentId = task.apiObject.get( 'parent', task.project.apiId  )
-               task.parentTask = taskById.get( parentId )
-               predecessorId = previousByParentId.get( parentId )
-               previousTask = taskById.get( predecessorId )
-               if previousTask is None:
-                  task.previousTask = None
-                  task.predecessorId = None
-               else:
-                  task.previousTask = previousTask
-                  task.predecessorId = predecessorId
-               if not task.complete:
-                  previousByParentId[ parentId ] = task.apiId
+            self.taskApi.loadTasks( [ self ] )
          return super().get_tasks()
 
       tasks = property( get_tasks )
 
+      def linkTasks( self, rawTasks ):
+         self.loaded = True
+         for apiObject in rawTasks:
+            self.taskApi.Task( self, apiObject )
+         taskById = {}
+         for task in self._tasks:
+            taskById[ task.apiId ] = task
+         previousByParentId = {}
+         for task in sorted( self._tasks, key=Task.Task.positionKey ):
+            parentId = task.parentId or task.project.apiId
+            task.parentTask = taskById.get( parentId )
+            if task.parentTask is not None:
+               # One copy of each id will do
+               task.parentId = task.parentTask.apiId
+            predecessorId = previousByParentId.get( parentId )
+            previousTask = taskById.get( predecessorId )
+            if previousTask is None:
+               task.previousTask = None
+               task.predecessorId = None
+            else:
+               task.previousTask = previousTask
+               task.predecessorId = predecessorId
+            if not task.complete:
+               previousByParentId[ parentId ] = task.apiId
+
       def newTask( self ):
-         return GoogleTasks.Task( self, {} )
+         return self.taskApi.Task( self, {} )
 
    class Task( Task.Task ):
+      # The API object is not kept, just the fields used from it, and any
+      # that would need sending back; it is made afresh when wanted
+      __slots__ = ( 'projectId', 'apiId', 'parentId', '_position', '_extra',
+                    '_original', 'predecessorId' )
+      usedFields = ( 'id', 'title', 'notes', 'status', 'due', 'parent',
+                     'position' )
+      # Set by the server, and never needed
+      droppedFields = ( 'kind', 'etag', 'selfLink', 'webViewLink', 'links',
+                        'updated' )
+
       def __init__( self, project, apiObject ):
          if not isinstance( project, GoogleTasks.Project ):
             raise RuntimeError( "cannot add Google Task to non-Google project" )
          super().__init__( project )
-         self.project = project
-         self.taskApi = project.taskApi
-         self.projectId = self.project.apiId
+         self.projectId = project.apiId
          self.apiObject = apiObject
-         self.title = apiObject.get( 'title' )
+         # These get set up when read in bulk
+         self.predecessorId = None
+
+      def get_taskApi( self ):
+         return self.project.taskApi
+
+      taskApi = property( get_taskApi )
+
+      def get_apiObject( self ):
+         apiObject = dict( self._extra or () )
+         for key in self.usedFields:
+            value = self.apiValue( key )
+            if value is not None:
+               apiObject[ key ] = value
+         return apiObject
+
+      def set_apiObject( self, apiObject ):
          self.apiId = apiObject.get( 'id' )
-         self.complete = apiObject.get( 'status' ) == "completed"
+         self._title = apiObject.get( 'title' )
+         self._tags = None
+         self._notes = apiObject.get( 'notes' )
+         self._complete = apiObject.get( 'status' ) == "completed"
          if 'due' in apiObject:
-            self.dueDate, self.dueTime = GoogleTasks.fromApiTime(
+            self._dueDate, self._dueTime = GoogleTasks.fromApiTime(
                   apiObject[ 'due' ] )
-         self.notes = apiObject.get( 'notes' )
-         # These get set up when read in bulk
-         self.predecessorId = None
-         self.previousTask = None
+         else:
+            self._dueDate, self._dueTime = None, None
+         self.parentId = apiObject.get( 'parent' )
+         position = apiObject.get( 'position' )
+         self._position = None if position is None else int( position )
+         self._extra = tuple( ( key, value ) for key, value in apiObject.items()
+                              if key not in self.usedFields and
+                                 key not in self.droppedFields ) or None
+         # This is what the server now has
+         self._original = None
+         # A new API object may have a new position
+         Task.Task.invalidateOrder()
+
+      apiObject = property( get_apiObject, set_apiObject )
+
+      def apiValue( self, key ):
+         if key == 'id':
+            return self.apiId
+         if key == 'status':
+            return "completed" if self.complete else "needsAction"
+         if key == 'due':
+            return GoogleTasks.toApiTime( self.dueDate, self.dueTime )
+         if key == 'parent':
+            return self.parentId
+         if key == 'position':
+            return None if self._position is None else "%020d" % self._position
+         return getattr( self, key )
+
+      def changing( self, field ):
+         # Remembers what the server has, so saving knows what has changed
+         key = "status" if field == "complete" else field
+         if self._original is None:
+            self._original = {}
+         if key not in self._original:
+            self._original[ key ] = self.apiValue( key )
 
       def apiOrderKey( self ):
-         return int( self.apiObject.get( 'position', '0' ) )
+         return self._position or 0
 
       def print( self, options=None, outfile=sys.stdout ):
          if options and "debug" in options:
@@ -140,101 +277,327 @@ class GoogleTasks:
          super().print( options=options, outfile=outfile )
 
       def save( self ):
-         status = "completed" if self.complete else "needsAction"
-         due = GoogleTasks.toApiTime( self.dueDate, self.dueTime )
-         apiMap = {
-            'title': self.title,
-            'status': status,
-            'notes': self.notes,
-            'due': due,
-         }
          updated = False
-
-         for key, value in apiMap.items():
-            original = self.apiObject.get( key )
+         for key, original in ( self._original or {} ).items():
+            value = self.apiValue( key )
             if original != value:
-               if value is None:
-                  del self.apiObject[ key ]
-               else:
-                  self.apiObject[ key ] = value
                updated = True
                if key == "due" and original is not None and value is not None:
                   print( "Warning: possible loss of time/repeat:",
                          self, file=sys.stderr )
+         self._original = None
 
          if self.apiId is None or self.projectId != self.project.apiId:
+            # Inserting places the task too, so it never needs moving, but a
+            # task going anywhere but the top of the list waits, as a move
+            # would, for its parent and predecessor to be placed
+            needsMove = False
+            placed = self.parentTask is not None or self.previousTask is not None
             oldId = self.apiId
             oldProjectId = self.projectId
-            self.projectId = self.project.apiId
-            self.apiObject = self.executeWithRetry(
-                                self.taskApi.tasks().insert,
-                                tasklist=self.projectId,
-                                body=self.apiObject )
-            self.apiId = self.apiObject[ 'id' ]
-            self.taskApi.invalidateProjectCache( self.projectId )
+            def insert():
+               insertParam = {
+                     'tasklist': self.project.apiId,
+                     'body': self.apiObject,
+               }
+               if self.parentTask is not None:
+                  insertParam[ 'parent' ] = self.parentTask.apiId
+               if self.previousTask is not None:
+                  insertParam[ 'previous' ] = self.previousTask.apiId
+               return self.taskApi.tasks().insert( **insertParam )
+            def inserted( apiObject ):
+               self.apiObject = apiObject
+               self.apiId = apiObject[ 'id' ]
+               self.projectId = self.project.apiId
+               self.taskApi.cacheTask( self.projectId, apiObject )
+               if self.previousTask is None:
+                  self.predecessorId = None
+               else:
+                  self.predecessorId = self.previousTask.apiId
+            if placed:
+               self.taskApi.submit( "taskMove", insert,
+                     callback=inserted,
+                     projectId=lambda: self.project.apiId,
+                     key=self,
+                     after=( self.parentTask, self.previousTask ) )
+            else:
+               self.taskApi.submit( "taskInsert", insert,
+                     callback=inserted,
+                     projectId=lambda: self.project.apiId )
             if oldId is not None:
-               self.executeWithRetry( self.taskApi.tasks().delete,
-                     tasklist=oldProjectId,
-                     task=oldId )
-               self.taskApi.invalidateProjectCache( oldProjectId )
-         elif updated:
-            self.executeWithRetry( self.taskApi.tasks().update,
-                  tasklist=self.projectId,
-                  task=self.apiId,
-                  body=self.apiObject )
-            self.taskApi.invalidateProjectCache( self.projectId )
-
-         parentId = None if self.parentTask is None else self.parentTask.apiId
-         predecessorId = None if self.previousTask is None else self.previousTask.apiId
-         if self.apiObject.get( 'parent' ) != parentId or self.predecessorId != predecessorId:
-            moveParam = {
-                  'tasklist': self.projectId,
-                  'task': self.apiId,
-            }
-            if parentId is not None:
-               moveParam[ 'parent' ] = parentId
-            if predecessorId is not None:
-               moveParam[ 'previous' ] = predecessorId
-            self.executeWithRetry( self.taskApi.tasks().move,
-                                   **moveParam )
-            self.taskApi.invalidateProjectCache( self.projectId )
+               self.taskApi.submit( "taskDelete",
+                     lambda: self.taskApi.tasks().delete(
+                        tasklist=oldProjectId,
+                        task=oldId ),
+                     callback=lambda result: self.taskApi.uncacheTask(
+                        oldProjectId, oldId ),
+                     projectId=oldProjectId )
+         else:
+            if updated:
+               def updated( apiObject ):
+                  self.apiObject = apiObject
+                  self.taskApi.cacheTask( self.projectId, apiObject )
+               self.taskApi.submit( "taskUpdate",
+                     lambda: self.taskApi.tasks().update(
+                        tasklist=self.projectId,
+                        task=self.apiId,
+                        body=self.apiObject ),
+                     callback=updated,
+                     projectId=self.projectId )
+            if self.moveRequired is None:
+               needsMove = self.needsMove()
+            else:
+               needsMove = self.moveRequired
+         self.moveRequired = None
+
+         if needsMove:
+            def move():
+               moveParam = {
+                     'tasklist': self.projectId,
+                     'task': self.apiId,
+               }
+               if self.parentTask is not None:
+                  moveParam[ 'parent' ] = self.parentTask.apiId
+               if self.previousTask is not None:
+                  moveParam[ 'previous' ] = self.previousTask.apiId
+               return self.taskApi.tasks().move( **moveParam )
+            def moved( apiObject ):
+               self.apiObject = apiObject
+               self.taskApi.cacheTask( self.projectId, apiObject )
+               if self.previousTask is None:
+                  self.predecessorId = None
+               else:
+                  self.predecessorId = self.previousTask.apiId
+            # A task can only be placed once its parent and predecessor are
+            self.taskApi.submit( "taskMove", move,
+                  callback=moved,
+                  projectId=lambda: self.projectId,
+                  key=self,
+                  after=( self.parentTask, self.previousTask ) )
+
+      def needsMove( self ):
+         # Tasks not yet inserted have no id to compare, so must be placed
+         parentId = None
+         if self.parentTask is not None:
+            if self.parentTask.apiId is None:
+               return True
+            parentId = self.parentTask.apiId
+         predecessorId = None
+         if self.previousTask is not None:
+            if self.previousTask.apiId is None:
+               return True
+            predecessorId = self.previousTask.apiId
+         return ( self.parentId != parentId or
+                  self.predecessorId != predecessorId )
 
       def delete( self ):
-         self.executeWithRetry( self.taskApi.tasks().delete,
-               tasklist=self.projectId,
-               task=self.apiId )
-         self.taskApi.invalidateProjectCache( self.projectId )
+         self.taskApi.submit( "taskDelete",
+               lambda: self.taskApi.tasks().delete(
+                  tasklist=self.projectId,
+                  task=self.apiId ),
+               callback=lambda result: self.taskApi.uncacheTask(
+                  self.projectId, self.apiId ),
+               projectId=self.projectId )
 
       def executeWithRetry( self, fn, **params ):
-         maxRetry = 10
-         retriesRemaining = maxRetry
-         result = None
-         while retriesRemaining:
-            retriesRemaining -= 1
-            try:
-               result = fn( **params ).execute()
-               lastException = None
-            except Exception as e:
-               lastException = e
-               time.sleep( maxRetry - retriesRemaining )
+         return self.taskApi.executeWithRetry( lambda: fn( **params ) )
+
+   class Batch:
+      # Mutations are submitted stage by stage, so that inserted projects and
+      # tasks have ids before anything refers to them.  Moves, and inserts
+      # below or after another task, are further split into waves, so a
+      # task is only placed after its parent and predecessor have been.
+      stages = ( "projectInsert", "projectUpdate",
+                 "taskInsert", "taskUpdate", "taskMove", "taskDelete",
+                 "projectDelete" )
+      maxRequests = 50
+
+      def __init__( self, taskApi ):
+         self.taskApi = taskApi
+         self.requests = []
+         self.waveByKey = {}
+
+      def __enter__( self ):
+         self.taskApi.currentBatch = self
+         return self
+
+      def __exit__( self, excType, excValue, traceback ):
+         self.taskApi.currentBatch = None
+         if excType is None:
+            self.execute()
+
+      def add( self, stage, request, callback, projectId, key, after ):
+         wave = 0
+         for dependency in after:
+            dependencyWave = self.waveByKey.get( ( stage, dependency ) )
+            if dependencyWave is not None and dependencyWave >= wave:
+               wave = dependencyWave + 1
+         if key is not None:
+            self.waveByKey[ ( stage, key ) ] = wave
+         order = ( self.stages.index( stage ), wave )
+         self.requests.append( ( order, request, callback, projectId ) )
+
+      def chunks( self ):
+         # The requests, in the order they have to be made
+         groups = {}
+         for order, request, callback, projectId in self.requests:
+            groups.setdefault( order, [] ).append( ( request, callback, projectId ) )
+         self.requests = []
+         for order in sorted( groups ):
+            group = groups[ order ]
+            while group:
+               yield group[ :self.maxRequests ]
+               group = group[ self.maxRequests: ]
+
+      def execute( self ):
+         executed = []
+         for chunk in self.chunks():
+            self.executeChunk( chunk )
+            executed.extend( chunk )
+         self.commit( executed )
+
+      def commit( self, executed ):
+         projectIds = set()
+         for request, callback, projectId in executed:
+            if callable( projectId ):
+               projectId = projectId()
+            if projectId is not None:
+               projectIds.add( projectId )
+         for projectId in projectIds:
+            self.taskApi.commitProjectCache( projectId )
+
+      def executeChunk( self, chunk ):
+         responses = {}
+         failed = []
+         def received( requestId, response, exception ):
+            if exception is None:
+               responses[ requestId ] = response
             else:
-               break
-         if lastException is not None:
-            raise lastException
-         return result
+               failed.append( ( requestId, exception ) )
+
+         executor = self.taskApi.executor
+         built = []
+         def buildBatch():
+            # Made afresh for each attempt, should the batch as a whole fail
+            responses.clear()
+            failed.clear()
+            httpBatch = self.taskApi.service.new_batch_http_request(
+                  callback=received )
+            httpBatch.methodId = "batch"
+            built[:] = [ request() for request, callback, projectId in chunk ]
+            for n, builtRequest in enumerate( built ):
+               httpBatch.add( builtRequest, request_id=str( n ) )
+            return httpBatch
+
+         if len( chunk ) == 1:
+            responses[ "0" ] = executor.execute( chunk[ 0 ][ 0 ] )
+         else:
+            # Each request in a batch counts against the quota
+            with Profile.phase( "batch" ):
+               executor.execute( buildBatch, cost=len( chunk ) )
+            if Profile.enabled:
+               for n, builtRequest in enumerate( built ):
+                  Profile.apiCall( Profile.methodName( builtRequest ), 0,
+                                   sent=getattr( builtRequest, 'body', None ),
+                                   received=responses.get( str( n ) ),
+                                   failed=str( n ) not in responses )
 
+         # Anything that failed in the batch for a reason that may go away
+         # gets retried on its own, after backing off as it would have had
+         # it been sent on its own
+         delays = []
+         for requestId, exception in failed:
+            delay = executor.retryDelay( exception, 1 )
+            if delay is None:
+               raise exception
+            Profile.retry( Profile.methodName( built[ int( requestId ) ] ),
+                           executor.retryReason( exception ) )
+            delays.append( delay )
+         if delays:
+            with Profile.phase( "backoff" ):
+               time.sleep( max( delays ) )
+         for requestId, exception in failed:
+            request = chunk[ int( requestId ) ][ 0 ]
+            responses[ requestId ] = executor.execute( request, attempt=1 )
+         for n, ( request, callback, projectId ) in enumerate( chunk ):
+            if callback is not None:
+               callback( responses[ str( n ) ] )
 
-   def __init__( self, configDir, cacheDir ):
+   def __init__( self, configDir, cacheDir, jobs=8, deltaSync=True,
+                 cacheEngine="sqlite", indexMaxAge=0, offline=False,
+                 allowOffline=False, service=None, account=None ):
+      # service replaces Google's, e.g. with a FakeTasks.Service; account
+      # names alternate credentials, None for the usual ones
       self.creds = None
-      self.service = None
+      self.account = account
+      self._service = service
+      self.serviceGiven = service is not None
+      self.serviceLock = threading.Lock()
+      self._executor = None
       self.configDir = configDir
       self.cacheDir = cacheDir
+      self.jobs = jobs
+      self.deltaSync = deltaSync
+      self.indexMaxAge = indexMaxAge
+      self.offline = offline
+      self.allowOffline = allowOffline
+      self.oldestData = None
+      self.reportedAge = False
+      self.currentBatch = None
+      self.cacheChanges = {}
+      self.cache = TaskCache.engines[ cacheEngine ]( cacheDir )
+      self.taskShortIds = None
+      # A long running process keeps projects loaded while they are current,
+      # and may want warnings kept apart from the output of its commands
+      self.keepLoaded = False
+      self.warningFile = None
+
+   def get_networkErrors( self ):
+      # What a missing or flaky connection looks like
+      from google.auth.exceptions import TransportError
+      import httplib2
+      return ( OSError, httplib2.HttpLib2Error, TransportError )
+
+   networkErrors = property( get_networkErrors )
 
-   def authenticate( self, alternateCredentials=None ):
+   def get_executor( self ):
+      if self._executor is None:
+         # Listing commands would rather go offline than wait for the network
+         self._executor = Executor.Executor(
+               networkErrors=self.networkErrors,
+               retryNetworkErrors=not self.allowOffline )
+      return self._executor
+
+   executor = property( get_executor )
+
+   def get_service( self ):
+      # Built when first used, which may be on a background thread
+      with self.serviceLock:
+         if self._service is None and self.creds is not None:
+            self._service = self.buildService()
+      return self._service
+
+   def set_service( self, service ):
+      self._service = service
+
+   service = property( get_service, set_service )
+
+   def buildService( self ):
+      from googleapiclient.discovery import build_from_document
+      with open( self.discoveryDocument, 'r' ) as document:
+         return build_from_document( json.load( document ),
+                                     credentials=self.creds )
+
+   def authenticate( self ):
+      if self.serviceGiven:
+         return
       self.creds = None
+      self.service = None
+      if self.offline:
+         return
 
-      if alternateCredentials:
-         suffix = "." + alternateCredentials
+      if self.account:
+         suffix = "." + self.account
       else:
          suffix = ""
 
@@ -255,12 +618,20 @@ class GoogleTasks:
       if not self.creds or not self.creds.valid:
          authenticated = False
          if self.creds and self.creds.expired and self.creds.refresh_token:
+            from google.auth.exceptions import TransportError
+            from google.auth.transport.requests import Request
             try:
                self.creds.refresh( Request() )
                authenticated = True
+            except TransportError as e:
+               if not self.allowOffline:
+                  raise
+               self.goOffline( e )
+               return
             except:
                pass
          if not authenticated:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(
                       appCredentialsFile, GoogleTasks.SCOPES )
             self.creds = flow.run_local_server()
@@ -268,7 +639,54 @@ class GoogleTasks:
             with open( userCredentialsFile, 'wb' ) as token:
                pickle.dump( self.creds, token )
 
-      self.service = build( 'tasks', 'v1', credentials=self.creds )
+   def stateKey( self, key ):
+      # Every account shares the cache, but has its own lists and ids
+      if self.account:
+         return key + "." + self.account
+      return key
+
+   def warn( self, message ):
+      print( "warning: " + message, file=self.warningFile or sys.stderr )
+
+   def goOffline( self, reason ):
+      self.warn( "working offline (%s)" % reason )
+      self.offline = True
+
+   def noteDataAge( self, fetched ):
+      if fetched is None:
+         return
+      if self.oldestData is None or fetched < self.oldestData:
+         self.oldestData = fetched
+
+   def reportDataAge( self ):
+      # Offline results are only as good as the cache, so say how old it is
+      if not self.offline or self.reportedAge or self.oldestData is None:
+         return
+      self.reportedAge = True
+      print( "offline: using data cached up to %s ago" %
+             GoogleTasks.describeAge( time.time() - self.oldestData ),
+             file=sys.stderr )
+
+   def startCommand( self, indexMaxAge=0, allowOffline=False ):
+      # A long running process serves one command after another, each with
+      # its own idea of how stale the data may be and whether the network
+      # must be reached
+      self.indexMaxAge = indexMaxAge
+      self.allowOffline = allowOffline
+      self.executor.retryNetworkErrors = not allowOffline
+      self.offline = self.creds is None and not self.serviceGiven
+      self.oldestData = None
+      self.reportedAge = False
+
+   def forgetProjects( self ):
+      # Everything is loaded afresh from the cache next time
+      self.projects = None
+      self.allTasks = set()
+      self.taskShortIds = None
+
+   def close( self ):
+      # Nothing is left running here, but subclasses may have connections
+      pass
 
    def tasklists( self ):
       return self.service.tasklists()
@@ -276,63 +694,432 @@ class GoogleTasks:
    def tasks( self ):
       return self.service.tasks()
 
-   def getProjects( self ):
+   def getProjects( self, maxAge=None ):
+      # The tasklist index is served from the cache while it is fresh, and
+      # revalidated (usually a 304) once it isn't.  A refresh in the
+      # background would only hold up the command's exit.
+      with Profile.phase( "getProjects" ):
+         if maxAge is None:
+            maxAge = self.indexMaxAge
+         index = self.cache.loadState( self.stateKey( "tasklists" ) )
+         if self.offline:
+            if index is None:
+               raise RuntimeError( "no cached tasklists to use offline" )
+         elif index is None or time.time() - index[ 'fetched' ] >= maxAge:
+            try:
+               with Profile.phase( "fetch index" ):
+                  index = self._fetchIndex( index )
+            except self.networkErrors as e:
+               if index is None or not self.allowOffline:
+                  raise
+               self.goOffline( e )
+         if self.offline:
+            self.noteDataAge( index[ 'fetched' ] )
+         previous = {}
+         if self.keepLoaded:
+            for project in self.projects or []:
+               previous[ project.apiId ] = project
+         self.projects = []
+         self.allTasks = set()
+         for apiObject in index[ 'items' ]:
+            project = previous.get( apiObject[ 'id' ] )
+            if project is None or project.apiObject.get( 'updated' ) != apiObject.get( 'updated' ):
+               project = self.Project( self, apiObject )
+            elif project.loaded:
+               self.allTasks |= project._tasks
+            self.projects.append( project )
+         with Profile.phase( "project ids" ):
+            shortIds = ShortIds( "p", self.cache.loadState(
+                  self.stateKey( "projectShortIds" ) ) )
+            shortIds.update( "tasklists",
+                             [ project.apiId for project in self.projects ] )
+            self.assignShortIds( shortIds, self.projects, self.projects )
+            self.saveShortIds( "projectShortIds", shortIds )
+         return self.projects
+
+   def _fetchIndex( self, index ):
+      # A single page index carries an etag, so we can ask if it changed
+      from googleapiclient.errors import HttpError
+      fetched = time.time()
       first = True
       nextPage = None
-      self.projects = []
-      self.allTasks = set()
+      items = []
+      etag = None
       while nextPage or first:
+         request = self.service.tasklists().list( maxResults=100,
+                                                  pageToken=nextPage )
+         if first and index is not None and index[ 'etag' ] is not None:
+            request.headers[ 'If-None-Match' ] = index[ 'etag' ]
+         try:
+            result = self.executeWithRetry( lambda: request )
+         except HttpError as e:
+            if not first or e.resp.status != 304:
+               raise
+            index[ 'fetched' ] = fetched
+            self.cache.storeState( self.stateKey( "tasklists" ), index )
+            return index
+         if first:
+            etag = result.get( 'etag' )
          first = False
-         result = self.service.tasklists().list( maxResults=100,
-                                                 pageToken=nextPage ).execute()
-         for apiObject in result.get( 'items', [] ):
-            self.projects.append( GoogleTasks.Project( self, apiObject ) )
+         items.extend( result.get( 'items', [] ) )
          nextPage = result.get( 'nextPageToken', None )
-      updateShortIds( self.projects, "p" )
-      return self.projects
+         if nextPage:
+            etag = None
+      index = { 'fetched': fetched, 'etag': etag, 'items': items }
+      self.cache.storeState( self.stateKey( "tasklists" ), index )
+      return index
 
    def newProject( self ):
-      return GoogleTasks.Project( self, {} )
+      return self.Project( self, {} )
+
+   def batch( self ):
+      return self.Batch( self )
+
+   def submit( self, stage, request, callback=None, projectId=None,
+               key=None, after=() ):
+      if self.offline:
+         raise RuntimeError( "cannot change tasks while offline" )
+      # request is called to build the API request when it is due, so it
+      # can refer to ids returned by earlier requests in the same batch
+      if self.currentBatch is not None:
+         self.currentBatch.add( stage, request, callback, projectId, key, after )
+         return
+      result = self.executeWithRetry( request )
+      if callback is not None:
+         callback( result )
+      if callable( projectId ):
+         projectId = projectId()
+      if projectId is not None:
+         self.commitProjectCache( projectId )
+
+   def executeWithRetry( self, request, http=None ):
+      return self.executor.execute( request, http=http )
 
    def invalidateProjectCache( self, projectId ):
-      # TODO - can we make it more fine-grained?
-      # TODO - can we make it save back, rather than reload each time?
-      projectCacheFile = self.cacheDir + ( '/project-%s.pickle' % projectId )
-      taskCacheFile = self.cacheDir + ( '/tasks-%s.pickle' % projectId )
-      if os.path.exists( projectCacheFile ):
-         os.remove( projectCacheFile )
-      if os.path.exists( taskCacheFile ):
-         os.remove( taskCacheFile )
-
-   def _getRawTasks( self, project ):
-      projectId = project.apiId
-      updated = project.apiObject[ 'updated' ]
-      projectCacheFile = self.cacheDir + ( '/project-%s.pickle' % projectId )
-      taskCacheFile = self.cacheDir + ( '/tasks-%s.pickle' % projectId )
-      if os.path.exists( projectCacheFile ) and os.path.exists( taskCacheFile ):
-         with open( projectCacheFile, 'rb' ) as projectCache:
-            cachedProject = pickle.load( projectCache )
-            if cachedProject.apiObject[ 'updated' ] >= project.apiObject[ 'updated' ]:
-               with open( taskCacheFile, 'rb' ) as taskCache:
-                  tasks = pickle.load( taskCache )
-                  return tasks
+      self.cacheChanges.pop( projectId, None )
+      self.cache.remove( projectId )
+
+   def cacheTask( self, projectId, apiObject ):
+      self.cacheChanges.setdefault( projectId, {} )[ apiObject[ 'id' ] ] = apiObject
+
+   def uncacheTask( self, projectId, taskId ):
+      self.cacheChanges.setdefault( projectId, {} )[ taskId ] = None
+
+   def cacheProject( self, project, previousUpdate ):
+      # A new project starts with an empty cache, otherwise the cache is
+      # only brought up to date if it was current before the change
+      if previousUpdate is None:
+         self.cache.store( project, time.time(), [] )
+         if self.projects is not None:
+            self.projects.append( project )
+         return
+      cache = self.cache.load( project.apiId )
+      if cache is not None and cache[ 'updated' ] >= previousUpdate:
+         self.cache.storeProject( project )
+
+   def commitProjectCache( self, projectId ):
+      # Apply the results of our own changes to the cached tasks, rather
+      # than making the next command fetch the whole list again
+      changes = self.cacheChanges.pop( projectId, None )
+      if not changes:
+         return
+      cache = self.cache.load( projectId )
+      if cache is None:
+         return
+      project = None
+      for candidate in self.projects or []:
+         if candidate.apiId == projectId:
+            project = candidate
+      self.cache.update( projectId, changes )
+
+      # Only claim to be up to date with the server if we were before, and
+      # the server has not renumbered siblings behind our back.  Otherwise
+      # the next load syncs the changes since the cache was last synced.
+      if project is None or cache[ 'updated' ] < project.apiObject[ 'updated' ]:
+         return
+      if not self.cache.consistent( projectId ):
+         return
+      apiObject = self.executeWithRetry(
+            lambda: self.tasklists().get( tasklist=projectId ) )
+      project.apiObject[ 'updated' ] = apiObject[ 'updated' ]
+      self.cache.setUpdated( projectId, apiObject[ 'updated' ] )
+
+   def loadTasks( self, projects ):
+      for project in self.streamTasks( projects ):
+         pass
+
+   def streamTasks( self, projects ):
+      # Serve what we can from the cache and sync the stale projects in
+      # parallel, handing back each project in order
+      projects = list( projects )
+      order, stale, rawTasks = self._tasksToLoad( projects )
+      pool = None
+      syncs = {}
+      if len( stale ) > 1 and not self.offline:
+         pool = self._syncPool()
+      if pool is not None:
+         for project in order:
+            if project in stale:
+               syncs[ project ] = self._syncInBackground( pool, project,
+                                                          stale[ project ] )
+
+      # Ids keep the length they had last time unless new tasks collide, so
+      # each project can be handed back, to have its ids shown, as soon as
+      # it is loaded.  Only projects never given ids could need a much
+      # longer length, so those are loaded first.
+      identified = self.loadTaskIds().groups
+      try:
+         for project in order:
+            if project.apiId not in identified:
+               self._finishLoading( project, stale, rawTasks,
+                                    syncs.get( project ) )
+         for project in projects:
+            if not project.loaded:
+               self._finishLoading( project, stale, rawTasks,
+                                    syncs.get( project ) )
+            yield project
+      finally:
+         if pool is not None:
+            pool.shutdown( cancel_futures=True )
+         with Profile.phase( "save ids" ):
+            self.saveTaskIds()
+         self.reportDataAge()
+
+   def _tasksToLoad( self, projects ):
+      # Returns the projects to load, in order, the cached state of those
+      # needing a sync (or None), and the raw tasks of the rest.  Ids are as
+      # long as every project's tasks need, so any project that has never
+      # had ids is loaded too, asked for or not, or the ids shown could be
+      # too short by the next command.
+      shortIds = self.loadTaskIds()
+      requested = set( projects )
+      unidentified = [ project for project in self.projects or ()
+                       if project not in requested and
+                          project.apiId not in shortIds.groups ]
+      order = []
+      stale = {}
+      rawTasks = {}
+      with Profile.phase( "read cache" ):
+         for project in projects + unidentified:
+            if project.loaded or project in stale or project in rawTasks:
+               continue
+            cache = self.cache.load( project.apiId )
+            if cache is None and self.offline and project not in requested:
+               # There is nothing to give it ids from
+               continue
+            order.append( project )
+            if cache is not None and cache[ 'updated' ] >= project.apiObject[ 'updated' ]:
+               rawTasks[ project ] = cache[ 'tasks' ]
+               Profile.cache( project.title, "hit" )
+            else:
+               stale[ project ] = cache
+               Profile.cache( project.title, "miss" if cache is None else "stale" )
+      return order, stale, rawTasks
+
+   def _finishLoading( self, project, stale, rawTasks, sync=None ):
+      if project in stale:
+         with Profile.phase( "sync" ):
+            rawTasks[ project ] = self._staleTasks( project, stale[ project ],
+                                                    sync )
+      with Profile.phase( "link" ):
+         project.linkTasks( rawTasks.pop( project ) )
+      with Profile.phase( "task ids" ):
+         self.assignTaskIds( [ project ] )
+
+   def refreshCache( self, projects ):
+      # Syncs the cached tasks of stale projects without loading them, so
+      # another client can load them from the cache without waiting
+      if self.offline:
+         return
+      stale = {}
+      with Profile.phase( "read cache" ):
+         for project in projects:
+            cache = self.cache.load( project.apiId )
+            if cache is None or cache[ 'updated' ] < project.apiObject[ 'updated' ]:
+               stale[ project ] = cache
+      pool = None
+      syncs = {}
+      if len( stale ) > 1:
+         pool = self._syncPool()
+      if pool is not None:
+         for project, cache in stale.items():
+            syncs[ project ] = self._syncInBackground( pool, project, cache )
+      try:
+         for project, cache in stale.items():
+            self._staleTasks( project, cache, syncs.get( project ) )
+      finally:
+         if pool is not None:
+            pool.shutdown( cancel_futures=True )
+
+   def textCandidates( self, projects, text, fields ):
+      return self._indexCandidates( projects,
+            lambda tasklists: self.cache.searchText( text, fields, tasklists ) )
+
+   def tagCandidates( self, projects, tag ):
+      return self._indexCandidates( projects,
+            lambda tasklists: self.cache.searchTags( tag, tasklists ) )
+
+   def dueCandidates( self, projects, first, last ):
+      return self._indexCandidates( projects,
+            lambda tasklists: self.cache.searchDue( first, last, tasklists ) )
+
+   def _indexCandidates( self, projects, search ):
+      # Loaded projects are searched as they are, and are cheap to search
+      tasklists = {}
+      for project in projects:
+         if not project.loaded and project.apiId is not None:
+            tasklists[ project.apiId ] = project.apiObject.get( 'updated', "" )
+      with Profile.phase( "index" ):
+         possible = search( tasklists )
+      if possible is None:
+         return set( projects )
+      return set( project for project in projects
+                  if project.apiId not in tasklists or project.apiId in possible )
+
+   def _staleTasks( self, project, cache, sync=None ):
+      if not self.offline:
+         try:
+            if sync is None:
+               syncTime, tasks = self._syncTasks( project, cache )
+            else:
+               syncTime, tasks = sync.result()
+            self.cache.store( project, syncTime, tasks )
+            return tasks
+         except self.networkErrors as e:
+            if not self.allowOffline:
+               raise
+            self.goOffline( e )
+      # Make do with whatever we have
+      Profile.cache( project.title, "offline" )
+      if cache is None:
+         self.warn( "no cached tasks for %s" % project.title )
+         return []
+      self.noteDataAge( cache[ 'synced' ] )
+      return cache[ 'tasks' ]
+
+   def _syncPool( self ):
+      if self.jobs > 1:
+         return ThreadPoolExecutor( max_workers=self.jobs )
+      return None
+
+   def _syncInBackground( self, pool, project, cache ):
+      return pool.submit( self._syncTasksInWorker, project, cache )
+
+   def _workerHttp( self ):
+      http = getattr( workerState, 'http', None )
+      if http is None or workerState.creds is not self.creds:
+         from google_auth_httplib2 import AuthorizedHttp
+         import httplib2
+         http = AuthorizedHttp( self.creds, http=httplib2.Http() )
+         workerState.http = http
+         workerState.creds = self.creds
+      return http
+
+   def _syncTasksInWorker( self, project, cache ):
+      with Profile.phase( "sync" ):
+         return self._syncTasks( project, cache, http=self._workerHttp() )
+
+   def _syncTasks( self, project, cache, http=None ):
+      from googleapiclient.errors import HttpError
+      syncTime = time.time()
+      if self.canSyncChanges( cache, syncTime ):
+         tasks = self._fetchTaskChanges( project, cache, http=http )
+         if tasks is not None:
+            return syncTime, tasks
+      try:
+         return syncTime, self._fetchTasks( project, http=http )
+      except HttpError as e:
+         # The list may have been deleted since the tasklist index was cached
+         if e.resp.status != 404:
+            raise
+         return syncTime, []
+
+   def canSyncChanges( self, cache, syncTime ):
+      return ( self.deltaSync and cache is not None and
+               cache[ 'synced' ] is not None and
+               syncTime - cache[ 'synced' ] < self.maxDeltaAge )
+
+   def changesSince( self, cache ):
+      # List parameters for the tasks changed since the cache was synced
+      updatedMin = time.strftime( "%Y-%m-%dT%H:%M:%S.000Z",
+            time.gmtime( cache[ 'synced' ] - self.syncMargin ) )
+      return { 'updatedMin': updatedMin, 'showDeleted': True }
+
+   def _fetchTaskChanges( self, project, cache, http=None ):
+      # Apply just the tasks changed since the last sync to the cached ones,
+      # or return None if the result can't be trusted
+      from googleapiclient.errors import HttpError
+      try:
+         changes = self._fetchTasks( project, http=http,
+                                     **self.changesSince( cache ) )
+      except HttpError:
+         return None
+      return self.applyTaskChanges( cache, changes )
+
+   def applyTaskChanges( self, cache, changes ):
+      changeById = {}
+      for task in changes:
+         changeById[ task[ 'id' ] ] = None if task.get( 'deleted' ) else task
+      tasks = TaskCache.applyChanges( cache[ 'tasks' ], changeById )
+      if not TaskCache.consistentTasks( tasks ):
+         return None
+      return tasks
+
+   def _fetchTasks( self, project, http=None, **listParams ):
       first = True
       nextPage = None
       tasks = []
       while nextPage or first:
          first = False
-         result = self.service.tasks().list( maxResults=100, tasklist=projectId,
-                                             pageToken=nextPage, showHidden=True,
-                                             showCompleted=True ).execute()
+         result = self.executeWithRetry(
+               lambda: self.service.tasks().list( maxResults=100,
+                                                  tasklist=project.apiId,
+                                                  pageToken=nextPage,
+                                                  showHidden=True,
+                                                  showCompleted=True,
+                                                  **listParams ),
+               http=http )
          items = result.get( 'items', [] )
          tasks.extend( items )
          nextPage = result.get( 'nextPageToken', None )
-      with open( taskCacheFile, 'wb' ) as taskCache:
-         pickle.dump( tasks, taskCache )
-      with open( projectCacheFile, 'wb' ) as projectCache:
-         pickle.dump( project, projectCache )
       return tasks
 
-   def assignTaskIds( self, newTasks ):
+   def assignTaskIds( self, projects ):
+      # Task ids are kept from run to run, and cover every project we have
+      # seen, not just the ones loaded now, so only the loaded projects'
+      # tasks need hashing, and only if they have changed
+      shortIds = self.loadTaskIds()
+      newTasks = set()
+      for project in projects:
+         shortIds.update( project.apiId, [ task.apiId for task in project._tasks ] )
+         newTasks |= project._tasks
       self.allTasks |= newTasks
-      updateShortIds( self.allTasks, "t" )
+      self.assignShortIds( shortIds, newTasks, self.allTasks )
+
+   def loadTaskIds( self ):
+      if self.taskShortIds is None:
+         self.taskShortIds = ShortIds( "t", self.cache.loadState(
+               self.stateKey( "taskShortIds" ) ) )
+         if not self.offline:
+            projectIds = set( project.apiId for project in self.projects )
+            for projectId in set( self.taskShortIds.groups ) - projectIds:
+               self.taskShortIds.removeGroup( projectId )
+      return self.taskShortIds
+
+   def saveTaskIds( self ):
+      if self.taskShortIds is None:
+         return
+      self.saveShortIds( "taskShortIds", self.taskShortIds )
+
+   def assignShortIds( self, shortIds, items, allItems ):
+      length = shortIds.length
+      if shortIds.uniqueLength() != length:
+         # Everything already given an id needs the longer one
+         items = allItems
+      for item in items:
+         item.shortId = shortIds.shortId( item.apiId )
+
+   def saveShortIds( self, key, shortIds ):
+      if shortIds.changed:
+         self.cache.storeState( self.stateKey( key ), shortIds.state() )
+         shortIds.changed = False
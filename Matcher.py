@@ -3,6 +3,12 @@
 import re
 import sys
 
+def always( projectOrTask ):
+   return True
+
+def never( projectOrTask ):
+   return False
+
 class Matcher():
    def __init__( self ):
       self.debug = False
@@ -10,9 +16,41 @@ class Matcher():
    def match( self, projectOrTask ):
       raise NotImplementedError( "must subclass Matcher.Matcher" )
 
+   def compile( self ):
+      # Returns ( cost, predicate ), where predicate does what match() does
+      # without any debugging.  Groups try their cheapest predicates first.
+      return ( 3, self.match )
+
    def hasInstanceOf( self, classType ):
       return isinstance( self, classType )
 
+   def candidateProjects( self, projects ):
+      # The projects whose tasks could match, or None if they all could
+      return None
+
+   def candidateTasks( self, project ):
+      # Likewise for the tasks in project, when an index can tell
+      return None
+
+class Compiled( Matcher ):
+   # A matcher tree turned into a single predicate
+   def __init__( self, matcher ):
+      super().__init__()
+      self.matcher = matcher
+      self.cost, self.predicate = matcher.compile()
+
+   def match( self, projectOrTask ):
+      return self.predicate( projectOrTask )
+
+   def hasInstanceOf( self, classType ):
+      return self.matcher.hasInstanceOf( classType )
+
+   def candidateProjects( self, projects ):
+      return self.matcher.candidateProjects( projects )
+
+   def candidateTasks( self, project ):
+      return self.matcher.candidateTasks( project )
+
 class Group( Matcher ):
    def __init__( self ):
       super().__init__()
@@ -29,7 +67,59 @@ class Group( Matcher ):
          if matcher.hasInstanceOf( classType ):
             return True
 
+   def compileMatchers( self, skip ):
+      # Children that can't change the result are left out
+      compiled = []
+      for matcher in self.matchers:
+         cost, predicate = matcher.compile()
+         if predicate is not skip:
+            compiled.append( ( cost, predicate ) )
+      return compiled
+
 class And( Group ):
+   def candidateProjects( self, projects ):
+      candidates = None
+      for matcher in self.matchers:
+         matcherCandidates = matcher.candidateProjects( projects )
+         if matcherCandidates is None:
+            continue
+         if candidates is None:
+            candidates = matcherCandidates
+         else:
+            candidates = candidates & matcherCandidates
+      return candidates
+
+   def candidateTasks( self, project ):
+      candidates = None
+      for matcher in self.matchers:
+         matcherCandidates = matcher.candidateTasks( project )
+         if matcherCandidates is None:
+            continue
+         if candidates is None:
+            candidates = matcherCandidates
+         else:
+            candidates = candidates & matcherCandidates
+      return candidates
+
+   def compile( self ):
+      compiled = self.compileMatchers( always )
+      if not compiled:
+         return ( 0, always )
+      if any( predicate is never for cost, predicate in compiled ):
+         return ( 0, never )
+      if len( compiled ) == 1:
+         return compiled[ 0 ]
+      compiled.sort( key=lambda c: c[ 0 ] )
+      predicates = tuple( predicate for cost, predicate in compiled )
+
+      def match( projectOrTask ):
+         for predicate in predicates:
+            if not predicate( projectOrTask ):
+               return False
+         return True
+
+      return ( sum( cost for cost, predicate in compiled ), match )
+
    def match( self, projectOrTask ):
       if self.debug:
          print( "And", "match?", file=sys.stderr )
@@ -43,6 +133,43 @@ class And( Group ):
       return True
 
 class Or( Group ):
+   def candidateProjects( self, projects ):
+      candidates = set()
+      for matcher in self.matchers:
+         matcherCandidates = matcher.candidateProjects( projects )
+         if matcherCandidates is None:
+            return None
+         candidates = candidates | matcherCandidates
+      return candidates
+
+   def candidateTasks( self, project ):
+      candidates = set()
+      for matcher in self.matchers:
+         matcherCandidates = matcher.candidateTasks( project )
+         if matcherCandidates is None:
+            return None
+         candidates = candidates | matcherCandidates
+      return candidates
+
+   def compile( self ):
+      compiled = self.compileMatchers( never )
+      if not compiled:
+         return ( 0, never )
+      if any( predicate is always for cost, predicate in compiled ):
+         return ( 0, always )
+      if len( compiled ) == 1:
+         return compiled[ 0 ]
+      compiled.sort( key=lambda c: c[ 0 ] )
+      predicates = tuple( predicate for cost, predicate in compiled )
+
+      def match( projectOrTask ):
+         for predicate in predicates:
+            if predicate( projectOrTask ):
+               return True
+         return False
+
+      return ( sum( cost for cost, predicate in compiled ), match )
+
    def match( self, projectOrTask ):
       if self.debug:
          print( "Or", "match?", file=sys.stderr )
@@ -56,6 +183,18 @@ class Or( Group ):
       return False
 
 class Not( Group ):
+   def compile( self ):
+      cost, predicate = Or.compile( self )
+      if predicate is always:
+         return ( 0, never )
+      if predicate is never:
+         return ( 0, always )
+
+      def match( projectOrTask ):
+         return not predicate( projectOrTask )
+
+      return ( cost, match )
+
    def match( self, projectOrTask ):
       if self.debug:
          print( "Not", "match?", file=sys.stderr )
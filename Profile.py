@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import json
+import sys
+import threading
+import time
+
+# Records where a run spends its time, for -zt and -zT.  Phases nest, so
+# each is reported under whichever phase was running when it started, on
+# the same thread (background threads start their own tree).  Everything
+# is a no-op unless start() has been called, so the calls can stay in the
+# code for good.
+
+enabled = False
+lock = threading.Lock()
+threadState = threading.local()
+
+class NoPhase:
+   def __enter__( self ):
+      return self
+
+   def __exit__( self, excType, excValue, traceback ):
+      return False
+
+noPhase = NoPhase()
+
+class Phase:
+   def __init__( self, name ):
+      self.name = name
+
+   def __enter__( self ):
+      stack = getattr( threadState, 'stack', None )
+      if stack is None:
+         root = "main" if threading.current_thread() is threading.main_thread() \
+                else "background"
+         stack = threadState.stack = [ root ]
+      stack.append( self.name )
+      self.path = tuple( stack )
+      with lock:
+         if enabled:
+            # Reported in the order they first started
+            profile[ 'phases' ].setdefault( self.path, [ 0, 0.0 ] )
+      self.start = time.perf_counter()
+      return self
+
+   def __exit__( self, excType, excValue, traceback ):
+      end = time.perf_counter()
+      threadState.stack.pop()
+      with lock:
+         if enabled:
+            totals = profile[ 'phases' ].setdefault( self.path, [ 0, 0.0 ] )
+            totals[ 0 ] += 1
+            totals[ 1 ] += end - self.start
+            profile[ 'events' ].append( ( "phase", "/".join( self.path ),
+                                          self.start - profile[ 'started' ],
+                                          end - self.start ) )
+      return False
+
+profile = None
+
+def start():
+   global enabled, profile
+   with lock:
+      profile = {
+         'started': time.perf_counter(),
+         'startedAt': time.time(),
+         'phases': {},
+         'api': {},
+         'retries': {},
+         'cache': {},
+         'events': [],
+      }
+      enabled = True
+   threadState.stack = None
+
+def stop():
+   global enabled
+   with lock:
+      enabled = False
+      profile[ 'total' ] = time.perf_counter() - profile[ 'started' ]
+
+def phase( name ):
+   if not enabled:
+      return noPhase
+   return Phase( name )
+
+def methodName( request ):
+   # e.g. tasks.tasks.list, however the request was made
+   return getattr( request, 'methodId', None ) or type( request ).__name__
+
+def size( body ):
+   if body is None:
+      return 0
+   if isinstance( body, bytes ):
+      return len( body )
+   if not isinstance( body, str ):
+      body = json.dumps( body )
+   return len( body.encode( 'utf8' ) )
+
+def apiCall( method, seconds, sent=None, received=None, failed=False ):
+   # Batched calls are recorded with no time of their own, that all goes
+   # to the batch
+   if not enabled:
+      return
+   sentBytes = size( sent )
+   receivedBytes = size( received )
+   with lock:
+      if not enabled:
+         return
+      totals = profile[ 'api' ].setdefault( method, {
+            'calls': 0, 'failed': 0, 'seconds': 0.0, 'sent': 0, 'received': 0 } )
+      totals[ 'calls' ] += 1
+      totals[ 'failed' ] += 1 if failed else 0
+      totals[ 'seconds' ] += seconds
+      totals[ 'sent' ] += sentBytes
+      totals[ 'received' ] += receivedBytes
+      profile[ 'events' ].append( ( "api", method,
+            time.perf_counter() - seconds - profile[ 'started' ], seconds ) )
+
+def retry( method, reason ):
+   if not enabled:
+      return
+   with lock:
+      if enabled:
+         retries = profile[ 'retries' ].setdefault( method, {} )
+         retries[ reason ] = retries.get( reason, 0 ) + 1
+
+def cache( project, outcome ):
+   # outcome is "hit", "stale" (synced changes), "miss" or "offline"
+   if not enabled:
+      return
+   with lock:
+      if enabled:
+         profile[ 'cache' ][ project ] = outcome
+
+def phaseOrder():
+   # Each phase under its parent, main thread first, otherwise as they started
+   started = { path: n for n, path in enumerate( profile[ 'phases' ] ) }
+   def key( path ):
+      return ( ( path[ 0 ] != "main", path[ 0 ] ) +
+               tuple( started.get( path[ :end ], -1 )
+                      for end in range( 2, len( path ) + 1 ) ) )
+   return sorted( profile[ 'phases' ], key=key )
+
+def report( outfile=sys.stderr ):
+   print( "profile: %.3fs" % profile[ 'total' ], file=outfile )
+   print( "  %-44s %6s %9s" % ( "phase", "count", "seconds" ), file=outfile )
+   for path in phaseOrder():
+      count, seconds = profile[ 'phases' ][ path ]
+      name = "  " * ( len( path ) - 2 ) + path[ -1 ]
+      if len( path ) == 2 and path[ 0 ] != "main":
+         name += " (%s)" % path[ 0 ]
+      print( "  %-44s %6d %9.3f" % ( name, count, seconds ), file=outfile )
+   if profile[ 'api' ]:
+      print( "  %-30s %6s %6s %9s %9s %9s" % (
+            "api method", "calls", "failed", "seconds", "sent", "received" ),
+            file=outfile )
+      for method, totals in sorted( profile[ 'api' ].items() ):
+         print( "  %-30s %6d %6d %9.3f %9d %9d" % (
+               method, totals[ 'calls' ], totals[ 'failed' ], totals[ 'seconds' ],
+               totals[ 'sent' ], totals[ 'received' ] ), file=outfile )
+   for method, reasons in sorted( profile[ 'retries' ].items() ):
+      print( "  retried %s: %s" % ( method, ", ".join(
+            "%s x%d" % ( reason, count )
+            for reason, count in sorted( reasons.items() ) ) ), file=outfile )
+   if profile[ 'cache' ]:
+      outcomes = {}
+      for project, outcome in profile[ 'cache' ].items():
+         outcomes.setdefault( outcome, [] ).append( project )
+      print( "  cache: %s" % ", ".join(
+            "%d %s" % ( len( projects ), outcome )
+            for outcome, projects in sorted( outcomes.items() ) ), file=outfile )
+      for outcome, projects in sorted( outcomes.items() ):
+         if outcome != "hit":
+            print( "    %s: %s" % ( outcome, ", ".join( sorted( projects ) ) ),
+                   file=outfile )
+
+def writeTrace( filename, argv ):
+   # One JSON object per line, so runs can be appended and compared
+   trace = {
+      'version': 1,
+      'started': profile[ 'startedAt' ],
+      'argv': argv,
+      'total': profile[ 'total' ],
+      'phases': [ { 'phase': "/".join( path ),
+                    'count': profile[ 'phases' ][ path ][ 0 ],
+                    'seconds': profile[ 'phases' ][ path ][ 1 ] }
+                  for path in phaseOrder() ],
+      'api': profile[ 'api' ],
+      'retries': profile[ 'retries' ],
+      'cache': profile[ 'cache' ],
+      'events': [ { 'kind': kind, 'name': name, 'at': at, 'seconds': seconds }
+                  for kind, name, at, seconds in profile[ 'events' ] ],
+   }
+   with open( filename, 'a' ) as traceFile:
+      print( json.dumps( trace ), file=traceFile )
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
+import bisect
 import re
 import sys
 
 import Matcher
+import Profile
+import Reorder
 import Task
 
 class Project:
@@ -11,6 +14,8 @@ class Project:
       self.shortId = None
       self.title = title
       self._tasks = set()
+      # ( generation, dueDates, tasks ), the due tasks sorted by due date
+      self._dueIndex = None
 
    def save( self ):
       raise NotImplementedError( "must subclass Project.Project" )
@@ -23,15 +28,55 @@ class Project:
 
    def addTask( self, task ):
       self._tasks.add( task )
+      self._dueIndex = None
 
    def removeTask( self, task ):
-      self._tasks.add( task )
+      self._tasks.discard( task )
+      self._dueIndex = None
 
    def get_tasks( self ):
       return self._tasks
 
    tasks = property( get_tasks )
 
+   def loadTasks( projects ):
+      for project in projects:
+         _ = project.tasks
+
+   def streamTasks( projects ):
+      for project in projects:
+         _ = project.tasks
+         yield project
+
+   def textCandidates( projects, text, fields ):
+      # Those of projects that may have a task with text in one of fields,
+      # or None if there is no index to tell
+      return None
+
+   def tagCandidates( projects, tag ):
+      # Likewise for a task with the tag
+      return None
+
+   def dueCandidates( projects, first, last ):
+      # Likewise for a task due from first to last
+      return None
+
+   def tasksDue( self, first, last ):
+      # The tasks due from first to last, inclusive, either of which may be
+      # None.  Due dates only change along with the order generation, so the
+      # index is rebuilt after loading, syncing or editing
+      tasks = self.tasks
+      if ( self._dueIndex is None or
+           self._dueIndex[ 0 ] != Task.Task.orderGeneration ):
+         dueTasks = sorted( ( task for task in tasks if task.dueDate ),
+                            key=lambda task: task.dueDate )
+         self._dueIndex = ( Task.Task.orderGeneration,
+                            [ task.dueDate for task in dueTasks ], dueTasks )
+      generation, dueDates, dueTasks = self._dueIndex
+      start = 0 if first is None else bisect.bisect_left( dueDates, first )
+      end = len( dueDates ) if last is None else bisect.bisect_right( dueDates, last )
+      return dueTasks[ start:end ]
+
    def __str__( self ):
       return "* (" + self.shortId + ") " + self.title
 
@@ -40,7 +85,10 @@ class Project:
 
    def matchingTasks( self, options, criteria ):
       match = set()
-      for task in self.tasks:
+      tasks = criteria.candidateTasks( self )
+      if tasks is None:
+         tasks = self.tasks
+      for task in tasks:
          if "debugMatching" in options:
             print( "", file=sys.stderr )
             print( "Matching...", task.shortId, task, file=sys.stderr )
@@ -67,20 +115,54 @@ class Project:
             return "99-" + name
       return sorted( projects, key=lambda p: titleSorter( p.title ) )
 
-   def parse( line ):
-      match = re.match( r"^[*] \((p[0-9a-f]*)\) (.*)", line )
+   linePattern = re.compile( r"^[*] \((p[0-9a-f]*)\) (.*)" )
+
+   def parseLine( line ):
+      # Returns ( shortId, title ), or None if this isn't a project line
+      match = Project.linePattern.match( line )
       if match:
-         project = Project( match[ 2 ] )
-         project.shortId = match[ 1 ]
+         return match[ 1 ], match[ 2 ]
+      return None
+
+   def parse( line ):
+      fields = Project.parseLine( line )
+      if fields:
+         project = Project( fields[ 1 ] )
+         project.shortId = fields[ 0 ]
          return project
       return None
 
+def candidateProjects( projects, criteria ):
+   # Only projects the criteria could match need their tasks loaded; short
+   # ids stay consistent because they are kept between runs
+   candidates = criteria.candidateProjects( projects )
+   if candidates is None:
+      return list( projects )
+   return [ project for project in projects if project in candidates ]
+
+def loadTasks( projects ):
+   # Each Project subclass may load its projects in bulk.
+   projectsByClass = {}
+   for project in Project.sort( projects ):
+      projectsByClass.setdefault( type( project ), [] ).append( project )
+   for projectClass, classProjects in projectsByClass.items():
+      projectClass.loadTasks( classProjects )
+
+def streamTasks( projects ):
+   # Yields the projects in sort order, each as soon as its tasks are loaded
+   projects = Project.sort( projects )
+   projectClasses = set( type( project ) for project in projects )
+   if len( projectClasses ) == 1:
+      return projectClasses.pop().streamTasks( projects )
+   return Project.streamTasks( projects )
+
 def write( projects, options, criteria, outfile=sys.stdout ):
    printedProject = set()
 
-   # Force reading of all tasks, so we get consistent short Ids.
-   for project in Project.sort( projects ):
-      _ = project.tasks
+   candidates = candidateProjects( projects, criteria )
+   loaded = streamTasks( candidates )
+   candidates = set( candidates )
+   ready = set()
 
    for project in Project.sort( projects ):
 
@@ -98,91 +180,116 @@ def write( projects, options, criteria, outfile=sys.stdout ):
               criteria.hasInstanceOf( ProjectMatcher ) ) ):
          printProjectIfNeeded()
 
-      sortKey = Task.Task.positionKey
-      for task in sorted( project.tasks, key=sortKey ):
-         if task.complete and "all" not in options:
-            continue
-         if criteria.match( task ):
-            printProjectIfNeeded()
-            task.print( options=options, outfile=outfile )
+      if project not in candidates:
+         continue
+      # Print each project as soon as it arrives, while later ones load
+      with Profile.phase( "wait" ):
+         while project not in ready:
+            ready.add( next( loaded ) )
+      with Profile.phase( "sort" ):
+         # Only the tasks an index picks out need matching
+         tasks = criteria.candidateTasks( project )
+         if tasks is None:
+            tasks = project.tasks
+         tasks = sorted( tasks, key=Task.Task.positionKey )
+      with Profile.phase( "print" ):
+         for task in tasks:
+            if task.complete and "all" not in options:
+               continue
+            if criteria.match( task ):
+               printProjectIfNeeded()
+               task.print( options=options, outfile=outfile )
+         outfile.flush()
+
+   loaded.close()
 
 class ParseError( RuntimeError ):
    pass
 
+def tokenize( infile ):
+   # Classifies each line once, as it is read, without creating anything
+   for lineNo, line in enumerate( infile, 1 ):
+      fields = Project.parseLine( line )
+      if fields is not None:
+         yield lineNo, "project", line, fields
+         continue
+      fields = Task.Task.parseLine( line )
+      if fields is not None:
+         yield lineNo, "task", line, fields
+         continue
+      yield lineNo, "text", line, None
+
 def read( taskApi, options, infile=None ):
    projects = taskApi.getProjects()
-   # Force reading of all tasks, so we get consistent short Ids.
-   for project in Project.sort( projects ):
-      _ = project.tasks
+   loadTasks( projects )
 
    projectTitles = set()
    projectById = {}
    taskById = {}
+   # Where each task was listed, so reordering can move as few as possible
+   originalParent = {}
+   originalRank = {}
    for project in projects:
       projectById[ project.shortId ] = project
       projectTitles.add( project.title )
-      for task in project.tasks:
+      for rank, task in enumerate( sorted( project.tasks, key=Task.Task.positionKey ) ):
          taskById[ task.shortId ] = task
+         originalParent[ task ] = task.parentTask or task.project
+         originalRank[ task ] = rank
 
    currentProject = None
    prevTask = None
    prevLevel = None
-   lastInParent = {}
+   siblingsInParent = {}
    tasksToDelete = set()
    projectsToDelete = set()
    projectsToSave = set()
    tasksToSave = []
    used = set()
-   line = None
+   lines = tokenize( infile )
    lineNo = 0
+   kind = None
+   line = None
+   fields = None
    def readLine():
-      nonlocal line, lineNo
-      if not infile.readable():
-         line = None
-         return
-      line = infile.readline()
-      if line == '':
-         line = None
-         return
-      lineNo += 1
+      nonlocal lineNo, kind, line, fields
+      lineNo, kind, line, fields = next( lines, ( lineNo, None, None, None ) )
 
    def isComment():
-      if line is None:
-         return False
-      return re.match( r"^\s*$", line ) or re.match( r"^#", line )
+      return kind == "text" and ( line.isspace() or line.startswith( "#" ) )
 
    def parseComment():
       while isComment():
          readLine()
 
    def isTask():
-      if line is None:
-         return False
-      return Task.Task.parse( currentProject, line ) is not None
+      return kind == "task"
 
    def parseTask():
       nonlocal prevTask, prevLevel
       if not currentProject:
          raise ParseError( "Line %d - task not in project: %s" % ( lineNo, line ) )
-      task, isDeleted, level = Task.Task.parse( currentProject, line )
-      if task is None:
-         return
+      shortId, complete, dueDate, title, isDeleted, level = fields
       errorLineNo = lineNo
       readLine()
-      while ( line is not None and
-              not isTask() and
-              not isProject() ):
-         if task.notes:
-            task.notes += line
-         else:
-            task.notes = line
+      notes = []
+      while kind == "text":
+         notes.append( line )
          readLine()
-      if task.notes:
-         task.notes = task.notes.strip()
-
-      original = taskById.get( task.shortId )
+      notes = "".join( notes ).strip() if notes else None
+
+      original = taskById.get( shortId )
+      if not original and shortId != "t":
+         # Ids may have grown longer since they were written, but still
+         # start the same way
+         matching = [ task for taskId, task in taskById.items()
+                      if taskId.startswith( shortId ) ]
+         if len( matching ) > 1:
+            raise ParseError( "Line %d - ambiguous id: %s" % ( errorLineNo, shortId ) )
+         if matching:
+            original = matching[ 0 ]
       if not original:
-         original = project.newTask()
+         original = currentProject.newTask()
 
       if original in used:
          raise ParseError( "Line %d - duplicate id: %s" % ( errorLineNo, original.shortId ) )
@@ -192,38 +299,36 @@ def read( taskApi, options, infile=None ):
          tasksToDelete.add( original )
          return
 
-      original.title = task.title
+      original.title = title
       if "verbose" in options:
-         original.notes = task.notes
-      original.dueDate = task.dueDate
-      original.complete = task.complete
-      original.project = task.project
+         original.notes = notes
+      original.dueDate = dueDate
+      original.complete = complete
+      original.project = currentProject
 
       if prevTask is None:
          if level != 0:
-            raise ParseError( "Line %d - cannot start from level %d" % ( lineNo, level ) )
+            raise ParseError( "Line %d - cannot start from level %d" % ( errorLineNo, level ) )
          original.parentTask = None
          posInParentKey = original.project
       elif level > prevTask.level() + 1:
-         raise ParseError( "Line %d - cannot jump from level %d to %d" % ( lineNo, prevTask.level(), level ) )
+         raise ParseError( "Line %d - cannot jump from level %d to %d" % ( errorLineNo, prevTask.level(), level ) )
       else:
          parent = prevTask
          parentLevel = parent.level()
          while parentLevel >= level:
             parent = parent.parentTask
             parentLevel -= 1
-         levelBefore = original.level()
          original.parentTask = parent
-         levelAfter = original.level()
-         if levelAfter == 0:
+         if original.level() == 0:
             posInParentKey = original.project
          else:
             posInParentKey = parent
 
-      predecessor = lastInParent.get( posInParentKey, None )
-      predecessorId = predecessor.apiId if predecessor is not None else None
+      siblings = siblingsInParent.setdefault( posInParentKey, [] )
+      predecessor = siblings[ -1 ] if siblings else None
       original.previousTask = predecessor
-      lastInParent[ posInParentKey ] = original
+      siblings.append( original )
 
       prevTask = original
       prevLevel = original.level()
@@ -231,30 +336,26 @@ def read( taskApi, options, infile=None ):
       tasksToSave.append( original )
 
    def isProject():
-      if line is None:
-         return False
-      return Project.parse( line ) is not None
+      return kind == "project"
 
    def parseProject():
       nonlocal currentProject
-      project = Project.parse( line )
-      if project is None:
-         return
+      shortId, title = fields
 
-      original = projectById.get( project.shortId )
+      original = projectById.get( shortId )
       if not original:
-         if project.title in projectTitles:
-            raise ParseError( "Line %d - project %s already exists, refusing to duplicate name" % ( lineNo, project.title ) )
+         if title in projectTitles:
+            raise ParseError( "Line %d - project %s already exists, refusing to duplicate name" % ( lineNo, title ) )
          original = taskApi.newProject()
 
       if original in used:
          raise ParseError( "Line %d - duplicate id: %s" % ( lineNo, original.shortId ) )
       used.add( original )
 
-      if project.title == "-":
+      if title == "-":
          projectsToDelete.add( original )
       else:
-         original.title = project.title
+         original.title = title
          projectsToSave.add( original )
          currentProject = original
 
@@ -272,22 +373,34 @@ def read( taskApi, options, infile=None ):
       while isProject():
          parseProject()
 
-      if line and not isProject():
+      if line is not None:
          raise ParseError( "Line %d - expected project, got: %s" % ( lineNo, line ) )
 
-   parseFile()
+   with Profile.phase( "parse" ):
+      parseFile()
    for project in projectsToDelete:
       if project.tasks:
          raise ParseError( "Project %s has tasks, refusing to delete" % project.shortId )
 
-   for item in projectsToSave:
-      item.save()
-   for item in tasksToSave:
-      item.save()
-   for item in tasksToDelete:
-      item.delete()
-   for project in projectsToDelete:
-      project.delete()
+   with Profile.phase( "plan moves" ):
+      for parent, siblings in siblingsInParent.items():
+         ranks = {}
+         for task in siblings:
+            if originalParent.get( task ) is parent:
+               ranks[ task ] = originalRank[ task ]
+         moving = set( Reorder.tasksToMove( siblings, ranks ) )
+         for task in siblings:
+            task.moveRequired = task in moving
+
+   with Profile.phase( "save" ), taskApi.batch():
+      for item in projectsToSave:
+         item.save()
+      for item in tasksToSave:
+         item.save()
+      for item in tasksToDelete:
+         item.delete()
+      for project in projectsToDelete:
+         project.delete()
 
 class ProjectMatcher( Matcher.Matcher ):
    def isProject( projectOrTask ):
@@ -316,3 +429,28 @@ class WordMatcher( ProjectMatcher ):
          else:
             print( "Project.Word", "no match", file=sys.stderr )
       return result
+
+   def candidateProjects( self, projects ):
+      return set( project for project in projects
+                  if self.word == project.shortId or
+                     re.search( self.word, project.title, flags=re.IGNORECASE ) )
+
+   def compile( self ):
+      # Every task in a project gets the same answer, so only ask once
+      word = self.word
+      search = re.compile( word, flags=re.IGNORECASE ).search
+      results = {}
+
+      def match( projectOrTask ):
+         if isinstance( projectOrTask, Project ):
+            project = projectOrTask
+         else:
+            project = projectOrTask.project
+         result = results.get( project )
+         if result is None:
+            result = ( project.shortId == word or
+                       search( project.title ) is not None )
+            results[ project ] = result
+         return result
+
+      return ( 1, match )
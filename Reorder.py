@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_left
+
+def longestOrderedRun( ranks ):
+   # The indices of a longest strictly increasing run (not necessarily
+   # contiguous) of ranks, found by patience sorting
+   tails = []
+   tailIndices = []
+   previous = []
+   for index, rank in enumerate( ranks ):
+      length = bisect_left( tails, rank )
+      if length == len( tails ):
+         tails.append( rank )
+         tailIndices.append( index )
+      else:
+         tails[ length ] = rank
+         tailIndices[ length ] = index
+      previous.append( tailIndices[ length - 1 ] if length else None )
+   run = set()
+   index = tailIndices[ -1 ] if tailIndices else None
+   while index is not None:
+      run.add( index )
+      index = previous[ index ]
+   return run
+
+def tasksToMove( siblings, originalRanks ):
+   # siblings are in their new order, and originalRanks gives the old order
+   # of those that were siblings before.  The longest run still in the old
+   # order can stay put; everything else is moved in around it.
+   placed = [ task for task in siblings if task in originalRanks ]
+   run = longestOrderedRun( [ originalRanks[ task ] for task in placed ] )
+   staying = set( placed[ index ] for index in run )
+   return [ task for task in siblings if task not in staying ]
@@ -3,47 +3,144 @@
 from hashlib import sha256
 
 class Trie:
+    # Nodes are only expanded as far as needed to tell strings apart: a node
+    # holding a single string keeps the rest of it in "rest" until another
+    # string arrives to share the prefix.  Counting the nodes shared by more
+    # than one string at each depth gives the unique prefix length directly.
     def __init__( self ):
-        self.letters = {}
+        self.root = { "freq" : 0, "letters" : {} }
+        self.sharedAtDepth = {}
+
+    def _share( self, depth, delta ):
+        self.sharedAtDepth[ depth ] = self.sharedAtDepth.get( depth, 0 ) + delta
+        if not self.sharedAtDepth[ depth ]:
+            del self.sharedAtDepth[ depth ]
 
     def addString( self , s ):
-        letters = self.letters
-        for c in s:
+        node = self.root
+        node[ "freq" ] += 1
+        if node[ "freq" ] == 2:
+            self._share( 0, 1 )
+        for depth, c in enumerate( s ):
+            letters = node[ "letters" ]
             if c not in letters:
-                letters[ c ] = { "freq" : 1 }
-            else:
-                letters[ c ][ "freq" ] += 1
-            letters = letters[ c ]
-        letters[ "*" ] = True #marks the end of word
-        
+                letters[ c ] = { "freq" : 1, "letters" : {}, "rest" : s[ depth + 1: ] }
+                return
+            node = letters[ c ]
+            rest = node.pop( "rest", None )
+            if rest:
+                node[ "letters" ][ rest[ 0 ] ] = { "freq" : 1, "letters" : {},
+                                                   "rest" : rest[ 1: ] }
+            node[ "freq" ] += 1
+            if node[ "freq" ] == 2:
+                self._share( depth + 1, 1 )
+
+    def removeString( self, s ):
+        node = self.root
+        node[ "freq" ] -= 1
+        if node[ "freq" ] == 1:
+            self._share( 0, -1 )
+        for depth, c in enumerate( s ):
+            letters = node[ "letters" ]
+            child = letters[ c ]
+            child[ "freq" ] -= 1
+            if child[ "freq" ] == 0:
+                del letters[ c ]
+                return
+            if child[ "freq" ] == 1:
+                self._share( depth + 1, -1 )
+            node = child
+
     def generateUniquePrefix( self, s ):
         prefix = []
-        letters = self.letters
+        node = self.root
         for c in s:
             prefix.append( c )
-            if letters[ c ][ "freq" ] == 1:
+            node = node[ "letters" ][ c ]
+            if node[ "freq" ] == 1:
                 break
-            letters = letters[ c ]
-            
+
         return "".join( prefix )
 
-def updateShortIds( tasks, extraPrefix="" ):
-   trie = Trie()
-   idToHash = {}
-
-   for task in tasks:
-      taskId = task.apiObject[ 'id' ]
-      idToHash[ taskId ] = sha256( taskId.encode( 'utf8' ) ).hexdigest()
-      trie.addString( idToHash[ taskId ] )
-
-   fixedLen = 0
-   for task in tasks:
-      taskId = task.apiObject[ 'id' ]
-      prefix = trie.generateUniquePrefix( idToHash[ taskId ] )
-      prefixLen = len( prefix )
-      if prefixLen > fixedLen:
-         fixedLen = prefixLen
-
-   for task in tasks:
-      taskId = task.apiObject[ 'id' ]
-      task.shortId = extraPrefix + idToHash[ taskId ][ : fixedLen ]
+    def uniquePrefixLength( self ):
+        # The deepest prefix shared by two strings, plus one to separate them
+        if not self.sharedAtDepth:
+            return 1
+        return max( self.sharedAtDepth ) + 1
+
+class ShortIds:
+   # Short ids are a common length prefix of the hash of each item's id.
+   # The hashes are kept, grouped (e.g. by project) so a group can be
+   # replaced when it is reloaded, and the length only ever grows, so ids
+   # stay the same from run to run unless a collision forces a longer one.
+   def __init__( self, extraPrefix="", state=None ):
+      self.extraPrefix = extraPrefix
+      self.trie = Trie()
+      self.hashes = {}
+      # How many groups hold each item; a task moved between projects can
+      # be in both until the one it left is reloaded
+      self.holders = {}
+      self.groups = {}
+      self.length = 0
+      self.changed = False
+      if state is not None:
+         self.length = state[ 'length' ]
+         for group, hashes in state[ 'groups' ].items():
+            self.groups[ group ] = set( hashes )
+            for itemId, idHash in hashes.items():
+               self.add( itemId, idHash )
+         self.changed = False
+
+   def state( self ):
+      groups = {}
+      for group, itemIds in self.groups.items():
+         groups[ group ] = dict( ( itemId, self.hashes[ itemId ] )
+                                 for itemId in itemIds )
+      return { 'length': self.length, 'groups': groups }
+
+   def add( self, itemId, idHash=None ):
+      self.holders[ itemId ] = self.holders.get( itemId, 0 ) + 1
+      if itemId in self.hashes:
+         return
+      if idHash is None:
+         idHash = sha256( itemId.encode( 'utf8' ) ).hexdigest()
+      self.hashes[ itemId ] = idHash
+      self.trie.addString( idHash )
+      self.changed = True
+
+   def remove( self, itemId ):
+      # Only forgotten once no group holds it
+      holders = self.holders.pop( itemId, 0 ) - 1
+      if holders > 0:
+         self.holders[ itemId ] = holders
+         return
+      idHash = self.hashes.pop( itemId, None )
+      if idHash is not None:
+         self.trie.removeString( idHash )
+         self.changed = True
+
+   def update( self, group, itemIds ):
+      itemIds = set( itemIds )
+      previous = self.groups.get( group, set() )
+      if previous == itemIds:
+         return
+      for itemId in previous - itemIds:
+         self.remove( itemId )
+      for itemId in itemIds - previous:
+         self.add( itemId )
+      self.groups[ group ] = itemIds
+      self.changed = True
+
+   def removeGroup( self, group ):
+      for itemId in self.groups.pop( group, () ):
+         self.remove( itemId )
+
+   def uniqueLength( self ):
+      length = self.trie.uniquePrefixLength()
+      if length > self.length:
+         self.length = length
+         self.changed = True
+      return self.length
+
+   def shortId( self, itemId ):
+      return self.extraPrefix + self.hashes[ itemId ][ : self.length ]
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import functools
 import re
 import sys
@@ -8,18 +8,40 @@ import sys
 import Matcher
 
 class Task():
+   # Sort keys are worked out once and kept on each task until anything
+   # that affects the order of any task changes
+   orderGeneration = 0
+
+   # There can be a great many tasks, kept for as long as "task serve"
+   # runs, so they have no __dict__
+   __slots__ = ( '_dueGeneration', '_earliestDue', '_keyGeneration',
+                 '_positionKey', '_alphabeticalKey', 'shortId', '_project',
+                 '_parentTask', '_childTasks', 'previousTask', 'moveRequired',
+                 '_title', '_notes', '_complete', '_dueDate', '_dueTime',
+                 '_tags' )
+
    def __init__( self, project ):
+      self._dueGeneration = None
+      self._keyGeneration = None
       self.shortId = None
       self._project = project
       self._project.addTask( self )
       self._parentTask = None
-      self.childTasks = set()
+      # Most tasks have no children, so they share the empty tuple
+      self._childTasks = ()
       self.previousTask = None
-      self.title = None
-      self.notes = None
-      self.complete = False
-      self.dueDate = None
-      self.dueTime = None
+      # Set when a planner has decided whether saving should move the task
+      self.moveRequired = None
+      self._title = None
+      self._notes = None
+      self._complete = False
+      self._dueDate = None
+      self._dueTime = None
+      self._tags = None
+
+   def changing( self, field ):
+      # Called before a field is changed, for subclasses that need to know
+      pass
 
    def get_project( self ):
       return self._project
@@ -37,13 +59,106 @@ class Task():
 
    def set_parentTask( self, parentTask ):
       if self._parentTask:
-         self._parentTask.childTasks.remove( self )
+         self._parentTask.removeChild( self )
       self._parentTask = parentTask
       if self._parentTask:
-         self._parentTask.childTasks.add( self )
+         self._parentTask.addChild( self )
+      Task.invalidateOrder()
 
    parentTask = property( get_parentTask, set_parentTask )
 
+   def get_childTasks( self ):
+      return self._childTasks
+
+   childTasks = property( get_childTasks )
+
+   def addChild( self, child ):
+      # A list is far smaller than a set, and there are seldom many
+      if not self._childTasks:
+         self._childTasks = []
+      self._childTasks.append( child )
+
+   def removeChild( self, child ):
+      self._childTasks.remove( child )
+      if not self._childTasks:
+         self._childTasks = ()
+
+   def get_title( self ):
+      return self._title
+
+   def set_title( self, title ):
+      if title != self._title:
+         self.changing( "title" )
+      self._title = title
+      self._tags = None
+      Task.invalidateOrder()
+
+   title = property( get_title, set_title )
+
+   def get_tags( self ):
+      # Worked out from the title when first wanted
+      if self._tags is None:
+         self._tags = tagsIn( self._title )
+      return self._tags
+
+   tags = property( get_tags )
+
+   def addTag( self, tag ):
+      if not tagName.fullmatch( tag ):
+         raise RuntimeError( "tags are letters, digits, _ and -, not: %s" % tag )
+      if tag.lower() not in self.tags:
+         self.title = self.title + " @" + tag if self.title else "@" + tag
+
+   def removeTag( self, tag ):
+      if tag.lower() in self.tags:
+         self.title = re.sub( r"\s*%s@%s(?![\w-])" % ( tagStart,
+                                                         re.escape( tag ) ),
+                              "", self.title, flags=re.IGNORECASE ).strip()
+
+   def get_notes( self ):
+      return self._notes
+
+   def set_notes( self, notes ):
+      if notes != self._notes:
+         self.changing( "notes" )
+      self._notes = notes
+
+   notes = property( get_notes, set_notes )
+
+   def get_complete( self ):
+      return self._complete
+
+   def set_complete( self, complete ):
+      if complete != self._complete:
+         self.changing( "complete" )
+      self._complete = complete
+
+   complete = property( get_complete, set_complete )
+
+   def get_dueDate( self ):
+      return self._dueDate
+
+   def set_dueDate( self, dueDate ):
+      if dueDate != self._dueDate:
+         self.changing( "due" )
+      self._dueDate = dueDate
+      Task.invalidateOrder()
+
+   dueDate = property( get_dueDate, set_dueDate )
+
+   def get_dueTime( self ):
+      return self._dueTime
+
+   def set_dueTime( self, dueTime ):
+      if dueTime != self._dueTime:
+         self.changing( "due" )
+      self._dueTime = dueTime
+
+   dueTime = property( get_dueTime, set_dueTime )
+
+   def invalidateOrder():
+      Task.orderGeneration += 1
+
    def save( self ):
       raise NotImplementedError( "must subclass Task.Task" )
 
@@ -96,40 +211,54 @@ class Task():
          print( self.notes, file=outfile )
          print( "", file=outfile )
 
-   def parse( project, line ):
-      match = re.match( r"\*(\*+) \((t[0-9a-f]*)\) +\[([ xX-])\] +(\[([0-9-]+)\] +)?(.*)", line )
+   linePattern = re.compile( r"\*(\*+) \((t[0-9a-f]*)\) +\[([ xX-])\] +(\[([0-9-]+)\] +)?(.*)" )
+
+   def parseLine( line ):
+      # Returns ( shortId, complete, dueDate, title, deleted, level ), or None
+      # if this isn't a task line
+      match = Task.linePattern.match( line )
       if match:
+         return ( match[ 2 ], match[ 3 ].upper() == 'X', match[ 5 ], match[ 6 ],
+                  match[ 3 ] == '-', len( match[ 1 ] ) - 1 )
+      return None
+
+   def parse( project, line ):
+      fields = Task.parseLine( line )
+      if fields:
          if not project:
             return True
          task = Task( project )
-         task.shortId = match[ 2 ]
-         task.complete = match[ 3 ].upper() == 'X'
-         task.dueDate = match[ 5 ]
-         task.title = match[ 6 ]
-         deleted = match[ 3 ] == '-'
-         level = len( match[ 1 ] ) - 1
+         task.shortId, task.complete, task.dueDate, task.title, deleted, level = fields
          return task, deleted, level
       return None
 
+   def earliestDue( self ):
+      # Each subtree is only scanned once per generation
+      if self._dueGeneration != Task.orderGeneration:
+         dueDate = self.dueDate if self.dueDate else "ZZZZ-ZZ-ZZ"
+         for child in self.childTasks:
+            childDue = child.earliestDue()
+            if childDue < dueDate:
+               dueDate = childDue
+         self._earliestDue = dueDate
+         self._dueGeneration = Task.orderGeneration
+      return self._earliestDue
+
    def sortKey( self, alphabetic ):
-      def partialKey( task, alphabetic ):
-         def earliestDue( task ):
-            dueDate = task.dueDate if task.dueDate else "ZZZZ-ZZ-ZZ"
-            for t in task.childTasks:
-               d = earliestDue( t )
-               if d < dueDate:
-                  dueDate = d
-            return dueDate
-
-         dateKey = earliestDue( task )
-         posKey = task.title.upper() if alphabetic else task.apiOrderKey()
-         return ( dateKey, posKey )
-
-      key = []
-      task = self
-      while task:
-         key.insert( 0, partialKey( task, alphabetic ) )
-         task = task.parentTask
+      if self._keyGeneration != Task.orderGeneration:
+         self._positionKey = None
+         self._alphabeticalKey = None
+         self._keyGeneration = Task.orderGeneration
+      key = self._alphabeticalKey if alphabetic else self._positionKey
+      if key is None:
+         posKey = self.title.upper() if alphabetic else self.apiOrderKey()
+         key = ( ( self.earliestDue(), posKey ), )
+         if self.parentTask:
+            key = self.parentTask.sortKey( alphabetic ) + key
+         if alphabetic:
+            self._alphabeticalKey = key
+         else:
+            self._positionKey = key
       return key
 
    def alphabeticalKey( self ):
@@ -138,6 +267,88 @@ class Task():
    def positionKey( self ):
       return self.sortKey( False )
 
+# A tag is an @ then letters, digits, _ and -, and case doesn't matter.  It
+# may follow punctuation, as in "(@na)" or "x,@na", but not what would make
+# it part of an email address or URL, as in "me@example.com".
+tagStart = r"(?<![\w@./])"
+tagName = re.compile( r"[\w-]+" )
+tagPattern = re.compile( tagStart + r"@([\w-]+)" )
+noTags = frozenset()
+
+def tagsIn( text ):
+   if not text or "@" not in text:
+      return noTags
+   return frozenset( tag.lower() for tag in tagPattern.findall( text ) ) or noTags
+
+def requiredText( pattern ):
+   # The longest text every match of a regular expression must contain,
+   # which may be empty, or None if that isn't easily told
+   if any( c in pattern for c in "|()" ):
+      return None
+   runs = [ "" ]
+   i = 0
+   while i < len( pattern ):
+      c = pattern[ i ]
+      if c == "\\":
+         escaped = pattern[ i + 1 : i + 2 ]
+         if escaped and not escaped.isalnum():
+            runs[ -1 ] += escaped
+         elif escaped and escaped in "dDsSwWbBAZafnrtv":
+            # A class, an assertion or a single character
+            runs.append( "" )
+         else:
+            # The rest take more characters, e.g. \x41, \u00e9, \0 or \1
+            return None
+         i += 2
+         continue
+      if c in "?*{":
+         # Whatever came just before may not be there at all
+         runs[ -1 ] = runs[ -1 ][ :-1 ]
+         runs.append( "" )
+         if c == "{":
+            i = pattern.find( "}", i )
+            if i < 0:
+               return None
+      elif c == "[":
+         i += 1
+         if pattern[ i : i + 1 ] == "^":
+            i += 1
+         if pattern[ i : i + 1 ] == "]":
+            i += 1
+         while i < len( pattern ) and pattern[ i ] != "]":
+            i += 2 if pattern[ i ] == "\\" else 1
+         runs.append( "" )
+      elif c in ".^$+":
+         runs.append( "" )
+      else:
+         runs[ -1 ] += c
+      i += 1
+   return max( runs, key=len )
+
+def indexedCandidates( projects, search ):
+   # search( projectClass, projects ) asks each kind of project's index
+   # which of them may have matching tasks, and gives None if it can't tell
+   projectsByClass = {}
+   for project in projects:
+      projectsByClass.setdefault( type( project ), [] ).append( project )
+   candidates = set()
+   for projectClass, classProjects in projectsByClass.items():
+      classCandidates = search( projectClass, classProjects )
+      if classCandidates is None:
+         classCandidates = set( classProjects )
+      candidates |= classCandidates
+   return candidates
+
+def textCandidates( projects, pattern, fields ):
+   # The projects that may have a task matching pattern in one of fields,
+   # or None for them all
+   text = requiredText( pattern )
+   if not text:
+      return None
+   return indexedCandidates( projects,
+         lambda projectClass, classProjects: projectClass.textCandidates(
+            classProjects, text, fields ) )
+
 class TaskMatcher( Matcher.Matcher ):
    def isTask( projectOrTask ):
       return isinstance( projectOrTask, Task )
@@ -167,62 +378,203 @@ class WordMatcher( TaskMatcher ):
             print( "Task.Word", "no match", file=sys.stderr )
       return result
 
+   def compile( self ):
+      word = self.word
+      search = re.compile( word, flags=re.IGNORECASE ).search
+
+      def match( projectOrTask ):
+         return ( isinstance( projectOrTask, Task ) and
+                  ( projectOrTask.shortId == word or
+                    search( projectOrTask.title ) is not None ) )
+
+      # Something that looks like a short id will rule out nearly everything
+      if re.match( r"t[0-9a-f]+$", word ):
+         return ( 1, match )
+      return ( 2, match )
+
+   def candidateProjects( self, projects ):
+      # A short id may match without being in the title
+      if re.match( r"t[0-9a-f]+$", self.word ):
+         return None
+      return textCandidates( projects, self.word, ( "title", ) )
+
+class TagMatcher( TaskMatcher ):
+   def __init__( self, tag ):
+      super().__init__()
+      self.tag = tag.lower()
+
+   def match( self, projectOrTask ):
+      if self.debug:
+         print( "Task.Tag", "match?", self.tag, file=sys.stderr )
+      result = TaskMatcher.isTask( projectOrTask ) and self.tag in projectOrTask.tags
+      if self.debug:
+         if result:
+            print( "Task.Tag", "match", file=sys.stderr )
+         else:
+            print( "Task.Tag", "no match", file=sys.stderr )
+      return result
+
+   def compile( self ):
+      tag = self.tag
+
+      def match( projectOrTask ):
+         return isinstance( projectOrTask, Task ) and tag in projectOrTask.tags
+
+      return ( 1, match )
+
+   def candidateProjects( self, projects ):
+      tag = self.tag
+      return indexedCandidates( projects,
+            lambda projectClass, classProjects: projectClass.tagCandidates(
+               classProjects, tag ) )
+
+class NotesMatcher( TaskMatcher ):
+   def __init__( self, word ):
+      super().__init__()
+      self.word = word
+
+   def match( self, projectOrTask ):
+      if self.debug:
+         print( "Task.Notes", "match?", self.word, file=sys.stderr )
+      result = ( TaskMatcher.isTask( projectOrTask ) and
+                 projectOrTask.notes is not None and
+                 re.search( self.word, projectOrTask.notes,
+                            flags=re.IGNORECASE ) is not None )
+      if self.debug:
+         if result:
+            print( "Task.Notes", "match", file=sys.stderr )
+         else:
+            print( "Task.Notes", "no match", file=sys.stderr )
+      return result
+
+   def compile( self ):
+      search = re.compile( self.word, flags=re.IGNORECASE ).search
+
+      def match( projectOrTask ):
+         return ( isinstance( projectOrTask, Task ) and
+                  projectOrTask.notes is not None and
+                  search( projectOrTask.notes ) is not None )
+
+      # Notes are longer than titles, and most tasks have none
+      return ( 2, match )
+
+   def candidateProjects( self, projects ):
+      return textCandidates( projects, self.word, ( "notes", ) )
+
 class DueMatcher( TaskMatcher ):
+   # Matches tasks due from first to last, inclusive, where either may be
+   # None for no limit.  The forms are:
+   #   DATE, =DATE      on DATE
+   #   +DATE, -DATE     after, before DATE
+   #   +=DATE, -=DATE   on or after, on or before DATE
+   #   A..B             from A to B, either of which may be left out
+   #   +1w, -7d         from today to a week ahead, from a week ago to today
+   #   overdue          before today
+   # where a DATE is yyyy-mm-dd, today (or now), or days or weeks from
+   # today, e.g. +3d or -1w.
+   offsetPattern = re.compile( r"([+-])([0-9]+)([dw])$" )
+   formatError = ( "due format must be due:[+-=]DATE, due:DATE..DATE, "
+                   "due:[+-]N[dw] or due:overdue, where DATE is yyyy-mm-dd, "
+                   "today or [+-]N[dw]" )
+
    def __init__( self, due ):
       super().__init__()
-      if due[ 0 : 2 ] == "+=" or due[ 0 : 2 ] == "=+":
-         self.dueRelative = "onOrAfter"
-         dueDate = due[ 2: ]
-      elif due[ 0 : 2 ] == "-=" or due[ 0 : 2 ] == "=-":
-         self.dueRelative = "onOrBefore"
-         dueDate = due[ 2: ]
-      elif due[ 0 ] == "+":
-         self.dueRelative = "after"
-         dueDate = due[ 1: ]
-      elif due[ 0 ] == "-":
-         self.dueRelative = "before"
-         dueDate = due[ 1: ]
-      elif due[ 0 ] == "=":
-         self.dueRelative = "on"
-         dueDate = due[ 1: ]
+      today = datetime.now().date()
+      if due == "overdue":
+         self.first = None
+         self.last = DueMatcher.date( "-1d", today )
+      elif ".." in due:
+         first, last = due.split( "..", 1 )
+         self.first = DueMatcher.date( first, today ) if first else None
+         self.last = DueMatcher.date( last, today ) if last else None
+      elif DueMatcher.offsetPattern.match( due ):
+         self.first, self.last = sorted( ( today.isoformat(),
+                                           DueMatcher.date( due, today ) ) )
       else:
-         self.dueRelative = "on"
-         dueDate = due
+         if due[ 0 : 2 ] == "+=" or due[ 0 : 2 ] == "=+":
+            relation = "onOrAfter"
+            dueDate = due[ 2: ]
+         elif due[ 0 : 2 ] == "-=" or due[ 0 : 2 ] == "=-":
+            relation = "onOrBefore"
+            dueDate = due[ 2: ]
+         elif due[ 0 ] == "+":
+            relation = "after"
+            dueDate = due[ 1: ]
+         elif due[ 0 ] == "-":
+            relation = "before"
+            dueDate = due[ 1: ]
+         elif due[ 0 ] == "=":
+            relation = "on"
+            dueDate = due[ 1: ]
+         else:
+            relation = "on"
+            dueDate = due
+         dueDate = DueMatcher.date( dueDate, today )
+         self.first = None
+         self.last = None
+         if relation in ( "on", "onOrAfter" ):
+            self.first = dueDate
+         if relation in ( "on", "onOrBefore" ):
+            self.last = dueDate
+         if relation == "after":
+            self.first = DueMatcher.date( "+1d", DueMatcher.day( dueDate ) )
+         if relation == "before":
+            self.last = DueMatcher.date( "-1d", DueMatcher.day( dueDate ) )
 
-      if dueDate == "today" or dueDate == "now":
-         now = datetime.now()
-         dueDate = now.strftime( "%Y-%m-%d" )
-      elif not re.match( r"[0-9]{4}-[0-9]{2}-[0-9]{2}$", dueDate ):
-         raise RuntimeError( "due format must be due:[+-=]yyyy-mm-dd" )
+   def day( text ):
+      try:
+         return datetime.strptime( text, "%Y-%m-%d" ).date()
+      except ValueError:
+         raise RuntimeError( DueMatcher.formatError )
 
-      self.due = dueDate
+   def date( text, today ):
+      # The yyyy-mm-dd date that text stands for
+      if text == "today" or text == "now":
+         return today.isoformat()
+      offset = DueMatcher.offsetPattern.match( text )
+      if offset:
+         days = int( offset[ 2 ] ) * ( 7 if offset[ 3 ] == "w" else 1 )
+         if offset[ 1 ] == "-":
+            days = -days
+         return ( today + timedelta( days=days ) ).isoformat()
+      if not re.match( r"[0-9]{4}-[0-9]{2}-[0-9]{2}$", text ):
+         raise RuntimeError( DueMatcher.formatError )
+      return text
 
    def match( self, projectOrTask ):
       if self.debug:
-         print( "Due", "match?", self.dueRelative, self.due, file=sys.stderr )
-      if TaskMatcher.isTask( projectOrTask ):
-         task = projectOrTask
-      else:
-         if self.debug:
-            print( "Due", "no match", file=sys.stderr )
-         return False
-      if not task.dueDate:
-         if self.debug:
-            print( "Due", "no match", file=sys.stderr )
-         return False
-      if self.dueRelative == "before":
-         result = task.dueDate < self.due
-      elif self.dueRelative == "onOrBefore":
-         result = task.dueDate <= self.due
-      elif self.dueRelative == "after":
-         result = task.dueDate > self.due
-      elif self.dueRelative == "onOrAfter":
-         result = task.dueDate >= self.due
-      else:
-         result = task.dueDate == self.due
+         print( "Due", "match?", self.first, "..", self.last, file=sys.stderr )
+      result = ( TaskMatcher.isTask( projectOrTask ) and
+                 bool( projectOrTask.dueDate ) and
+                 ( self.first is None or projectOrTask.dueDate >= self.first ) and
+                 ( self.last is None or projectOrTask.dueDate <= self.last ) )
       if self.debug:
          if result:
             print( "Due", "match", file=sys.stderr )
          else:
-            print( "Due", "no match" )
+            print( "Due", "no match", file=sys.stderr )
       return result
+
+   def compile( self ):
+      first = self.first
+      last = self.last
+
+      def match( projectOrTask ):
+         if not isinstance( projectOrTask, Task ):
+            return False
+         dueDate = projectOrTask.dueDate
+         return ( bool( dueDate ) and
+                  ( first is None or dueDate >= first ) and
+                  ( last is None or dueDate <= last ) )
+
+      return ( 1, match )
+
+   def candidateProjects( self, projects ):
+      first = self.first
+      last = self.last
+      return indexedCandidates( projects,
+            lambda projectClass, classProjects: projectClass.dueCandidates(
+               classProjects, first, last ) )
+
+   def candidateTasks( self, project ):
+      return set( project.tasksDue( self.first, self.last ) )
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+import glob
+import json
+import os.path
+import sqlite3
+import threading
+
+import Task
+
+# The cache holds, per task list, the raw API task objects, the tasklist's
+# 'updated' stamp they correspond to and when they were last synced.
+
+def applyChanges( tasks, changes ):
+   # changes maps task id to its new API object, or None if deleted
+   taskById = {}
+   for task in tasks:
+      taskById[ task[ 'id' ] ] = task
+   deleted = set()
+   for taskId, apiObject in changes.items():
+      if apiObject is None:
+         taskById.pop( taskId, None )
+         deleted.add( taskId )
+      else:
+         taskById[ taskId ] = apiObject
+   # Subtasks go with their parent
+   while deleted:
+      deleted = set( task[ 'id' ] for task in taskById.values()
+                     if task.get( 'parent' ) in deleted )
+      for taskId in deleted:
+         del taskById[ taskId ]
+   return list( taskById.values() )
+
+def consistentTasks( tasks ):
+   # Siblings that were renumbered without being marked as updated, or
+   # parents we never heard about, mean we have missed something
+   taskIds = set()
+   for task in tasks:
+      taskIds.add( task[ 'id' ] )
+   positions = set()
+   for task in tasks:
+      parentId = task.get( 'parent' )
+      if parentId is not None and parentId not in taskIds:
+         return False
+      position = ( parentId, task.get( 'position' ) )
+      if position in positions:
+         return False
+      positions.add( position )
+   return True
+
+class TaskCache:
+   def load( self, projectId ):
+      raise NotImplementedError( "must subclass TaskCache.TaskCache" )
+
+   def store( self, project, synced, tasks ):
+      raise NotImplementedError( "must subclass TaskCache.TaskCache" )
+
+   def storeProject( self, project ):
+      raise NotImplementedError( "must subclass TaskCache.TaskCache" )
+
+   def update( self, projectId, changes ):
+      raise NotImplementedError( "must subclass TaskCache.TaskCache" )
+
+   def consistent( self, projectId ):
+      raise NotImplementedError( "must subclass TaskCache.TaskCache" )
+
+   def setUpdated( self, projectId, updated ):
+      raise NotImplementedError( "must subclass TaskCache.TaskCache" )
+
+   def remove( self, projectId ):
+      raise NotImplementedError( "must subclass TaskCache.TaskCache" )
+
+   def searchText( self, text, fields, tasklists ):
+      # tasklists maps task list ids to the 'updated' stamp they should be
+      # cached at.  Returns those that may have a task with text (in any
+      # case) in one of fields, or None if the cache keeps no index.
+      return None
+
+   def searchTags( self, tag, tasklists ):
+      # The same, for a task with the tag
+      return None
+
+   def searchDue( self, first, last, tasklists ):
+      # The same, for a task due from first to last (yyyy-mm-dd, inclusive,
+      # either may be None)
+      return None
+
+   def loadState( self, key ):
+      raise NotImplementedError( "must subclass TaskCache.TaskCache" )
+
+   def storeState( self, key, value ):
+      raise NotImplementedError( "must subclass TaskCache.TaskCache" )
+
+class JsonCache( TaskCache ):
+   # A file per task list, holding just its tasklist API object, when it was
+   # synced and its raw tasks, written whole and swapped into place.  Files
+   # in any other format version are ignored, and so get rewritten.
+   formatVersion = 1
+
+   def __init__( self, cacheDir ):
+      self.cacheDir = cacheDir
+      # Left behind when the cache was pickled, and never read now
+      for oldFile in glob.glob( cacheDir + '/*.pickle' ):
+         try:
+            os.remove( oldFile )
+         except FileNotFoundError:
+            pass
+
+   def _cacheFile( self, projectId ):
+      return self.cacheDir + ( '/tasklist-%s.json' % projectId )
+
+   def _stateFile( self, key ):
+      return self.cacheDir + ( '/state-%s.json' % key )
+
+   def _read( self, cacheFile ):
+      try:
+         with open( cacheFile ) as cache:
+            contents = json.load( cache )
+      except FileNotFoundError:
+         return None
+      except ValueError:
+         # Cut short while being written by an older version
+         return None
+      if not isinstance( contents, dict ) or \
+            contents.get( 'version' ) != self.formatVersion:
+         return None
+      return contents
+
+   def _write( self, cacheFile, contents ):
+      # May be written from a background thread cut short at exit, so never
+      # leave a half written file behind
+      contents[ 'version' ] = self.formatVersion
+      with open( cacheFile + '.new', 'w' ) as cache:
+         json.dump( contents, cache, separators=( ',', ':' ) )
+      os.replace( cacheFile + '.new', cacheFile )
+
+   def load( self, projectId ):
+      contents = self._read( self._cacheFile( projectId ) )
+      if contents is None:
+         return None
+      return { 'updated': contents[ 'tasklist' ][ 'updated' ],
+               'synced': contents[ 'synced' ],
+               'tasks': contents[ 'tasks' ] }
+
+   def store( self, project, synced, tasks ):
+      self._write( self._cacheFile( project.apiId ),
+                   { 'tasklist': project.apiObject, 'synced': synced,
+                     'tasks': tasks } )
+
+   def storeProject( self, project ):
+      cacheFile = self._cacheFile( project.apiId )
+      contents = self._read( cacheFile )
+      if contents is not None:
+         contents[ 'tasklist' ] = project.apiObject
+         self._write( cacheFile, contents )
+
+   def update( self, projectId, changes ):
+      cacheFile = self._cacheFile( projectId )
+      contents = self._read( cacheFile )
+      if contents is None:
+         return
+      contents[ 'tasks' ] = applyChanges( contents[ 'tasks' ], changes )
+      self._write( cacheFile, contents )
+
+   def consistent( self, projectId ):
+      cache = self.load( projectId )
+      return cache is not None and consistentTasks( cache[ 'tasks' ] )
+
+   def setUpdated( self, projectId, updated ):
+      cacheFile = self._cacheFile( projectId )
+      contents = self._read( cacheFile )
+      if contents is not None:
+         contents[ 'tasklist' ][ 'updated' ] = updated
+         self._write( cacheFile, contents )
+
+   def remove( self, projectId ):
+      cacheFile = self._cacheFile( projectId )
+      if os.path.exists( cacheFile ):
+         os.remove( cacheFile )
+
+   def loadState( self, key ):
+      contents = self._read( self._stateFile( key ) )
+      if contents is None:
+         return None
+      return contents[ 'value' ]
+
+   def storeState( self, key, value ):
+      self._write( self._stateFile( key ), { 'value': value } )
+
+class SqliteCache( TaskCache ):
+   cacheFileName = '/tasks.sqlite'
+
+   # Kept in the database's user_version; a database made with any other
+   # schema is emptied and made afresh, as it only holds what can be fetched
+   # again
+   schemaVersion = 5
+   tables = ( "tasklists", "tasks", "state", "taskText", "taskTags" )
+
+   schema = [
+      """CREATE TABLE IF NOT EXISTS tasklists (
+            id TEXT PRIMARY KEY,
+            updated TEXT NOT NULL,
+            synced REAL,
+            apiObject TEXT NOT NULL )""",
+      """CREATE TABLE IF NOT EXISTS tasks (
+            id TEXT PRIMARY KEY,
+            tasklist TEXT NOT NULL,
+            parent TEXT,
+            position TEXT,
+            status TEXT,
+            due TEXT,
+            title TEXT,
+            notes TEXT,
+            apiObject TEXT NOT NULL )""",
+      """CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL )""",
+      """CREATE TABLE IF NOT EXISTS taskTags (
+            tag TEXT NOT NULL,
+            task TEXT NOT NULL,
+            PRIMARY KEY ( tag, task ) ) WITHOUT ROWID""",
+      """CREATE TRIGGER IF NOT EXISTS taskTagsDelete AFTER DELETE ON tasks BEGIN
+            DELETE FROM taskTags WHERE task = old.id;
+         END""",
+      "CREATE INDEX IF NOT EXISTS tasksByTasklist ON tasks ( tasklist, parent, position )",
+      "CREATE INDEX IF NOT EXISTS tasksByParent ON tasks ( parent )",
+      "CREATE INDEX IF NOT EXISTS tasksByStatus ON tasks ( status )",
+      "CREATE INDEX IF NOT EXISTS tasksByDue ON tasks ( due )",
+      "CREATE INDEX IF NOT EXISTS taskTagsByTask ON taskTags ( task )",
+   ]
+
+   # A trigram index over titles and notes, kept up to date by triggers, for
+   # narrowing down which task lists a search needs to load.  Not every
+   # SQLite has FTS5, so this is optional.
+   textSchema = [
+      """CREATE VIRTUAL TABLE IF NOT EXISTS taskText USING fts5 (
+            title, notes, content='tasks', tokenize='trigram' )""",
+      """CREATE TRIGGER IF NOT EXISTS taskTextInsert AFTER INSERT ON tasks BEGIN
+            INSERT INTO taskText ( rowid, title, notes )
+               VALUES ( new.rowid, new.title, new.notes );
+         END""",
+      """CREATE TRIGGER IF NOT EXISTS taskTextDelete AFTER DELETE ON tasks BEGIN
+            INSERT INTO taskText ( taskText, rowid, title, notes )
+               VALUES ( 'delete', old.rowid, old.title, old.notes );
+         END""",
+      """CREATE TRIGGER IF NOT EXISTS taskTextUpdate AFTER UPDATE OF title, notes ON tasks BEGIN
+            INSERT INTO taskText ( taskText, rowid, title, notes )
+               VALUES ( 'delete', old.rowid, old.title, old.notes );
+            INSERT INTO taskText ( rowid, title, notes )
+               VALUES ( new.rowid, new.title, new.notes );
+         END""",
+   ]
+   minSearchText = 3
+
+   def __init__( self, cacheDir ):
+      # Other task commands may be using the cache at the same time, so
+      # everything happens in transactions, and we wait for their locks
+      self.lock = threading.Lock()
+      self.connection = sqlite3.connect( cacheDir + self.cacheFileName,
+                                         timeout=30, check_same_thread=False )
+      self.connection.execute( "PRAGMA journal_mode=WAL" )
+      with self.connection:
+         self.connection.execute( "BEGIN IMMEDIATE" )
+         version, = self.connection.execute( "PRAGMA user_version" ).fetchone()
+         if version != self.schemaVersion:
+            for table in self.tables:
+               self.connection.execute( "DROP TABLE IF EXISTS %s" % table )
+            self.connection.execute( "PRAGMA user_version=%d" % self.schemaVersion )
+         for statement in self.schema:
+            self.connection.execute( statement )
+      self.textIndexed = True
+      try:
+         with self.connection:
+            for statement in self.textSchema:
+               self.connection.execute( statement )
+      except sqlite3.OperationalError:
+         self.textIndexed = False
+
+   def _taskRow( self, projectId, task ):
+      return ( task[ 'id' ], projectId, task.get( 'parent' ), task.get( 'position' ),
+               task.get( 'status' ), task.get( 'due' ), task.get( 'title' ),
+               task.get( 'notes' ), json.dumps( task ) )
+
+   def _putTasks( self, projectId, tasks ):
+      self.connection.executemany(
+            """INSERT INTO tasks ( id, tasklist, parent, position, status, due,
+                                   title, notes, apiObject )
+               VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ? )
+               ON CONFLICT ( id ) DO UPDATE SET
+                  tasklist=excluded.tasklist, parent=excluded.parent,
+                  position=excluded.position, status=excluded.status,
+                  due=excluded.due, title=excluded.title, notes=excluded.notes,
+                  apiObject=excluded.apiObject""",
+            [ self._taskRow( projectId, task ) for task in tasks ] )
+      self.connection.executemany( "DELETE FROM taskTags WHERE task=?",
+                                   [ ( task[ 'id' ], ) for task in tasks ] )
+      self.connection.executemany( "INSERT INTO taskTags ( tag, task ) VALUES ( ?, ? )",
+            [ ( tag, task[ 'id' ] ) for task in tasks
+              for tag in Task.tagsIn( task.get( 'title' ) ) ] )
+
+   def load( self, projectId ):
+      with self.lock:
+         row = self.connection.execute(
+               "SELECT updated, synced FROM tasklists WHERE id=?",
+               ( projectId, ) ).fetchone()
+         if row is None:
+            return None
+         rows = self.connection.execute(
+               "SELECT apiObject FROM tasks WHERE tasklist=?",
+               ( projectId, ) ).fetchall()
+      return { 'updated': row[ 0 ], 'synced': row[ 1 ],
+               'tasks': [ json.loads( apiObject ) for apiObject, in rows ] }
+
+   def store( self, project, synced, tasks ):
+      with self.lock, self.connection:
+         self.connection.execute(
+               """INSERT OR REPLACE INTO tasklists ( id, updated, synced, apiObject )
+                  VALUES ( ?, ?, ?, ? )""",
+               ( project.apiId, project.apiObject[ 'updated' ], synced,
+                 json.dumps( project.apiObject ) ) )
+         self.connection.execute( "DELETE FROM tasks WHERE tasklist=?",
+                                  ( project.apiId, ) )
+         self._putTasks( project.apiId, tasks )
+
+   def storeProject( self, project ):
+      with self.lock, self.connection:
+         self.connection.execute(
+               "UPDATE tasklists SET updated=?, apiObject=? WHERE id=?",
+               ( project.apiObject[ 'updated' ], json.dumps( project.apiObject ),
+                 project.apiId ) )
+
+   def update( self, projectId, changes ):
+      with self.lock, self.connection:
+         for taskId, apiObject in changes.items():
+            if apiObject is not None:
+               self._putTasks( projectId, [ apiObject ] )
+               continue
+            # Subtasks go with their parent
+            self.connection.execute(
+                  """WITH RECURSIVE doomed ( id ) AS (
+                        SELECT ?
+                        UNION SELECT tasks.id FROM tasks JOIN doomed
+                           ON tasks.parent = doomed.id )
+                     DELETE FROM tasks WHERE id IN doomed""",
+                  ( taskId, ) )
+
+   def consistent( self, projectId ):
+      with self.lock:
+         orphan = self.connection.execute(
+               """SELECT 1 FROM tasks child
+                  WHERE child.tasklist=? AND child.parent IS NOT NULL AND
+                     NOT EXISTS ( SELECT 1 FROM tasks parent
+                                  WHERE parent.id = child.parent )
+                  LIMIT 1""",
+               ( projectId, ) ).fetchone()
+         clash = self.connection.execute(
+               """SELECT 1 FROM tasks WHERE tasklist=?
+                  GROUP BY parent, position HAVING COUNT(*) > 1
+                  LIMIT 1""",
+               ( projectId, ) ).fetchone()
+      return orphan is None and clash is None
+
+   def setUpdated( self, projectId, updated ):
+      with self.lock, self.connection:
+         self.connection.execute( "UPDATE tasklists SET updated=? WHERE id=?",
+                                  ( updated, projectId ) )
+
+   def remove( self, projectId ):
+      with self.lock, self.connection:
+         self.connection.execute( "DELETE FROM tasks WHERE tasklist=?",
+                                  ( projectId, ) )
+         self.connection.execute( "DELETE FROM tasklists WHERE id=?",
+                                  ( projectId, ) )
+
+   def searchText( self, text, fields, tasklists ):
+      if not self.textIndexed or len( text ) < self.minSearchText:
+         return None
+      query = "{%s} : \"%s\"" % ( " ".join( fields ), text.replace( '"', '""' ) )
+      return self._search( """SELECT DISTINCT tasks.tasklist FROM taskText
+                                 JOIN tasks ON tasks.rowid = taskText.rowid
+                                 WHERE taskText MATCH ?""",
+                           ( query, ), tasklists )
+
+   def searchTags( self, tag, tasklists ):
+      return self._search( """SELECT DISTINCT tasks.tasklist FROM taskTags
+                              JOIN tasks ON tasks.id = taskTags.task
+                              WHERE taskTags.tag=?""",
+                           ( tag, ), tasklists )
+
+   def searchDue( self, first, last, tasklists ):
+      # Due stamps are the date then "T" and the time, so those on the last
+      # day all sort before last + "U", and the index on due still serves
+      return self._search( """SELECT DISTINCT tasklist FROM tasks
+                              WHERE due IS NOT NULL AND due >= ? AND due < ?""",
+                           ( first or "", ( last + "U" ) if last else "U" ),
+                           tasklists )
+
+   def _search( self, query, parameters, tasklists ):
+      with self.lock:
+         found = set( tasklist for tasklist, in self.connection.execute(
+               query, parameters ) )
+         cachedUpdated = dict( self.connection.execute(
+               "SELECT id, updated FROM tasklists" ) )
+      # Lists not cached as they are now could have anything in them
+      return set( tasklist for tasklist, updated in tasklists.items()
+                  if tasklist in found or
+                     cachedUpdated.get( tasklist, "" ) < updated )
+
+   def loadState( self, key ):
+      with self.lock:
+         row = self.connection.execute( "SELECT value FROM state WHERE key=?",
+                                        ( key, ) ).fetchone()
+      if row is None:
+         return None
+      return json.loads( row[ 0 ] )
+
+   def storeState( self, key, value ):
+      with self.lock, self.connection:
+         self.connection.execute(
+               "INSERT OR REPLACE INTO state ( key, value ) VALUES ( ?, ? )",
+               ( key, json.dumps( value ) ) )
+
+engines = {
+   "sqlite": SqliteCache,
+   "json": JsonCache,
+   # What the json cache used to be, before it stopped pickling
+   "pickle": JsonCache,
+}
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import FakeTasks
+from GoogleTasks import GoogleTasks
+
+# Measures how much memory loaded tasks take, as "task serve" keeps them,
+# by linking made up tasks shaped like the API's into projects.  The raw
+# API objects are let go of once linked, as they are when really loading,
+# so only what the task objects themselves keep is counted.
+
+usage = """
+Usage: memory.py [-p PROJECTS] [TASKS...]
+
+  -p PROJECTS  Spread the tasks over this many projects (default 20)
+
+By default 10000 and 100000 tasks are loaded.
+"""
+
+def rawTasks( listId, count ):
+   # A third are subtasks, a third have notes and a tenth are due; every
+   # string is distinct, as it would be coming from JSON
+   tasks = []
+   for n in range( count ):
+      taskId = "%s-t%06dxxxxxxxxxx" % ( listId[ :6 ], n )
+      task = {
+         'kind': 'tasks#task',
+         'id': taskId,
+         'etag': '"%s"' % taskId,
+         'title': "Task number %d in the list" % n,
+         'updated': "2024-01-01T00:00:00.000Z",
+         'selfLink': "https://www.googleapis.com/tasks/v1/lists/%s/tasks/%s" % (
+               listId, taskId ),
+         'position': "%020d" % ( n * 1024 ),
+         'status': "completed" if n % 4 == 0 else "needsAction",
+         'links': [],
+         'webViewLink': "https://tasks.google.com/task/%s?sa=6" % taskId,
+      }
+      if n % 3 == 1:
+         task[ 'parent' ] = tasks[ n - 1 ][ 'id' ]
+      if n % 3 == 2:
+         task[ 'notes' ] = "Some notes about task %d" % n
+      if n % 10 == 0:
+         task[ 'due' ] = "2024-02-01T00:00:00.000Z"
+      if n % 4 == 0:
+         task[ 'completed' ] = "2024-01-02T00:00:00.000Z"
+      tasks.append( task )
+   return json.loads( json.dumps( tasks ) )
+
+def measure( taskApi, projectCount, taskCount ):
+   projects = [ taskApi.Project( taskApi, { 'id': "list%04dxxxxxxxxxxxxxxx" % n,
+                                            'title': "List %d" % n,
+                                            'updated': "2024-01-01T00:00:00.000Z" } )
+                for n in range( projectCount ) ]
+   perProject = taskCount // projectCount
+   raw = [ rawTasks( project.apiId, perProject ) for project in projects ]
+   gc.collect()
+   tracemalloc.start()
+   before = tracemalloc.get_traced_memory()[ 0 ]
+   start = time.perf_counter()
+   for project, tasks in zip( projects, raw ):
+      project.linkTasks( tasks )
+      taskApi.assignTaskIds( [ project ] )
+   elapsed = time.perf_counter() - start
+   raw = None
+   gc.collect()
+   after = tracemalloc.get_traced_memory()[ 0 ]
+   tracemalloc.stop()
+   loaded = perProject * projectCount
+   print( "%8d %10.1f %10.0f %10.2f" % (
+         loaded, ( after - before ) / 1e6, ( after - before ) / loaded, elapsed ) )
+   return projects
+
+def main( argv ):
+   projectCount = 20
+   counts = []
+   while argv:
+      arg = argv.pop( 0 )
+      if arg == '-p':
+         projectCount = int( argv.pop( 0 ) )
+      elif arg.isdigit():
+         counts.append( int( arg ) )
+      else:
+         print( usage )
+         return 1
+   if not counts:
+      counts = [ 10000, 100000 ]
+
+   print( "%8s %10s %10s %10s" % ( "tasks", "MB", "bytes/task", "link secs" ) )
+   for count in counts:
+      with tempfile.TemporaryDirectory( prefix="task-memory-" ) as cacheDir:
+         taskApi = GoogleTasks( cacheDir, cacheDir, service=FakeTasks.Service() )
+         taskApi.projects = []
+         measure( taskApi, projectCount, count )
+         taskApi.close()
+   return 0
+
+if __name__ == '__main__':
+   sys.exit( main( sys.argv[ 1: ] ) )
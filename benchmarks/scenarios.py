@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+import importlib.machinery
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import FakeTasks
+
+# Runs task commands against a FakeTasks.Service, in a throwaway home
+# directory, and reports the API calls each one makes.  Each command gets
+# a fresh API client sharing one cache, as if task were run afresh, so the
+# counts show what the cache, delta sync, batching and retries save.
+
+usage = """
+Usage: scenarios.py [-v] [-b BACKEND] [-l LISTS] [-t TASKS] [-L LATENCY] [SCENARIO...]
+
+  -v          Show the commands' output
+  -b BACKEND  sync (the default) or async
+  -l LISTS    Task lists to start with (default 10)
+  -t TASKS    Tasks in each list (default 30)
+  -L LATENCY  Seconds each request takes (default 0.02)
+"""
+
+repoDir = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+def loadTaskScript():
+   loader = importlib.machinery.SourceFileLoader( "taskScript",
+                                                  os.path.join( repoDir, "task" ) )
+   spec = importlib.util.spec_from_loader( loader.name, loader )
+   module = importlib.util.module_from_spec( spec )
+   loader.exec_module( module )
+   return module
+
+# Rewrites the bulk edit file given, in place, as an editor would
+editorScript = """#!%s
+import sys
+path = sys.argv[ 1 ]
+with open( path ) as taskFile:
+   lines = taskFile.read().split( "\\n" )
+%s
+with open( path, "w" ) as taskFile:
+   taskFile.write( "\\n".join( lines ) )
+"""
+
+class FakeServer:
+   # Stands in for the daemon, handing each command a fresh client
+   def __init__( self, service, backend ):
+      self.service = service
+      self.backend = backend
+      self.taskApi = None
+
+   def taskApiFor( self, settings, allowOffline, indexMaxAge, interactive=False ):
+      configDir = os.environ[ 'HOME' ] + '/.config/tasks'
+      cacheDir = os.environ[ 'HOME' ] + '/.cache/tasks'
+      self.taskApi = self.backend( configDir, cacheDir,
+                                   jobs=settings[ "jobs" ],
+                                   deltaSync=settings[ "deltaSync" ],
+                                   cacheEngine=settings[ "cacheEngine" ],
+                                   indexMaxAge=indexMaxAge,
+                                   offline=settings[ "offline" ],
+                                   allowOffline=allowOffline,
+                                   service=self.service,
+                                   account=settings[ "account" ] )
+      return self.taskApi
+
+   def finish( self ):
+      if self.taskApi is not None:
+         self.taskApi.close()
+         self.taskApi = None
+
+class Runner:
+   def __init__( self, taskScript, backend, lists, tasks, latency, verbose ):
+      self.taskScript = taskScript
+      self.backend = backend
+      self.lists = lists
+      self.tasks = tasks
+      self.latency = latency
+      self.verbose = verbose
+
+   def start( self, **serviceOptions ):
+      # A new home, cache and server, with lists named List0... holding
+      # tasks named L0T0... and a subtask under each L?T1
+      self.home = tempfile.TemporaryDirectory( prefix="task-scenario-" )
+      os.environ[ 'HOME' ] = self.home.name
+      os.makedirs( self.home.name + '/.config/tasks' )
+      with open( self.home.name + '/.config/tasks/tasklist-index-max-age', 'w' ) as config:
+         # Always revalidated, so every command makes the same requests
+         print( "0", file=config )
+      self.service = FakeTasks.Service()
+      for listNo in range( self.lists ):
+         tasklist = self.service.tasklists().insert(
+               body={ 'title': "List%d" % listNo } ).execute()
+         previous = None
+         for taskNo in range( self.tasks ):
+            task = self.service.tasks().insert(
+                  tasklist=tasklist[ 'id' ], previous=previous,
+                  body={ 'title': "L%dT%d" % ( listNo, taskNo ) } ).execute()
+            previous = task[ 'id' ]
+            if taskNo == 1:
+               self.service.tasks().insert(
+                     tasklist=tasklist[ 'id' ], parent=task[ 'id' ],
+                     body={ 'title': "L%dT%dS" % ( listNo, taskNo ) } ).execute()
+      # Only now are requests slowed down, or made to fail
+      self.service.latency = self.latency
+      for option, value in serviceOptions.items():
+         setattr( self.service, option, value )
+      self.server = FakeServer( self.service, self.backend )
+
+   def editor( self, transform ):
+      path = self.home.name + '/editor'
+      with open( path, 'w' ) as script:
+         script.write( editorScript % ( sys.executable, transform ) )
+      os.chmod( path, 0o755 )
+      os.environ[ 'EDITOR' ] = path
+
+   def run( self, description, *argv ):
+      self.service.resetCounts()
+      start = time.perf_counter()
+      sys.stdout.flush()
+      saved = os.dup( 1 )
+      if not self.verbose:
+         devNull = os.open( os.devnull, os.O_WRONLY )
+         os.dup2( devNull, 1 )
+         os.close( devNull )
+      try:
+         self.taskScript.main( list( argv ), self.server )
+      finally:
+         self.server.finish()
+         sys.stdout.flush()
+         os.dup2( saved, 1 )
+         os.close( saved )
+      elapsed = time.perf_counter() - start
+      self.report( description, elapsed )
+
+   def report( self, description, elapsed ):
+      service = self.service
+      calls = sum( service.calls.values() )
+      failed = sum( service.failed.values() )
+      print( "%-40s %6.2fs %5d %5d %5d  %s" % (
+            description, elapsed, sum( service.httpRequests.values() ),
+            calls, failed,
+            ", ".join( "%s %d" % ( method, count )
+                       for method, count in sorted( service.calls.items() ) ) ) )
+
+   def changeElsewhere( self ):
+      # Renames the first task of the first list behind our back
+      tasklist = list( self.service.lists )[ 0 ]
+      task = list( self.service.tasksByList[ tasklist ] )[ 0 ]
+      self.service.tasks().update( tasklist=tasklist, task=task,
+                                   body={ 'title': "changed elsewhere" } ).execute()
+
+def listing( runner ):
+   runner.start()
+   runner.run( "ls, nothing cached", "ls" )
+   runner.run( "ls, everything cached", "ls" )
+   runner.changeElsewhere()
+   runner.run( "ls, one list changed elsewhere", "ls" )
+   runner.changeElsewhere()
+   runner.run( "ls -R, one list changed elsewhere", "ls", "-R" )
+   runner.run( "ls p:List1", "ls", "p:List1" )
+   runner.run( "project-ls", "project-ls" )
+   runner.start()
+   runner.run( "ls -j 1, nothing cached", "ls", "-j", "1" )
+
+def changes( runner ):
+   runner.start()
+   runner.run( "ls, nothing cached", "ls" )
+   runner.run( "add", "add", "p:List1", "new", "task" )
+   runner.run( "done", "done", "L1T3" )
+   runner.run( "undo", "undo", "L1T3" )
+   runner.run( "rename", "mv", "L1T4", "--", "renamed" )
+   runner.run( "delete", "rm", "L1T5" )
+   runner.run( "project-add", "project-add", "--", "Extra" )
+   runner.run( "project-rename", "-P", "mv", "Extra", "--", "Extra2" )
+   runner.run( "ls, after our own changes", "ls" )
+
+def bulk( runner ):
+   runner.start()
+   runner.run( "ls, nothing cached", "ls" )
+   runner.editor( "" )
+   runner.run( "bulk, no changes", "bulk", "p:List1" )
+   runner.editor( """
+tasks = [ n for n, line in enumerate( lines ) if line.startswith( "** " ) ]
+lines[ tasks[ 0 ] ], lines[ tasks[ -1 ] ] = lines[ tasks[ -1 ] ], lines[ tasks[ 0 ] ]
+""" )
+   runner.run( "bulk, swap first and last", "bulk", "p:List1" )
+   runner.editor( """
+tasks = [ n for n, line in enumerate( lines ) if line.startswith( "** " ) ]
+lines[ tasks[ 0 ]:tasks[ -1 ] + 1 ] = reversed( lines[ tasks[ 0 ]:tasks[ -1 ] + 1 ] )
+lines = [ line for line in lines if not line.startswith( "*** " ) ]
+""" )
+   runner.run( "bulk, reverse (dropping subtasks)", "bulk", "p:List2" )
+   runner.editor( """
+lines = [ line.replace( "[ ]", "[X]" ) if line.startswith( "** " ) else line
+          for line in lines ]
+""" )
+   runner.run( "bulk, complete everything", "bulk", "p:List3" )
+   runner.editor( """
+lines.append( "* (p) New list" )
+lines.extend( "** (t) [ ] New task %d" % n for n in range( 10 ) )
+""" )
+   runner.run( "bulk, new list of 10 tasks", "bulk", "p:List4" )
+
+def failures( runner ):
+   runner.start( throttleRate=0.2 )
+   runner.run( "ls, nothing cached, 20% throttled", "ls" )
+   runner.start( errorRate=0.2 )
+   runner.run( "ls, nothing cached, 20% failing", "ls" )
+   runner.start( quota=5 )
+   runner.run( "ls, nothing cached, 5 calls/s quota", "ls" )
+   runner.service.fail( 503, 503, 429 )
+   runner.run( "done, after 503, 503, 429", "done", "L1T3" )
+   runner.start()
+   runner.service.failBatches( 503 )
+   runner.editor( """
+lines = [ line.replace( "[ ]", "[X]" ) if line.startswith( "** " ) else line
+          for line in lines ]
+""" )
+   runner.run( "bulk, complete all after a 503 batch", "bulk", "p:List2" )
+
+scenarios = {
+   "listing": listing,
+   "changes": changes,
+   "bulk": bulk,
+   "failures": failures,
+}
+
+def main( argv ):
+   backendName = "sync"
+   lists = 10
+   tasks = 30
+   latency = 0.02
+   verbose = False
+   names = []
+   while argv:
+      arg = argv.pop( 0 )
+      if arg == '-v':
+         verbose = True
+      elif arg == '-b':
+         backendName = argv.pop( 0 )
+      elif arg == '-l':
+         lists = int( argv.pop( 0 ) )
+      elif arg == '-t':
+         tasks = int( argv.pop( 0 ) )
+      elif arg == '-L':
+         latency = float( argv.pop( 0 ) )
+      elif arg in scenarios:
+         names.append( arg )
+      else:
+         print( usage )
+         print( "Scenarios: %s" % ", ".join( scenarios ) )
+         return 1
+   if not names:
+      names = list( scenarios )
+
+   if backendName == "async":
+      from AsyncGoogleTasks import AsyncGoogleTasks as backend
+   else:
+      from GoogleTasks import GoogleTasks as backend
+   runner = Runner( loadTaskScript(), backend, lists, tasks, latency, verbose )
+   print( "%-40s %7s %5s %5s %5s  %s" % ( "scenario", "time", "http", "calls",
+                                          "fail", "calls by method" ) )
+   for name in names:
+      print( "%s:" % name )
+      scenarios[ name ]( runner )
+   return 0
+
+if __name__ == '__main__':
+   sys.exit( main( sys.argv[ 1: ] ) )
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+# Times task commands from start to finish, split into the time spent
+# importing modules (from python -X importtime) and the rest, which is
+# authenticating, loading and actually running the command.  The commands
+# run for real, against the usual config and cache, so stick to listing.
+# Any running "task serve" is used as normal.
+
+usage = """
+Usage: startup.py [-n RUNS] [COMMAND...]
+
+Each COMMAND is one quoted argument, e.g. "ls -o".  By default the
+commands are: "" (help), "-h", "ls -o", "ls" and "project-ls".
+"""
+
+defaultCommands = [ "", "-h", "ls -o", "ls", "project-ls" ]
+taskScript = os.path.join( os.path.dirname( os.path.dirname(
+      os.path.abspath( __file__ ) ) ), 'task' )
+importLine = re.compile( r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)" )
+
+def runOnce( command ):
+   # Returns the wall time, and the cumulative import time of each module
+   # imported directly by the interpreter or the task script, in seconds
+   argv = [ sys.executable, '-X', 'importtime', taskScript ] + command.split()
+   start = time.perf_counter()
+   result = subprocess.run( argv, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True )
+   wall = time.perf_counter() - start
+   imports = {}
+   for line in result.stderr.splitlines():
+      match = importLine.match( line )
+      if match and len( match.group( 3 ) ) == 1:
+         module = match.group( 4 )
+         imports[ module ] = imports.get( module, 0 ) + int( match.group( 2 ) ) / 1e6
+   return wall, imports, result.returncode
+
+def benchmark( command, runs ):
+   walls = []
+   importTotals = []
+   imports = {}
+   status = 0
+   for run in range( runs ):
+      wall, imports, status = runOnce( command )
+      walls.append( wall )
+      importTotals.append( sum( imports.values() ) )
+   wall = statistics.median( walls )
+   importTime = statistics.median( importTotals )
+   heaviest = sorted( imports.items(), key=lambda item: -item[ 1 ] )[ :3 ]
+   print( "%-14s %8.0f %8.0f %8.0f  %s%s" % (
+         '"%s"' % command, wall * 1000, importTime * 1000,
+         ( wall - importTime ) * 1000,
+         ", ".join( "%s %.0f" % ( module, seconds * 1000 )
+                    for module, seconds in heaviest ),
+         "" if status == 0 else "  (exit status %d)" % status ) )
+
+def main( argv ):
+   runs = 5
+   commands = []
+   while argv:
+      arg = argv.pop( 0 )
+      if arg == '-n':
+         runs = int( argv.pop( 0 ) )
+      elif arg == '--help':
+         print( usage )
+         return 0
+      else:
+         commands.append( arg )
+   if not commands:
+      commands = defaultCommands
+
+   print( "Median of %d runs, in milliseconds" % runs )
+   print( "%-14s %8s %8s %8s  %s" % ( "command", "total", "imports", "rest",
+                                      "heaviest imports" ) )
+   for command in commands:
+      benchmark( command, runs )
+   return 0
+
+if __name__ == '__main__':
+   sys.exit( main( sys.argv[ 1: ] ) )
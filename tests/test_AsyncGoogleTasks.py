@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+try:
+   import aiohttp
+   from aiohttp import web
+except ImportError:
+   aiohttp = None
+
+from googleapiclient.errors import HttpError
+
+import FakeTasks
+
+class Creds:
+   valid = True
+   token = "token"
+
+class Server:
+   # Serves a FakeTasks.Service over HTTP on a loop of its own
+   def __init__( self, service ):
+      self.loop = asyncio.new_event_loop()
+      self.thread = threading.Thread( target=self.loop.run_forever, daemon=True )
+      self.thread.start()
+      self.runner = web.AppRunner( FakeTasks.restApp( service ) )
+      self.run( self.runner.setup() )
+      site = web.TCPSite( self.runner, "127.0.0.1", 0 )
+      self.run( site.start() )
+      port = site._server.sockets[ 0 ].getsockname()[ 1 ]
+      self.baseUrl = "http://127.0.0.1:%d/tasks/v1/" % port
+
+   def run( self, coroutine ):
+      return asyncio.run_coroutine_threadsafe( coroutine, self.loop ).result()
+
+   def close( self ):
+      self.run( self.runner.cleanup() )
+      self.loop.call_soon_threadsafe( self.loop.stop )
+      self.thread.join()
+      self.loop.close()
+
+@unittest.skipIf( aiohttp is None, "needs aiohttp" )
+class AsyncGoogleTasksTest( unittest.TestCase ):
+   def setUp( self ):
+      from AsyncGoogleTasks import AsyncGoogleTasks
+      self.service = FakeTasks.Service()
+      self.tasklist = self.service.tasklists().insert(
+            body={ 'title': "List" } ).execute()
+      previous = None
+      for n in range( 3 ):
+         previous = self.service.tasks().insert(
+               tasklist=self.tasklist[ 'id' ], previous=previous,
+               body={ 'title': "T%d" % n } ).execute()[ 'id' ]
+      self.server = Server( self.service )
+      self.cacheDir = tempfile.TemporaryDirectory()
+      self.taskApi = AsyncGoogleTasks( self.cacheDir.name, self.cacheDir.name )
+      self.taskApi.creds = Creds()
+      self.taskApi.baseUrl = self.server.baseUrl
+
+   def tearDown( self ):
+      self.taskApi.close()
+      self.server.close()
+      self.cacheDir.cleanup()
+
+   def serverTasks( self ):
+      return { task[ 'title' ]: task
+               for task in self.service.tasksByList[ self.tasklist[ 'id' ] ].values()
+               if not task.get( 'deleted' ) }
+
+   def test_sync_api( self ):
+      project = self.taskApi.getProjects()[ 0 ]
+      task = [ task for task in project.tasks if task.title == "T1" ][ 0 ]
+      task.complete = True
+      task.save()
+      self.assertEqual( self.serverTasks()[ "T1" ][ 'status' ], "completed" )
+
+   def test_coroutines_on_another_loop( self ):
+      project = self.taskApi.getProjects()[ 0 ]
+      tasks = asyncio.run( project.getTasksAsync() )
+      self.assertEqual( sorted( task.title for task in tasks ), [ "T0", "T1", "T2" ] )
+      task = [ task for task in tasks if task.title == "T1" ][ 0 ]
+      task.title = "renamed"
+      asyncio.run( task.saveAsync() )
+      self.assertIn( "renamed", self.serverTasks() )
+      asyncio.run( task.deleteAsync() )
+      self.assertEqual( sorted( self.serverTasks() ), [ "T0", "T2" ] )
+
+   def test_partly_failed_batch_keeps_what_succeeded( self ):
+      project = self.taskApi.getProjects()[ 0 ]
+      tasks = { task.title: task for task in project.tasks }
+      self.service.tasksByList[ self.tasklist[ 'id' ] ].pop( tasks[ "T2" ].apiId )
+      def renameBoth():
+         for title in ( "T0", "T2" ):
+            tasks[ title ].title = title + " renamed"
+            tasks[ title ].save()
+      with self.assertRaises( HttpError ):
+         asyncio.run( self.taskApi.batched( renameBoth ) )
+      self.assertIn( "T0 renamed", self.serverTasks() )
+      cached = self.taskApi.cache.load( self.tasklist[ 'id' ] )[ 'tasks' ]
+      self.assertIn( "T0 renamed", [ task[ 'title' ] for task in cached ] )
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+repoDir = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, repoDir )
+sys.path.insert( 0, os.path.join( repoDir, "benchmarks" ) )
+
+import scenarios
+import Daemon
+from GoogleTasks import GoogleTasks
+
+forwardScript = """
+import sys
+sys.path.insert( 0, %r )
+import Daemon
+print( Daemon.forward( sys.argv[ 1 ], sys.argv[ 2: ] ) )
+"""
+
+class SlowSyncApi( GoogleTasks ):
+   # Syncing waits until it is let go, to see what else can happen meanwhile
+   def __init__( self, *args, **kwargs ):
+      super().__init__( *args, **kwargs )
+      self.syncing = threading.Event()
+      self.release = threading.Event()
+      self.failure = None
+
+   def refreshCache( self, projects ):
+      self.syncing.set()
+      self.release.wait( 10 )
+      if self.failure is not None:
+         raise self.failure
+      super().refreshCache( projects )
+
+@unittest.skipUnless( hasattr( socket, 'AF_UNIX' ), "needs Unix sockets" )
+class DaemonTest( unittest.TestCase ):
+   def setUp( self ):
+      self.home = os.environ.get( 'HOME' )
+      self.runner = scenarios.Runner( scenarios.loadTaskScript(), GoogleTasks,
+                                      lists=3, tasks=3, latency=0, verbose=False )
+      self.runner.start()
+      self.taskScript = self.runner.taskScript
+      self.configDir, self.cacheDir = self.taskScript.loadGlobalConfig()
+      self.workDir = tempfile.TemporaryDirectory( prefix="task-client-" )
+      self.syncApi = None
+
+   def tearDown( self ):
+      if self.syncApi is not None:
+         self.syncApi.release.set()
+      if self.home is None:
+         os.environ.pop( 'HOME', None )
+      else:
+         os.environ[ 'HOME' ] = self.home
+      self.workDir.cleanup()
+      self.runner.home.cleanup()
+
+   def newTaskApi( self, backend=GoogleTasks ):
+      return backend( self.configDir, self.cacheDir, allowOffline=True,
+                      service=self.runner.service )
+
+   def serve( self, run ):
+      self.syncApi = self.newTaskApi( SlowSyncApi )
+      taskApi = self.newTaskApi()
+      taskApi.keepLoaded = True
+      server = Daemon.Server( taskApi, self.syncApi,
+                              self.taskScript.apiSettings( {} ), self.cacheDir,
+                              run, syncInterval=3600 )
+      # It never stops, but nothing is left of it once its home is gone
+      threading.Thread( target=server.serve, daemon=True ).start()
+      deadline = time.monotonic() + 10
+      while not os.path.exists( Daemon.socketPath( self.cacheDir ) ):
+         self.assertLess( time.monotonic(), deadline )
+         time.sleep( 0.01 )
+      return server
+
+   def forward( self, *argv, **environ ):
+      # Returns what forward() returned, and the client's stderr
+      env = dict( os.environ )
+      env.update( environ )
+      result = subprocess.run(
+            [ sys.executable, '-c', forwardScript % repoDir, self.cacheDir ] +
+            list( argv ), cwd=self.workDir.name, env=env, timeout=30,
+            stdin=subprocess.DEVNULL, capture_output=True, text=True )
+      self.stderr = result.stderr
+      return result.stdout.splitlines()[ -1 ]
+
+   def test_command_runs_in_client_directory_and_environment( self ):
+      seen = {}
+      def run( argv, server ):
+         seen[ 'argv' ] = argv
+         seen[ 'cwd' ] = os.getcwd()
+         seen[ 'EDITOR' ] = os.environ.get( 'EDITOR' )
+         return 3
+      cwd = os.getcwd()
+      editor = os.environ.get( 'EDITOR' )
+      self.serve( run )
+      self.assertEqual( self.forward( "ls", EDITOR="client-editor" ), "3" )
+      self.assertEqual( seen[ 'argv' ], [ "ls" ] )
+      self.assertEqual( seen[ 'cwd' ], os.path.realpath( self.workDir.name ) )
+      self.assertEqual( seen[ 'EDITOR' ], "client-editor" )
+      self.assertEqual( os.getcwd(), cwd )
+      self.assertEqual( os.environ.get( 'EDITOR' ), editor )
+
+   def test_relative_trace_file( self ):
+      self.serve( self.taskScript.main )
+      self.assertEqual( self.forward( "ls", "-zT", "trace.json" ), "0" )
+      self.assertTrue( os.path.exists( os.path.join( self.workDir.name,
+                                                     "trace.json" ) ) )
+
+   def test_commands_run_while_syncing( self ):
+      self.serve( self.taskScript.main )
+      self.assertTrue( self.syncApi.syncing.wait( 10 ) )
+      self.assertEqual( self.forward( "ls" ), "0" )
+      self.assertFalse( self.syncApi.release.is_set() )
+
+   def test_sync_warnings_stay_out_of_commands( self ):
+      def run( argv, server ):
+         # The sync fails while this command has the client's stderr
+         self.syncApi.failure = RuntimeError( "no network" )
+         self.syncApi.release.set()
+         time.sleep( 0.2 )
+         return 0
+      # Warnings go to fd 2, as they do in a real daemon, whatever the test
+      # runner has made of sys.stderr
+      stderr = sys.stderr
+      sys.stderr = open( 2, 'w', buffering=1, closefd=False )
+      try:
+         self.serve( run )
+         self.assertTrue( self.syncApi.syncing.wait( 10 ) )
+         self.assertEqual( self.forward( "ls" ), "0" )
+      finally:
+         sys.stderr.close()
+         sys.stderr = stderr
+      self.assertNotIn( "no network", self.stderr )
+
+   def test_not_run_again_if_the_daemon_stops( self ):
+      # A daemon that takes the command and then dies
+      listener = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+      listener.bind( Daemon.socketPath( self.cacheDir ) )
+      listener.listen()
+      def die():
+         connection, address = listener.accept()
+         message, fds, flags, address = socket.recv_fds( connection,
+                                                         Daemon.maxMessage, 3 )
+         for fd in fds:
+            os.close( fd )
+         connection.close()
+         listener.close()
+      threading.Thread( target=die, daemon=True ).start()
+      self.assertEqual( self.forward( "add", "x" ), "1" )
+      self.assertIn( "daemon stopped", self.stderr )
+
+if __name__ == '__main__':
+   unittest.main()
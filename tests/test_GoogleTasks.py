@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import FakeTasks
+from GoogleTasks import GoogleTasks
+
+class ServiceTest( unittest.TestCase ):
+   # A fake service with lists L0... holding a task each, and a cache
+   lists = 3
+
+   def setUp( self ):
+      self.service = FakeTasks.Service()
+      for listNo in range( self.lists ):
+         tasklist = self.service.tasklists().insert(
+               body={ 'title': "L%d" % listNo } ).execute()
+         self.service.tasks().insert( tasklist=tasklist[ 'id' ],
+                                      body={ 'title': "L%dT0" % listNo } ).execute()
+      self.cacheDir = tempfile.TemporaryDirectory()
+
+   def tearDown( self ):
+      self.cacheDir.cleanup()
+
+   def newTaskApi( self, service=None, indexMaxAge=0, **options ):
+      taskApi = GoogleTasks( self.cacheDir.name, self.cacheDir.name,
+                             service=service or self.service, **options )
+      taskApi.startCommand( indexMaxAge=indexMaxAge )
+      return taskApi
+
+   def addTask( self, listNo, title ):
+      tasklist = list( self.service.lists )[ listNo ]
+      self.service.tasks().insert( tasklist=tasklist,
+                                   body={ 'title': title } ).execute()
+
+def apiTask( taskId, position, parent=None, title=None ):
+   task = { 'id': taskId, 'position': position, 'title': title or taskId }
+   if parent is not None:
+      task[ 'parent' ] = parent
+   return task
+
+class DeltaSyncTest( ServiceTest ):
+   def setUp( self ):
+      super().setUp()
+      self.taskApi = GoogleTasks( self.cacheDir.name, self.cacheDir.name,
+                                  service=self.service )
+      self.cached = { 'tasks': [ apiTask( "a", "1" ), apiTask( "a1", "1", "a" ),
+                                 apiTask( "a2", "2", "a" ), apiTask( "b", "2" ),
+                                 apiTask( "b1", "1", "b" ) ] }
+
+   def apply( self, *changes ):
+      tasks = self.taskApi.applyTaskChanges( self.cached, list( changes ) )
+      if tasks is None:
+         return None
+      return { task[ 'id' ]: ( task.get( 'parent' ), task[ 'position' ] )
+               for task in tasks }
+
+   def test_deleted_tasks_go_with_their_subtasks( self ):
+      self.assertEqual( self.apply( { 'id': "a", 'deleted': True } ),
+                        { "b": ( None, "2" ), "b1": ( "b", "1" ) } )
+      # A deleted task the cache never had changes nothing
+      self.assertEqual( len( self.apply( { 'id': "z", 'deleted': True } ) ), 5 )
+
+   def test_moved_and_new_tasks( self ):
+      tasks = self.apply( apiTask( "a2", "2", "b" ), apiTask( "c", "3" ),
+                          apiTask( "c1", "1", "c" ) )
+      self.assertEqual( tasks, { "a": ( None, "1" ), "a1": ( "a", "1" ),
+                                 "a2": ( "b", "2" ), "b": ( None, "2" ),
+                                 "b1": ( "b", "1" ), "c": ( None, "3" ),
+                                 "c1": ( "c", "1" ) } )
+      self.assertEqual( self.cached[ 'tasks' ][ 2 ], apiTask( "a2", "2", "a" ) )
+
+   def test_moved_into_a_deleted_task( self ):
+      # The delete is applied after the move, so the moved task goes too
+      tasks = self.apply( apiTask( "b1", "3", "a" ), { 'id': "a", 'deleted': True } )
+      self.assertEqual( tasks, { "b": ( None, "2" ) } )
+
+   def test_missed_changes( self ):
+      # A parent we never heard about
+      self.assertIsNone( self.apply( apiTask( "x", "3", "gone" ) ) )
+      # a1 was renumbered without being among the changes
+      self.assertIsNone( self.apply( apiTask( "a2", "1", "a" ) ) )
+      # ... but not if it was
+      self.assertIsNotNone( self.apply( apiTask( "a2", "1", "a" ),
+                                        apiTask( "a1", "2", "a" ) ) )
+
+   def test_synced_changes_match_the_service( self ):
+      tasklist = list( self.service.lists )[ 0 ]
+      tasks = self.service.tasks()
+      parent = tasks.insert( tasklist=tasklist, body={ 'title': "parent" } ).execute()
+      tasks.insert( tasklist=tasklist, body={ 'title': "child" },
+                    parent=parent[ 'id' ] ).execute()
+      mover = tasks.insert( tasklist=tasklist, body={ 'title': "mover" } ).execute()
+      taskApi = self.newTaskApi()
+      taskApi.loadTasks( taskApi.getProjects() )
+      taskApi.close()
+      tasks.delete( tasklist=tasklist, task=parent[ 'id' ] ).execute()
+      first, = [ task for task in self.service.tasksByList[ tasklist ].values()
+                 if task[ 'title' ] == "L0T0" ]
+      tasks.move( tasklist=tasklist, task=mover[ 'id' ],
+                  parent=first[ 'id' ] ).execute()
+      tasks.insert( tasklist=tasklist, body={ 'title': "new" } ).execute()
+      taskApi = self.newTaskApi()
+      applied = []
+      def applyTaskChanges( cache, changes ):
+         applied.append( changes )
+         return GoogleTasks.applyTaskChanges( taskApi, cache, changes )
+      taskApi.applyTaskChanges = applyTaskChanges
+      taskApi.loadTasks( taskApi.getProjects()[ :1 ] )
+      taskApi.close()
+      # The changes were fetched, deletions and all, and left the cache as a
+      # full fetch would
+      self.assertEqual( len( applied ), 1 )
+      self.assertEqual( sum( 1 for task in applied[ 0 ] if task.get( 'deleted' ) ), 2 )
+      expected = { task[ 'id' ]: task
+                   for task in self.service.tasksByList[ tasklist ].values()
+                   if not task.get( 'deleted' ) }
+      cached = self.taskApi.cache.load( tasklist )[ 'tasks' ]
+      self.assertEqual( { task[ 'id' ]: task for task in cached }, expected )
+
+class StreamTasksTest( ServiceTest ):
+   def test_first_project_before_the_rest_are_loaded( self ):
+      taskApi = self.newTaskApi()
+      taskApi.loadTasks( taskApi.getProjects() )
+      taskApi.close()
+      self.addTask( 2, "new" )
+      taskApi = self.newTaskApi()
+      projects = taskApi.getProjects()
+      stream = taskApi.streamTasks( projects )
+      self.assertIs( next( stream ), projects[ 0 ] )
+      self.assertEqual( [ project.loaded for project in projects ],
+                        [ True, False, False ] )
+      shortId = list( projects[ 0 ].tasks )[ 0 ].shortId
+      self.assertEqual( list( stream ), projects[ 1: ] )
+      # Any longer id still starts with the one shown
+      self.assertTrue( list( projects[ 0 ].tasks )[ 0 ].shortId.startswith( shortId ) )
+
+   def test_projects_never_given_ids_are_loaded_first( self ):
+      taskApi = self.newTaskApi()
+      projects = taskApi.getProjects()
+      stream = taskApi.streamTasks( projects[ :1 ] )
+      next( stream )
+      self.assertEqual( [ project.loaded for project in projects ],
+                        [ True, True, True ] )
+      stream.close()
+
+class IndexTest( ServiceTest ):
+   def titles( self, taskApi ):
+      return [ project.title for project in taskApi.getProjects() ]
+
+   def test_fresh_index_is_not_fetched( self ):
+      self.newTaskApi().getProjects()
+      self.service.resetCounts()
+      taskApi = self.newTaskApi( indexMaxAge=3600 )
+      self.assertEqual( self.titles( taskApi ), [ "L0", "L1", "L2" ] )
+      taskApi.close()
+      self.assertEqual( sum( self.service.httpRequests.values() ), 0 )
+
+   def test_each_account_has_its_own_index( self ):
+      work = FakeTasks.Service()
+      work.tasklists().insert( body={ 'title': "WorkList" } ).execute()
+      personal = self.newTaskApi( indexMaxAge=3600 )
+      self.assertEqual( self.titles( personal ), [ "L0", "L1", "L2" ] )
+      personal.loadTasks( personal.projects )
+      workApi = self.newTaskApi( service=work, indexMaxAge=3600, account="Work" )
+      self.assertEqual( self.titles( workApi ), [ "WorkList" ] )
+      workApi.loadTasks( workApi.projects )
+      self.assertEqual( self.titles( self.newTaskApi( indexMaxAge=3600 ) ),
+                        [ "L0", "L1", "L2" ] )
+      offline = self.newTaskApi( service=work, account="Work", offline=True )
+      self.assertEqual( self.titles( offline ), [ "WorkList" ] )
+      # Loading the other account's lists left these ids alone
+      taskApi = self.newTaskApi( indexMaxAge=3600 )
+      taskApi.getProjects()
+      self.assertEqual( set( taskApi.loadTaskIds().groups ),
+                        set( project.apiId for project in personal.projects ) )
+
+if __name__ == '__main__':
+   unittest.main()
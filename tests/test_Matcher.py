@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import itertools
+import os
+import sys
+import unittest
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import Matcher
+
+class Leaf( Matcher.Matcher ):
+   # Matches what its test says it matches, at the given cost, noting each
+   # call in calls
+   def __init__( self, name, cost, test, calls ):
+      super().__init__()
+      self.name = name
+      self.cost = cost
+      self.test = test
+      self.calls = calls
+
+   def match( self, projectOrTask ):
+      return self.test( projectOrTask )
+
+   def compile( self ):
+      if self.test is Matcher.always or self.test is Matcher.never:
+         return ( 0, self.test )
+
+      def predicate( projectOrTask ):
+         self.calls.append( self.name )
+         return self.test( projectOrTask )
+
+      return ( self.cost, predicate )
+
+def group( groupType, *matchers ):
+   result = groupType()
+   for matcher in matchers:
+      result.add( matcher )
+   return result
+
+class CompileTest( unittest.TestCase ):
+   def setUp( self ):
+      self.calls = []
+
+   def leaf( self, name, cost, test ):
+      return Leaf( name, cost, test, self.calls )
+
+   def value( self, name, cost ):
+      # Matches a dict of leaf names to results
+      return self.leaf( name, cost, lambda values: values[ name ] )
+
+   def test_cheapest_first( self ):
+      matcher = group( Matcher.And, self.value( "slow", 5 ), self.value( "fast", 1 ) )
+      cost, predicate = matcher.compile()
+      self.assertEqual( cost, 6 )
+      self.assertFalse( predicate( { "slow": True, "fast": False } ) )
+      self.assertEqual( self.calls, [ "fast" ] )
+      self.calls.clear()
+      self.assertTrue( predicate( { "slow": True, "fast": True } ) )
+      self.assertEqual( self.calls, [ "fast", "slow" ] )
+
+      matcher = group( Matcher.Or, self.value( "slow", 5 ), self.value( "fast", 1 ) )
+      cost, predicate = matcher.compile()
+      self.calls.clear()
+      self.assertTrue( predicate( { "slow": False, "fast": True } ) )
+      self.assertEqual( self.calls, [ "fast" ] )
+      self.calls.clear()
+      self.assertFalse( predicate( { "slow": False, "fast": False } ) )
+      self.assertEqual( self.calls, [ "fast", "slow" ] )
+
+   def test_nested_cost( self ):
+      inner = group( Matcher.Or, self.value( "a", 3 ), self.value( "b", 3 ) )
+      matcher = group( Matcher.And, inner, self.value( "c", 4 ) )
+      cost, predicate = matcher.compile()
+      self.assertEqual( cost, 10 )
+      self.assertFalse( predicate( { "a": True, "b": True, "c": False } ) )
+      self.assertEqual( self.calls, [ "c" ] )
+
+   def test_folding( self ):
+      always = self.leaf( "always", 0, Matcher.always )
+      never = self.leaf( "never", 0, Matcher.never )
+      one = self.value( "one", 2 )
+      self.assertEqual( group( Matcher.And ).compile(), ( 0, Matcher.always ) )
+      self.assertEqual( group( Matcher.Or ).compile(), ( 0, Matcher.never ) )
+      self.assertEqual( group( Matcher.Not ).compile(), ( 0, Matcher.always ) )
+      self.assertEqual( group( Matcher.And, one, never ).compile(), ( 0, Matcher.never ) )
+      self.assertEqual( group( Matcher.Or, one, always ).compile(), ( 0, Matcher.always ) )
+      self.assertEqual( group( Matcher.Not, one, always ).compile(), ( 0, Matcher.never ) )
+      self.assertEqual( group( Matcher.Not, never ).compile(), ( 0, Matcher.always ) )
+      # What can't change the result is left out, leaving just one
+      cost, predicate = group( Matcher.And, always, one ).compile()
+      self.assertEqual( cost, 2 )
+      self.assertTrue( predicate( { "one": True } ) )
+      self.assertEqual( self.calls, [ "one" ] )
+      cost, predicate = group( Matcher.Or, never, one ).compile()
+      self.assertEqual( cost, 2 )
+      self.assertFalse( predicate( { "one": False } ) )
+      # Folded children fold their parents in turn
+      nothing = group( Matcher.Or, never, group( Matcher.And, one, never ) )
+      self.assertEqual( nothing.compile(), ( 0, Matcher.never ) )
+      self.assertEqual( group( Matcher.Not, nothing ).compile(), ( 0, Matcher.always ) )
+
+   def test_same_results_as_match( self ):
+      a, b, c = self.value( "a", 3 ), self.value( "b", 1 ), self.value( "c", 2 )
+      matcher = group( Matcher.Or,
+                       group( Matcher.And, a, group( Matcher.Not, b ) ),
+                       group( Matcher.Not, c, group( Matcher.And, a, b ) ) )
+      compiled = Matcher.Compiled( matcher )
+      for results in itertools.product( ( False, True ), repeat=3 ):
+         values = dict( zip( "abc", results ) )
+         self.assertEqual( compiled.match( values ), matcher.match( values ), values )
+         expected = ( values[ "a" ] and not values[ "b" ] ) or \
+                    not ( values[ "c" ] or ( values[ "a" ] and values[ "b" ] ) )
+         self.assertEqual( compiled.match( values ), expected, values )
+
+if __name__ == '__main__':
+   unittest.main()
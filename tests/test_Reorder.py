@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import itertools
+import os
+import sys
+import unittest
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import Reorder
+
+def ranksOf( order ):
+   return { task: rank for rank, task in enumerate( order ) }
+
+def applyMoves( original, target, moving ):
+   # Moves each task in turn, in the target order, to just after the task
+   # before it there, as the API does
+   current = [ task for task in original if task in target ]
+   for index, task in enumerate( target ):
+      if task not in moving:
+         continue
+      if task in current:
+         current.remove( task )
+      position = current.index( target[ index - 1 ] ) + 1 if index else 0
+      current.insert( position, task )
+   return current
+
+def fewestMoves( original, target ):
+   # By brute force: every task but the most that can stay in order
+   ranks = ranksOf( original )
+   placed = [ task for task in target if task in ranks ]
+   for size in range( len( placed ), -1, -1 ):
+      for staying in itertools.combinations( placed, size ):
+         if list( staying ) == sorted( staying, key=ranks.get ):
+            return len( target ) - size
+
+class TasksToMoveTest( unittest.TestCase ):
+   def check( self, original, target, expected=None ):
+      moving = Reorder.tasksToMove( target, ranksOf( original ) )
+      if expected is not None:
+         self.assertEqual( moving, expected )
+      self.assertEqual( len( moving ), fewestMoves( original, target ) )
+      self.assertEqual( applyMoves( original, target, set( moving ) ), target )
+      return moving
+
+   def test_unchanged( self ):
+      self.check( "abcde", list( "abcde" ), [] )
+
+   def test_swap( self ):
+      moving = self.check( "abcde", list( "ebcda" ) )
+      self.assertEqual( set( moving ), { "a", "e" } )
+
+   def test_reverse( self ):
+      self.check( "abcde", list( "edcba" ) )
+
+   def test_new_task( self ):
+      self.check( "abcd", list( "abxcd" ), [ "x" ] )
+
+   def test_moved_in_from_another_parent( self ):
+      # y was a sibling elsewhere, so has no rank here, and c has left
+      self.check( "abcd", list( "aybd" ), [ "y" ] )
+
+   def test_every_order_of_five( self ):
+      for target in itertools.permutations( "abcde" ):
+         self.check( "abcde", list( target ) )
+
+   def test_longest_ordered_run( self ):
+      ranks = [ 3, 1, 4, 1, 5, 9, 2, 6 ]
+      run = Reorder.longestOrderedRun( ranks )
+      self.assertEqual( len( run ), 4 )
+      ranks = [ ranks[ index ] for index in sorted( run ) ]
+      self.assertEqual( ranks, sorted( set( ranks ) ) )
+      self.assertEqual( Reorder.longestOrderedRun( [] ), set() )
+
+if __name__ == '__main__':
+   unittest.main()
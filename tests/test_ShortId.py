@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import unittest
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+from ShortId import ShortIds, Trie
+
+class TrieTest( unittest.TestCase ):
+   def test_empty( self ):
+      trie = Trie()
+      self.assertEqual( trie.uniquePrefixLength(), 1 )
+
+   def test_prefixes( self ):
+      trie = Trie()
+      for s in ( "abcd", "abef", "xyz" ):
+         trie.addString( s )
+      self.assertEqual( trie.uniquePrefixLength(), 3 )
+      self.assertEqual( trie.generateUniquePrefix( "abcd" ), "abc" )
+      self.assertEqual( trie.generateUniquePrefix( "abef" ), "abe" )
+      self.assertEqual( trie.generateUniquePrefix( "xyz" ), "x" )
+
+   def test_remove( self ):
+      trie = Trie()
+      for s in ( "abcd", "abef", "xyz" ):
+         trie.addString( s )
+      trie.removeString( "abef" )
+      self.assertEqual( trie.uniquePrefixLength(), 1 )
+      self.assertEqual( trie.generateUniquePrefix( "abcd" ), "a" )
+      trie.addString( "abcz" )
+      self.assertEqual( trie.uniquePrefixLength(), 4 )
+
+class ShortIdsTest( unittest.TestCase ):
+   def test_ids_are_unique_prefixes( self ):
+      shortIds = ShortIds( "t" )
+      itemIds = [ "item%d" % n for n in range( 200 ) ]
+      shortIds.update( "A", itemIds )
+      shortIds.uniqueLength()
+      ids = set( shortIds.shortId( itemId ) for itemId in itemIds )
+      self.assertEqual( len( ids ), len( itemIds ) )
+      self.assertTrue( all( shortId.startswith( "t" ) for shortId in ids ) )
+
+   def test_length_never_shrinks( self ):
+      shortIds = ShortIds()
+      shortIds.update( "A", [ "item%d" % n for n in range( 200 ) ] )
+      length = shortIds.uniqueLength()
+      shortIds.update( "A", [ "item0" ] )
+      self.assertEqual( shortIds.uniqueLength(), length )
+
+   def test_state_round_trip( self ):
+      shortIds = ShortIds( "t" )
+      shortIds.update( "A", [ "x", "y" ] )
+      shortIds.update( "B", [ "z" ] )
+      shortIds.uniqueLength()
+      restored = ShortIds( "t", shortIds.state() )
+      self.assertFalse( restored.changed )
+      self.assertEqual( restored.state(), shortIds.state() )
+      for itemId in ( "x", "y", "z" ):
+         self.assertEqual( restored.shortId( itemId ), shortIds.shortId( itemId ) )
+
+   def test_item_moved_between_groups( self ):
+      # x moves from A to B, and B is reloaded before A
+      shortIds = ShortIds()
+      shortIds.update( "A", [ "x", "y" ] )
+      shortIds.update( "B", [ "x", "z" ] )
+      shortIds.update( "A", [ "y" ] )
+      shortIds.uniqueLength()
+      self.assertTrue( shortIds.shortId( "x" ) )
+      self.assertEqual( shortIds.state()[ 'groups' ][ 'B' ].keys(), { "x", "z" } )
+      restored = ShortIds( "", shortIds.state() )
+      self.assertEqual( restored.shortId( "x" ), shortIds.shortId( "x" ) )
+      shortIds.update( "B", [ "z" ] )
+      self.assertNotIn( "x", shortIds.hashes )
+
+   def test_group_removed_while_item_held_elsewhere( self ):
+      shortIds = ShortIds()
+      shortIds.update( "A", [ "x" ] )
+      shortIds.update( "B", [ "x" ] )
+      shortIds.removeGroup( "A" )
+      shortIds.uniqueLength()
+      self.assertTrue( shortIds.shortId( "x" ) )
+      shortIds.removeGroup( "B" )
+      self.assertEqual( shortIds.hashes, {} )
+      self.assertEqual( shortIds.trie.uniquePrefixLength(), 1 )
+
+if __name__ == '__main__':
+   unittest.main()
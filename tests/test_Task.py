@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+from datetime import date, timedelta
+import os
+import sys
+import unittest
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+from Project import Project
+import Task
+
+def newTask( title ):
+   task = Task.Task( Project( "Project" ) )
+   task.title = title
+   return task
+
+class TagTest( unittest.TestCase ):
+   def test_tags_in( self ):
+      cases = {
+            "call @na": { "na" },
+            "@NA first": { "na" },
+            "(@na)": { "na" },
+            "x,@na and @home-work.": { "na", "home-work" },
+            "mail me@example.com": set(),
+            "see https://example.com/@user": set(),
+            "two @@at signs": set(),
+            "": set(),
+            None: set(),
+         }
+      for text, tags in cases.items():
+         self.assertEqual( Task.tagsIn( text ), tags, text )
+
+   def test_add_and_remove( self ):
+      task = newTask( "call (@na)" )
+      task.addTag( "NA" )
+      self.assertEqual( task.title, "call (@na)" )
+      task.addTag( "home" )
+      self.assertEqual( task.title, "call (@na) @home" )
+      self.assertEqual( task.tags, { "na", "home" } )
+      task.removeTag( "home" )
+      task.removeTag( "home" )
+      self.assertEqual( task.title, "call (@na)" )
+      task.removeTag( "na" )
+      self.assertEqual( task.tags, set() )
+
+   def test_remove_leaves_email_addresses( self ):
+      task = newTask( "mail me@na.org @na" )
+      task.removeTag( "na" )
+      self.assertEqual( task.title, "mail me@na.org" )
+
+   def test_add_rejects_what_would_not_be_a_tag( self ):
+      task = newTask( "call" )
+      for tag in ( "", "n a", "na!", "@na" ):
+         with self.assertRaises( RuntimeError ):
+            task.addTag( tag )
+      self.assertEqual( task.title, "call" )
+
+class RequiredTextTest( unittest.TestCase ):
+   def test_literals( self ):
+      self.assertEqual( Task.requiredText( "pay bill" ), "pay bill" )
+      self.assertEqual( Task.requiredText( "a.b" ), "a" )
+      self.assertEqual( Task.requiredText( "x+longest?" ), "longes" )
+      self.assertEqual( Task.requiredText( "v1\\.2" ), "v1.2" )
+      self.assertEqual( Task.requiredText( "ab[cd]efg" ), "efg" )
+      self.assertEqual( Task.requiredText( "call\\s+bob" ), "call" )
+
+   def test_unknown( self ):
+      for pattern in ( "a|b", "(ab)", "ab{2", "\\x41bc", "\\u00e9t\\u00e9",
+                       "\\0ab", "\\1ab", "a\\N{DASH}b" ):
+         self.assertIsNone( Task.requiredText( pattern ), pattern )
+
+class DueMatcherTest( unittest.TestCase ):
+   def range( self, due ):
+      matcher = Task.DueMatcher( due )
+      return matcher.first, matcher.last
+
+   def day( self, days ):
+      return ( date.today() + timedelta( days=days ) ).isoformat()
+
+   def test_dates( self ):
+      self.assertEqual( self.range( "2030-01-02" ), ( "2030-01-02", "2030-01-02" ) )
+      self.assertEqual( self.range( "=2030-01-02" ), ( "2030-01-02", "2030-01-02" ) )
+      self.assertEqual( self.range( "+2030-01-02" ), ( "2030-01-03", None ) )
+      self.assertEqual( self.range( "-2030-01-01" ), ( None, "2029-12-31" ) )
+      self.assertEqual( self.range( "+=2030-01-02" ), ( "2030-01-02", None ) )
+      self.assertEqual( self.range( "-=2030-01-02" ), ( None, "2030-01-02" ) )
+      self.assertEqual( self.range( "today" ), ( self.day( 0 ), self.day( 0 ) ) )
+
+   def test_ranges( self ):
+      self.assertEqual( self.range( "overdue" ), ( None, self.day( -1 ) ) )
+      self.assertEqual( self.range( "+1w" ), ( self.day( 0 ), self.day( 7 ) ) )
+      self.assertEqual( self.range( "-7d" ), ( self.day( -7 ), self.day( 0 ) ) )
+      self.assertEqual( self.range( "2030-01-01..2030-02-01" ),
+                        ( "2030-01-01", "2030-02-01" ) )
+      self.assertEqual( self.range( "..+3d" ), ( None, self.day( 3 ) ) )
+      self.assertEqual( self.range( "today.." ), ( self.day( 0 ), None ) )
+
+   def test_bad_formats( self ):
+      for due in ( "tomorrow", "2030-1-2", "+2030-13-01", "1w", "2030-01-01..soon" ):
+         with self.assertRaises( RuntimeError, msg=due ):
+            Task.DueMatcher( due )
+
+   def test_match( self ):
+      matcher = Task.DueMatcher( "2030-01-01..2030-01-31" )
+      task = newTask( "pay" )
+      self.assertFalse( matcher.match( task ) )
+      for dueDate, expected in ( ( "2029-12-31", False ), ( "2030-01-01", True ),
+                                 ( "2030-01-31", True ), ( "2030-02-01", False ) ):
+         task.dueDate = dueDate
+         self.assertEqual( matcher.match( task ), expected, dueDate )
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import unittest
+
+repoDir = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, repoDir )
+sys.path.insert( 0, os.path.join( repoDir, "benchmarks" ) )
+
+import scenarios
+from GoogleTasks import GoogleTasks
+
+class FakeServer( scenarios.FakeServer ):
+   # Keeps the last client, so what it loaded can be looked at
+   def finish( self ):
+      self.lastTaskApi = self.taskApi
+      super().finish()
+
+class Runner( scenarios.Runner ):
+   def __init__( self ):
+      super().__init__( scenarios.loadTaskScript(), GoogleTasks, lists=10,
+                        tasks=6, latency=0, verbose=False )
+
+   def start( self, **serviceOptions ):
+      super().start( **serviceOptions )
+      self.server = FakeServer( self.service, self.backend )
+
+   def report( self, description, elapsed ):
+      pass
+
+class CommandTest( unittest.TestCase ):
+   # Each test starts with a fresh home, cache and fake service
+   def setUp( self ):
+      self.home = os.environ.get( 'HOME' )
+      self.editor = os.environ.get( 'EDITOR' )
+      self.runner = Runner()
+      self.runner.start()
+
+   def tearDown( self ):
+      for name, value in ( ( 'HOME', self.home ), ( 'EDITOR', self.editor ) ):
+         if value is None:
+            os.environ.pop( name, None )
+         else:
+            os.environ[ name ] = value
+      self.runner.home.cleanup()
+
+class FilteredIdsTest( CommandTest ):
+   # Ids shown for some projects must still mean the same tasks once the
+   # rest are loaded
+   def taskCount( self ):
+      service = self.runner.service
+      return sum( len( tasks ) for tasks in service.tasksByList.values() )
+
+   def test_bulk_after_filtered_ls( self ):
+      runner = self.runner
+      before = self.taskCount()
+      runner.run( "", "ls", "p:List0" )
+      runner.editor( """
+first = [ n for n, line in enumerate( lines ) if line.startswith( "** " ) ][ 0 ]
+lines[ first ] = lines[ first ].replace( "] ", "] [2030-01-01] ", 1 )
+""" )
+      runner.run( "", "bulk", "p:List0" )
+      calls = runner.service.calls
+      self.assertEqual( calls[ "tasks.insert" ], 0 )
+      self.assertEqual( calls[ "tasks.move" ], 0 )
+      self.assertEqual( calls[ "tasks.update" ] + calls[ "tasks.patch" ], 1 )
+      self.assertEqual( self.taskCount(), before )
+
+   def test_done_after_filtered_ls( self ):
+      runner = self.runner
+      runner.run( "", "ls", "p:List0" )
+      shortId = [ task.shortId for task in runner.server.lastTaskApi.allTasks
+                  if task.title == "L0T3" ][ 0 ]
+      runner.run( "", "done", shortId )
+      tasks = list( runner.service.tasksByList.values() )[ 0 ].values()
+      done = [ task[ 'title' ] for task in tasks if task[ 'status' ] == "completed" ]
+      self.assertEqual( done, [ "L0T3" ] )
+
+class BatchRetryTest( CommandTest ):
+   def test_failed_batch_is_retried( self ):
+      runner = self.runner
+      runner.run( "", "ls" )
+      runner.service.failBatches( 503 )
+      runner.editor( """
+lines = [ line.replace( "[ ]", "[X]" ) if line.startswith( "** " ) else line
+          for line in lines ]
+""" )
+      runner.run( "", "bulk", "p:List2" )
+      self.assertEqual( runner.service.httpRequests[ "batch" ], 2 )
+      tasks = list( runner.service.tasksByList.values() )[ 2 ].values()
+      self.assertEqual( sorted( task[ 'title' ] for task in tasks
+                                if task[ 'status' ] != "completed" ),
+                        [ "L2T1S" ] )
+
+class InsertTest( CommandTest ):
+   def test_new_tasks_are_placed_as_inserted( self ):
+      runner = self.runner
+      runner.run( "", "ls" )
+      runner.editor( """
+lines.append( "* (p) New list" )
+lines.extend( "** (t) [ ] New task %d" % n for n in range( 4 ) )
+lines.insert( len( lines ) - 2, "*** (t) [ ] New subtask" )
+""" )
+      runner.run( "", "bulk", "p:List4" )
+      calls = runner.service.calls
+      self.assertEqual( calls[ "tasks.insert" ], 5 )
+      self.assertEqual( calls[ "tasks.move" ], 0 )
+      tasks = list( runner.service.tasksByList.values() )[ -1 ].values()
+      byId = { task[ 'id' ]: task for task in tasks }
+      topLevel = sorted( ( task for task in tasks if 'parent' not in task ),
+                         key=lambda task: task[ 'position' ] )
+      self.assertEqual( [ task[ 'title' ] for task in topLevel ],
+                        [ "New task %d" % n for n in range( 4 ) ] )
+      subtask = [ task for task in tasks if 'parent' in task ][ 0 ]
+      self.assertEqual( subtask[ 'title' ], "New subtask" )
+      self.assertEqual( byId[ subtask[ 'parent' ] ][ 'title' ], "New task 1" )
+
+if __name__ == '__main__':
+   unittest.main()